@@ -3,4 +3,6 @@ from .candidate import Candidate as Candidate  #noqa: E402
 from .instrument import Instrument as Instrument  # noqa: E402
 from .instrument import Footprint as Footprint  # noqa: E402
 from .alert import Alert as Alert  # noqa: E402
-from .event_tools import plot_coverage, calculate_coverage, renormalize_skymap, candidate_coverage  # noqa: E402, F401
\ No newline at end of file
+from .core.spatial import PointingIndex as PointingIndex  # noqa: E402
+from .core.skymap import MultiOrderSkymap as MultiOrderSkymap  # noqa: E402
+from .event_tools import plot_coverage, calculate_coverage, renormalize_skymap, candidate_coverage, update_coverage, coverage_timeline, batch_candidate_coverage  # noqa: E402, F401
\ No newline at end of file
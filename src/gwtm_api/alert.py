@@ -1,5 +1,6 @@
 import datetime
 import json
+import os
 import healpy as hp
 import tempfile
 
@@ -7,6 +8,8 @@ from .core import baseapi
 from .core import apimodels
 from .core.tmcache import TMCache
 from .core import util
+from .core.skymap import DEFAULT_SPARSE_CREDIBLE, MultiOrderSkymap, SparseSkymap, pyramid_nside, skymap_pyramid, \
+    greedy_sort, greedy_credible_levels
 
 class Alert(apimodels._Table):
     id: int = None
@@ -100,7 +103,11 @@ class Alert(apimodels._Table):
         super().__init__(payload=selfdict)
 
     @staticmethod
-    def get(api_token: str, id: int = None, graceid: str = None, urlencode=False):
+    def get(api_token: str, id: int = None, graceid: str = None, urlencode=False, cache=False):
+        '''
+            cache: bool - keep the response in the TMCache (memory and disk), keyed by the query.
+                it is served for baseapi.CACHE_TTLS["query_alerts"] seconds, then revalidated with the server
+        '''
 
         get_dict = util.non_none_locals(locals=locals())
 
@@ -109,10 +116,9 @@ class Alert(apimodels._Table):
         }
 
         api = baseapi.api(target="query_alerts")
-        req = api._get(r_json=r_json, urlencode=urlencode)
+        status_code, request_json = api._get_json(r_json=r_json, urlencode=urlencode, cache=cache)
 
-        if req.status_code == 200:
-            request_json = json.loads(req.text)
+        if status_code == 200:
             for i in request_json:
                 if isinstance(i, str):
                     alert_json = json.loads(i)
@@ -121,11 +127,14 @@ class Alert(apimodels._Table):
                 #only return the first since it is the most recent
                 return Alert(kwdict=alert_json)
         else:
-            raise Exception(f"Error in Alert.get(). Request: {req.text[0:1000]}")
+            raise Exception(f"Error in Alert.get(). Request: {request_json[0:1000]}")
 
 
     @staticmethod
-    def get_all(api_token: str, id: int = None, graceid: str = None, urlencode=False):
+    def get_all(api_token: str, id: int = None, graceid: str = None, urlencode=False, cache=False):
+        '''
+            cache: bool - keep the response in the TMCache, see Alert.get
+        '''
 
         get_dict = util.non_none_locals(locals=locals())
 
@@ -134,11 +143,10 @@ class Alert(apimodels._Table):
         }
 
         api = baseapi.api(target="query_alerts")
-        req = api._get(r_json=r_json, urlencode=urlencode)
+        status_code, request_json = api._get_json(r_json=r_json, urlencode=urlencode, cache=cache)
 
         ret = []
-        if req.status_code == 200:
-            request_json = json.loads(req.text)
+        if status_code == 200:
             for i in request_json:
                 if isinstance(i, str):
                     alert_json = json.loads(i)
@@ -146,13 +154,25 @@ class Alert(apimodels._Table):
                     alert_json = i
                 ret.append(Alert(kwdict=alert_json))
         else:
-            raise Exception(f"Error in Alert.get(). Request: {req.text[0:1000]}")
+            raise Exception(f"Error in Alert.get(). Request: {request_json[0:1000]}")
 
         return ret
 
 
+    @staticmethod
+    async def get_all_async(*args, **kwargs):
+        '''
+            Awaitable Alert.get_all, run on the shared connection pool
+        '''
+        return await baseapi.run_async(Alert.get_all, *args, **kwargs)
+
+
     @staticmethod
     def fetch_contours(api_token: str, id: int = None, graceid: str = None, urlencode=False, cache=False):
+        '''
+            cache: bool - keep the contours in the TMCache, revalidated with the server after
+                baseapi.CACHE_TTLS["gw_contour"] seconds so a new alert's contours are picked up
+        '''
 
         get_dict = util.non_none_locals(locals=locals())
 
@@ -160,23 +180,10 @@ class Alert(apimodels._Table):
             "d_json":get_dict
         }
 
-        request_json = None
-        if cache:
-            cache_name = f"{graceid}_gw_contour.json"
-            contour_cache = TMCache(filename=cache_name, cache_type="json")
-            request_json = contour_cache.get()
-
-        if request_json is None:
-            api = baseapi.api(target="gw_contour")
-            req = api._get(r_json=r_json, urlencode=urlencode)
-
-            if req.status_code == 200:
-                request_json = json.loads(req.text)
-            else:
-                raise Exception(f"Error in Alert.fetch_contours(). Request: {req.text[0:1000]}")
-
-        if cache:
-            contour_cache.put(payload=request_json)
+        api = baseapi.api(target="gw_contour")
+        status_code, request_json = api._get_json(r_json=r_json, urlencode=urlencode, cache=cache)
+        if status_code != 200:
+            raise Exception(f"Error in Alert.fetch_contours(). Request: {request_json[0:1000]}")
 
         contour_polygons = []
         for contour in request_json['features']:
@@ -185,7 +192,32 @@ class Alert(apimodels._Table):
 
 
     @staticmethod
-    def fetch_skymap(api_token: str, id: int = None, graceid: str = None, urlencode=False, cache=False):
+    async def fetch_contours_async(*args, **kwargs):
+        '''
+            Awaitable Alert.fetch_contours, run on the shared connection pool
+        '''
+        return await baseapi.run_async(Alert.fetch_contours, *args, **kwargs)
+
+
+    @staticmethod
+    def fetch_skymap(api_token: str, id: int = None, graceid: str = None, urlencode=False, cache=False, progress=None,
+        moc=False, resolution: int = None):
+        '''
+            The event's flat skymap in RING ordering. With cache=True it is kept as a raw
+            .npy in the TMCache and returned memory-mapped read-only, so processes reading
+            the same event share one copy in the page cache. Copy it before writing to it.
+
+            The fits file is streamed to disk in chunks, never held in memory.
+            progress: callable - called after each chunk with the download stats, see baseapi.api._download
+            moc: bool - return a MultiOrderSkymap (UNIQ, PROBDENSITY) instead, without flattening it.
+                flat files are merged into multi-order pixels
+            resolution: int - the nside that is fine enough. the skymap is downgraded (probability
+                preserving) to the coarsest power of two nside at or above it, down to nside 64.
+                with cache=True every level is built once, when the skymap is first cached.
+                only for flat skymaps, a MultiOrderSkymap is rasterized to a resolution by its caller
+        '''
+        if moc and resolution is not None:
+            raise ValueError("Error in Alert.fetch_skymap(). resolution only applies to flat skymaps, not moc=True")
 
         get_dict = util.non_none_locals(locals=locals())
 
@@ -193,23 +225,125 @@ class Alert(apimodels._Table):
             "d_json":get_dict
         }
 
-        request_map = None
+        def download(fits_path):
+            api = baseapi.api(target="gw_skymap")
+            req = api._download(r_json=r_json, path=fits_path, urlencode=urlencode, progress=progress)
+            if req.status_code != 200:
+                raise Exception(f"Error in Alert.fetch_skymap(). Request: {req.text[0:1000]}")
+
+        if moc:
+            return Alert._fetch_multiorder_skymap(graceid=graceid, cache=cache, download=download)
+
         if cache:
-            cache_name = f"{graceid}_gw_skymap.fits"
-            skymap_cache = TMCache(filename=cache_name, cache_type="fits")
-            request_map = skymap_cache.get()
+            def fetch():
+                #the fits is downloaded into the cache and converted once. a fits cached by earlier versions is converted as is
+                fits_cache = TMCache(filename=f"{graceid}_gw_skymap.fits", cache_type="fits", graceid=graceid)
+                if not os.path.exists(fits_cache.cache_path):
+                    download(fits_cache.cache_path)
+                skymap = hp.read_map(fits_cache.cache_path)
+                os.remove(fits_cache.cache_path)
+                Alert._put_skymap_pyramid(graceid, skymap)
+                return skymap
+
+            #one download per event however many processes miss at once
+            request_map = TMCache(filename=f"{graceid}_gw_skymap.npy", cache_type="npy", graceid=graceid).get_or_fetch(fetch)
+
+            level = pyramid_nside(hp.npix2nside(len(request_map)), resolution)
+            if level != hp.npix2nside(len(request_map)):
+                request_map = Alert._get_skymap_level(graceid, request_map, level)
+        else:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                fits_path = os.path.join(tmp_dir, f"{graceid}_gw_skymap.fits")
+                download(fits_path)
+                request_map = hp.read_map(fits_path)
 
-        if request_map is None:
-            api = baseapi.api(target="gw_skymap")
-            req = api._get(r_json=r_json, urlencode=urlencode)
+            level = pyramid_nside(hp.npix2nside(len(request_map)), resolution)
+            if level != hp.npix2nside(len(request_map)):
+                request_map = hp.ud_grade(request_map, level, power=-2)
+
+        return request_map
+
+
+    @staticmethod
+    def _skymap_level_cache(graceid: str, nside: int) -> TMCache:
+        return TMCache(filename=f"{graceid}_gw_skymap_nside{nside}.npy", cache_type="npy", graceid=graceid)
+
+
+    @staticmethod
+    def _put_skymap_pyramid(graceid: str, skymap):
+        for nside, level in skymap_pyramid(skymap):
+            Alert._skymap_level_cache(graceid, nside).put(payload=level, overwrite=True)
+
+
+    @staticmethod
+    def _get_skymap_level(graceid: str, skymap, nside: int):
+        #only missing for skymaps cached before the pyramid was built
+        return Alert._skymap_level_cache(graceid, nside).get_or_fetch(lambda: hp.ud_grade(skymap, nside, power=-2))
+
+
+    @staticmethod
+    def _fetch_multiorder_skymap(graceid: str, cache: bool, download) -> MultiOrderSkymap:
+        def fetch():
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                fits_path = os.path.join(tmp_dir, f"{graceid}_gw_skymap.fits")
+                download(fits_path)
+                return MultiOrderSkymap.from_fits(fits_path)
 
-            if req.status_code == 200:
-                with tempfile.NamedTemporaryFile() as _tmp_file:
-                    _tmp_file.write(req.content)
-                    request_map = hp.read_map(_tmp_file.name)
-            else:
-                raise Exception(f"Error in Alert.fetch_skymap(). Request: {req.text[0:1000]}")
         if cache:
-            skymap_cache.put(payload=request_map)
+            skymap_cache = TMCache(filename=f"{graceid}_gw_skymap_moc.npz", cache_type="npz", graceid=graceid)
+            return MultiOrderSkymap.from_payload(skymap_cache.get_or_fetch(lambda: fetch().to_payload()))
+        return fetch()
 
-        return request_map
\ No newline at end of file
+
+    @staticmethod
+    def fetch_credible_levels(api_token: str, graceid: str, cache=False, resolution: int = None):
+        '''
+            The greedy credible level (0-1) of each pixel of the event's flat skymap, and the
+            sort permutation it comes from (pixels from most to least probable). With cache=True
+            both are computed once per skymap and pyramid level, and returned memory-mapped.
+            returns (levels, sort)
+        '''
+        skymap = Alert.fetch_skymap(api_token=api_token, graceid=graceid, cache=cache, resolution=resolution)
+        if not cache:
+            sort = greedy_sort(skymap)
+            return greedy_credible_levels(skymap, sort), sort
+
+        name = f"{graceid}_gw_skymap_nside{hp.npix2nside(len(skymap))}"
+        sort = TMCache(filename=f"{name}_greedy_sort.npy", cache_type="npy", graceid=graceid).get_or_fetch(
+            lambda: greedy_sort(skymap)
+        )
+        levels = TMCache(filename=f"{name}_credible_levels.npy", cache_type="npy", graceid=graceid).get_or_fetch(
+            lambda: greedy_credible_levels(skymap, sort)
+        )
+        return levels, sort
+
+
+    @staticmethod
+    def fetch_sparse_skymap(api_token: str, graceid: str, credible: float = DEFAULT_SPARSE_CREDIBLE, cache=False,
+        progress=None, resolution: int = None) -> SparseSkymap:
+        '''
+            The pixels of the event's skymap inside its credible region as a SparseSkymap.
+            With cache=True it is built once, and later calls do not load the full skymap.
+            resolution: int - build it from a pyramid level, see fetch_skymap
+        '''
+        def fetch():
+            return SparseSkymap.from_flat(
+                Alert.fetch_skymap(api_token=api_token, graceid=graceid, cache=cache, progress=progress, resolution=resolution),
+                credible=credible
+            )
+
+        if cache:
+            level = f"_resolution{resolution}" if resolution is not None else ""
+            sparse_cache = TMCache(
+                filename=f"{graceid}_gw_skymap_sparse_{credible}{level}.npz", cache_type="npz", graceid=graceid
+            )
+            return SparseSkymap.from_payload(sparse_cache.get_or_fetch(lambda: fetch().to_payload()))
+        return fetch()
+
+
+    @staticmethod
+    async def fetch_skymap_async(*args, **kwargs):
+        '''
+            Awaitable Alert.fetch_skymap, run on the shared connection pool
+        '''
+        return await baseapi.run_async(Alert.fetch_skymap, *args, **kwargs)
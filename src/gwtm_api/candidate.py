@@ -211,6 +211,14 @@ class Candidate(apimodels._Table):
             return ret
         else:
             raise Exception(f"Error in Candidate.get(). Request: {req.text[0:1000]}")
+
+
+    @staticmethod
+    async def get_async(*args, **kwargs) -> List[Candidate]:
+        '''
+            Awaitable Candidate.get, run on the shared connection pool
+        '''
+        return await baseapi.run_async(Candidate.get, *args, **kwargs)
     
 
     def put(
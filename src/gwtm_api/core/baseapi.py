@@ -1,11 +1,247 @@
+import asyncio
+import functools
+import hashlib
+import json
 import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import urllib.parse
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+from .tmcache import TMCache
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+#seconds a cached GET of each endpoint is served before it is revalidated with the server.
+#footprints and instruments rarely change, pointings and alerts arrive throughout an event
+CACHE_TTLS = {
+    "footprints": 7 * 24 * 3600,
+    "instruments": 24 * 3600,
+    "gw_contour": 600,
+    "query_alerts": 60,
+    "pointings": 60
+}
+DEFAULT_CACHE_TTL = 300
+
+#only verbs that are safe to replay are retried on read errors and bad gateway responses
+RETRY_METHODS = frozenset(["GET", "PUT", "DELETE", "HEAD", "OPTIONS"])
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+class _ConnectionCounters():
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.requests = 0
+        self.downloaded = 0
+
+    def open(self):
+        with self._lock:
+            self.opened += 1
+
+    def request(self):
+        with self._lock:
+            self.requests += 1
+
+    def download(self, n_bytes):
+        with self._lock:
+            self.downloaded += n_bytes
+
+
+def _counting_pool(pool_cls, counters):
+    def _new_conn(self):
+        counters.open()
+        return pool_cls._new_conn(self)
+
+    def _make_request(self, *args, **kwargs):
+        counters.request()
+        return pool_cls._make_request(self, *args, **kwargs)
+
+    return type(f"_Counting{pool_cls.__name__}", (pool_cls,), {
+        "_new_conn": _new_conn,
+        "_make_request": _make_request
+    })
+
+
+class _CountingAdapter(HTTPAdapter):
+
+    def __init__(self, counters, **kwargs):
+        self._counters = counters
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _counting_pool(HTTPConnectionPool, self._counters),
+            "https": _counting_pool(HTTPSConnectionPool, self._counters)
+        }
+
+
+class Client():
+    '''
+        Keep-alive HTTP client shared by every api instance.
+
+        pool_size: int - number of pooled connections kept open per host, and
+            the maximum number of requests the async helpers run at once
+        max_retries: int - retries for failed connections and idempotent verbs
+        backoff_factor: float - exponential backoff between retries (seconds)
+    '''
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, max_retries=DEFAULT_MAX_RETRIES,
+        backoff_factor=DEFAULT_BACKOFF_FACTOR):
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self._counters = _ConnectionCounters()
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=RETRY_METHODS,
+            raise_on_status=False
+        )
+        adapter = _CountingAdapter(
+            self._counters, pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+        )
+
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+
+    def request(self, method, url, **kwargs):
+        response = self.session.request(method, url, **kwargs)
+        #a streamed body is counted by the caller as it reads it
+        if not kwargs.get("stream", False):
+            self._counters.download(len(response.content))
+        return response
+
+
+    def executor(self) -> ThreadPoolExecutor:
+        #sized to the connection pool so concurrent calls never wait on a connection
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="gwtm_api")
+            return self._executor
+
+
+    def stats(self) -> dict:
+        opened = self._counters.opened
+        sent = self._counters.requests
+        return {
+            "requests": sent,
+            "connections_opened": opened,
+            "connections_reused": max(sent - opened, 0),
+            "bytes_downloaded": self._counters.downloaded
+        }
+
+
+    def close(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> Client:
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = Client()
+        return _client
+
+
+def configure(pool_size=DEFAULT_POOL_SIZE, max_retries=DEFAULT_MAX_RETRIES,
+    backoff_factor=DEFAULT_BACKOFF_FACTOR) -> Client:
+    '''
+        Replace the shared client, closing the pooled connections of the previous one
+    '''
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = Client(pool_size=pool_size, max_retries=max_retries, backoff_factor=backoff_factor)
+        return _client
+
+
+def connection_stats() -> dict:
+    return get_client().stats()
+
+
+async def run_async(func, *args, **kwargs):
+    '''
+        Await a blocking api call on the shared client's worker pool. At most
+        pool_size calls are in flight at once, all over the pooled connections.
+    '''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_client().executor(), functools.partial(func, *args, **kwargs))
+
+
+def map_concurrent(func, items, max_workers=None) -> list:
+    '''
+        Run a blocking api call over items concurrently and return the results in order.
+        Uses its own short-lived threads (bounded by the connection pool size) so it is
+        safe to call from inside run_async.
+    '''
+    items = list(items)
+    if len(items) <= 1:
+        return [func(x) for x in items]
+    if max_workers is None:
+        max_workers = get_client().pool_size
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(func, items))
+
+
+class _CachedResponse():
+    '''
+        A 200 response whose json body came from the TMCache, or was just stored in it.
+        Has the status_code, text, json() and headers of a requests.Response.
+
+        from_cache: bool - False when the body was just downloaded
+    '''
+    status_code = 200
+    ok = True
+
+    def __init__(self, url, body, meta, from_cache=True):
+        self.url = url
+        self.body = body
+        self.from_cache = from_cache
+        self.headers = {}
+        if meta.get("etag") is not None:
+            self.headers["ETag"] = meta["etag"]
+        if meta.get("last_modified") is not None:
+            self.headers["Last-Modified"] = meta["last_modified"]
+
+
+    @property
+    def text(self) -> str:
+        return json.dumps(self.body)
+
+
+    def json(self):
+        return self.body
 
 
 class api():
 
-    def __init__(self, target=None, token=None, base='https://treasuremap.space/api/', api_version='v1'):
+    def __init__(self, target=None, token=None, base='https://treasuremap.space/api/', api_version='v1', client=None):
         self.base = f'{base}{api_version}'
         self.target = target
 
@@ -13,6 +249,7 @@ class api():
             self.token = os.getenv('GWTM_API_TOKEN')
         else:
             self.token = token
+        self.client = client if client is not None else get_client()
         self.url = None
         self.request = None
 
@@ -27,30 +264,166 @@ class api():
         data = r_json['data'] if 'data' in r_json.keys() else None
         files = r_json['files'] if 'files' in r_json.keys() else None
         d_json = r_json['d_json'] if 'd_json' in r_json.keys() else None
-        self.request = requests.post(self.url, json=d_json, data=data, files=files)
+        self.request = self.client.request("POST", self.url, json=d_json, data=data, files=files)
         return self.request
 
 
-    def _get(self, r_json, urlencode=False):
+    def _get(self, r_json, urlencode=False, cache=False, ttl=None):
+        '''
+            GET the target. With cache=True the json body of a 200 is kept in the TMCache with the
+            response's ETag and Last-Modified. For ttl seconds (default = CACHE_TTLS of the target)
+            it is served without a request, after that it is revalidated with a conditional GET
+            and served again on a 304 Not Modified.
+
+            returns: the response. a body served or stored by the cache is a _CachedResponse
+        '''
         self._build_url()
         d_json = r_json['d_json'] if 'd_json' in r_json.keys() else None
+        if not cache:
+            return self._send_get(d_json, urlencode)
+
+        if ttl is None:
+            ttl = CACHE_TTLS.get(self.target, DEFAULT_CACHE_TTL)
+        graceid = d_json.get("graceid") if isinstance(d_json, dict) else None
+        entry = TMCache(filename=self._cache_key(d_json), cache_type="json", graceid=graceid)
+        url = self.url
+
+        def cached():
+            body, meta = entry.get(), entry.get_meta()
+            if body is None or meta is None:
+                return None, None
+            return body, meta
+
+        body, meta = cached()
+        if body is not None and time.time() - meta["fetched"] < ttl:
+            return _CachedResponse(url, body, meta)
+
+        with entry.lock():
+            #revalidated while this caller waited for the lock
+            body, meta = cached()
+            if body is not None and time.time() - meta["fetched"] < ttl:
+                return _CachedResponse(url, body, meta)
+
+            headers = {}
+            if body is not None and meta.get("etag") is not None:
+                headers["If-None-Match"] = meta["etag"]
+            if body is not None and meta.get("last_modified") is not None:
+                headers["If-Modified-Since"] = meta["last_modified"]
+            self.request = self._send_get(d_json, urlencode, headers=headers)
+
+            if self.request.status_code == 304 and body is not None:
+                meta = {**meta, "fetched": time.time(), "revalidated": meta.get("revalidated", 0) + 1}
+                entry.put_meta(meta)
+                return _CachedResponse(url, body, meta)
+            if self.request.status_code != 200:
+                return self.request
+
+            body = json.loads(self.request.text)
+            meta = {
+                "etag": self.request.headers.get("ETag"),
+                "last_modified": self.request.headers.get("Last-Modified"),
+                "fetched": time.time()
+            }
+            entry.put(payload=body, overwrite=True)
+            entry.put_meta(meta)
+            return _CachedResponse(url, body, meta, from_cache=False)
+
+
+    def _send_get(self, d_json, urlencode=False, headers=None):
         if urlencode:
             self.url = f"{self.url}?{urllib.parse.urlencode(d_json)}"
-            self.request = requests.get(self.url)
+            self.request = self.client.request("GET", self.url, headers=headers)
         else:
-            self.request = requests.get(self.url, json=d_json)
+            self.request = self.client.request("GET", self.url, json=d_json, headers=headers)
+        return self.request
+
+
+    def _cache_key(self, d_json) -> str:
+        '''
+            cache filename of a GET: the endpoint, the graceid if any (so TMCache.pin covers
+            it) and a hash of the normalized query
+        '''
+        query = json.dumps({"url": self.url, "query": d_json}, sort_keys=True, default=str)
+        digest = hashlib.sha1(query.encode("utf-8")).hexdigest()[:24]
+        graceid = d_json.get("graceid") if isinstance(d_json, dict) else None
+        label = f"_{graceid}" if isinstance(graceid, str) else ""
+        return f"api_{self.target.replace('/', '_')}{label}_{digest}.json"
+
+
+    def _get_json(self, r_json, urlencode=False, cache=False, ttl=None):
+        '''
+            GET the target and parse its json body, see _get for cache and ttl.
+            a cached body is returned as is, without parsing it again
+
+            returns: (status_code, body) - body is the parsed json on a 200, else the response text
+        '''
+        req = self._get(r_json=r_json, urlencode=urlencode, cache=cache, ttl=ttl)
+        if req.status_code != 200:
+            return req.status_code, req.text
+        return 200, req.json()
+
+
+    def _download(self, r_json, path, urlencode=False, progress=None, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        '''
+            GET the target streamed in chunks into path, so the body is never held in memory.
+            The chunks go to a temporary file next to path that is renamed over it once
+            complete, so path never holds a partial download.
+
+            progress: callable - called after each chunk with a dict of
+                bytes, total (None when the server does not send a length), seconds and bytes_per_second
+            returns: the response. on a 200 its stats dict is set as response.download_stats
+        '''
+        self._build_url()
+        d_json = r_json['d_json'] if 'd_json' in r_json.keys() else None
+        if urlencode:
+            self.url = f"{self.url}?{urllib.parse.urlencode(d_json)}"
+            d_json = None
+
+        self.request = self.client.request("GET", self.url, json=d_json, stream=True)
+        if self.request.status_code != 200:
+            #read the (error) body, which releases the connection to the pool
+            self.client._counters.download(len(self.request.content))
+            return self.request
+
+        total = self.request.headers.get("Content-Length")
+        stats = {
+            "bytes": 0,
+            "total": int(total) if total is not None else None,
+            "seconds": 0.0,
+            "bytes_per_second": 0.0
+        }
+        start = time.monotonic()
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".part")
+        try:
+            with self.request, os.fdopen(fd, "wb") as output_file:
+                for chunk in self.request.iter_content(chunk_size=chunk_size):
+                    output_file.write(chunk)
+                    self.client._counters.download(len(chunk))
+                    stats["bytes"] += len(chunk)
+                    stats["seconds"] = time.monotonic() - start
+                    stats["bytes_per_second"] = stats["bytes"] / stats["seconds"] if stats["seconds"] > 0 else 0.0
+                    if progress is not None:
+                        progress(dict(stats))
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        self.request.download_stats = stats
         return self.request
 
 
     def _put(self, r_json):
         self._build_url()
         d_json = r_json['d_json']
-        self.request = requests.put(self.url, json=d_json)
+        self.request = self.client.request("PUT", self.url, json=d_json)
         return self.request
 
 
     def _delete(self, r_json):
         self._build_url()
         d_json = r_json['d_json']
-        self.request = requests.delete(self.url, json=d_json)
+        self.request = self.client.request("DELETE", self.url, json=d_json)
         return self.request
@@ -0,0 +1,167 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import healpy as hp
+
+from . import util
+
+#shards per worker, so one slow shard of large polygons doesn't idle the rest of the pool
+SHARDS_PER_WORKER = 4
+
+
+def pixels_to_ranges(pixels: np.ndarray) -> np.ndarray:
+    '''
+        compress pixel indices into sorted, disjoint, half-open [start, stop) ranges
+        returns an int64 array with shape (n_ranges, 2)
+    '''
+    pixels = np.unique(np.asarray(pixels, dtype=np.int64))
+    if len(pixels) == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    breaks = np.flatnonzero(np.diff(pixels) != 1) + 1
+    starts = pixels[np.concatenate([[0], breaks])]
+    stops = pixels[np.concatenate([breaks - 1, [len(pixels) - 1]])] + 1
+    return np.stack([starts, stops], axis=-1)
+
+
+def ranges_to_pixels(ranges: np.ndarray) -> np.ndarray:
+    '''
+        expand [start, stop) ranges back into their pixel indices
+    '''
+    ranges = np.asarray(ranges, dtype=np.int64).reshape(-1, 2)
+    lengths = ranges[:, 1] - ranges[:, 0]
+    return np.repeat(ranges[:, 0] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+
+def polygon_ranges(polygons: list, nside: int, nest: bool = False, inclusive: bool = False, workers: int = None):
+    '''
+        pixelize polygons of (ra, dec) vertices into pixel ranges. with workers > 1 the polygons are
+        sharded across a process pool and the ranges of every shard are yielded as they complete,
+        otherwise a single shard is pixelized in this process.
+        the shards' ranges are each disjoint, but may overlap each other
+    '''
+    if workers is None or workers <= 1 or len(polygons) < 2:
+        yield _pixelize_shard(nside, nest, inclusive, polygons)
+        return
+
+    n_shards = min(len(polygons), workers * SHARDS_PER_WORKER)
+    shards = [polygons[i::n_shards] for i in range(n_shards)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(_pixelize_shard, nside, nest, inclusive, shard) for shard in shards
+        ]
+        for future in futures:
+            yield future.result()
+
+
+def grouped_polygon_ranges(groups: list, nside: int, nest: bool = False, inclusive: bool = False, workers: int = None) -> list:
+    '''
+        pixelize groups of polygons (e.g. the ccds of each pointing) into the pixel ranges of each
+        group, in order. with workers > 1 the groups are sharded across a process pool
+    '''
+    if workers is None or workers <= 1 or len(groups) < 2:
+        return _pixelize_groups(nside, nest, inclusive, groups)
+
+    n_shards = min(len(groups), workers * SHARDS_PER_WORKER)
+    ranges = [None] * len(groups)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(_pixelize_groups, nside, nest, inclusive, groups[i::n_shards]) for i in range(n_shards)
+        ]
+        for i, future in enumerate(futures):
+            ranges[i::n_shards] = future.result()
+    return ranges
+
+
+def _pixelize_groups(nside: int, nest: bool, inclusive: bool, groups: list) -> list:
+    return [_pixelize_shard(nside, nest, inclusive, polygons) for polygons in groups]
+
+
+def _pixelize_shard(nside: int, nest: bool, inclusive: bool, polygons: list) -> np.ndarray:
+    pixels = [
+        hp.query_polygon(nside, util.polygon_to_uvecs(polygon), inclusive=inclusive, nest=nest)
+        for polygon in polygons
+    ]
+    if len(pixels) == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    return pixels_to_ranges(np.concatenate(pixels))
+
+
+class CoverageMask():
+    '''
+        Covered sky pixels accumulated as a preallocated boolean array of length npix.
+        Pixels from overlapping polygons are OR-ed in, so nothing is double counted
+        and memory does not grow with the number of polygons.
+
+        nside: int - healpix resolution of the mask, normally the skymap's
+        nest: bool - pixel ordering of the mask, must match the skymap
+    '''
+
+    def __init__(self, nside: int, nest: bool = False):
+        self.nside = nside
+        self.nest = nest
+        self.mask = np.zeros(hp.nside2npix(nside), dtype=bool)
+
+
+    def add(self, pixels: np.ndarray) -> np.ndarray:
+        '''
+            pixels: unique pixel indices
+            returns the pixels that were not already covered
+        '''
+        new_pixels = pixels[~self.mask[pixels]]
+        self.mask[new_pixels] = True
+        return new_pixels
+
+
+    def add_polygon(self, polygon, inclusive: bool = False) -> np.ndarray:
+        '''
+            polygon: list of (ra, dec) vertices in degrees, optionally closed
+            returns the pixels that were not already covered
+        '''
+        pixels = hp.query_polygon(self.nside, util.polygon_to_uvecs(polygon), inclusive=inclusive, nest=self.nest)
+        return self.add(pixels)
+
+
+    def add_ranges(self, ranges: np.ndarray):
+        '''
+            ranges: disjoint half-open [start, stop) pixel ranges, as returned by pixels_to_ranges
+        '''
+        #proportional to the pixels in the ranges, not to npix, so merging a shard stays cheap
+        if len(ranges) == 0:
+            return
+        self.mask[ranges_to_pixels(ranges)] = True
+
+
+    def add_polygons(self, polygons: list, inclusive: bool = False, workers: int = None):
+        '''
+            pixelize many polygons. with workers > 1 the polygons are sharded across a process pool,
+            each worker returns the compressed pixel ranges of its shard and they are merged here.
+            the workers only need the nside, so the skymap is never sent to them.
+        '''
+        if workers is None or workers <= 1 or len(polygons) < 2:
+            for polygon in polygons:
+                self.add_polygon(polygon, inclusive=inclusive)
+            return
+
+        for ranges in polygon_ranges(polygons, self.nside, nest=self.nest, inclusive=inclusive, workers=workers):
+            self.add_ranges(ranges)
+
+
+    def pixels(self) -> np.ndarray:
+        return np.flatnonzero(self.mask)
+
+
+    def count(self) -> int:
+        return int(np.count_nonzero(self.mask))
+
+
+    def area(self) -> float:
+        '''
+            covered area in deg^2
+        '''
+        return self.count() * hp.nside2pixarea(self.nside, degrees=True)
+
+
+    def probability(self, skymap: np.ndarray) -> float:
+        '''
+            summed skymap probability of the covered pixels
+        '''
+        return float(np.sum(skymap[self.mask]))
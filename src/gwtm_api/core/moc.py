@@ -0,0 +1,199 @@
+import io
+import numpy as np
+import healpy as hp
+
+from . import coverage
+
+#ranges are stored as cells of the deepest HEALPix order
+MAX_ORDER = 29
+
+
+def _boundaries(ranges: np.ndarray) -> np.ndarray:
+    return ranges.reshape(-1)
+
+
+def _contains(boundaries: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    #a position is covered when an odd number of range boundaries are at or before it
+    return np.searchsorted(boundaries, positions, side="right") % 2 == 1
+
+
+def _merge(ranges: np.ndarray) -> np.ndarray:
+    '''
+        merge sorted-by-start ranges that overlap or touch
+    '''
+    ranges = ranges[ranges[:, 1] > ranges[:, 0]]
+    if len(ranges) == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    stops = np.maximum.accumulate(ranges[:, 1])
+    new_run = np.concatenate([[True], ranges[1:, 0] > stops[:-1]])
+    run_starts = np.flatnonzero(new_run)
+    run_stops = np.concatenate([run_starts[1:], [len(ranges)]]) - 1
+    return np.stack([ranges[run_starts, 0], stops[run_stops]], axis=-1)
+
+
+class MOC():
+    '''
+        Multi-Order Coverage map: the covered sky as sorted, disjoint, half-open ranges of
+        nested HEALPix cells at order 29. A coverage is described by its number of ranges,
+        not its number of pixels, and set operations are linear merges of the range lists.
+
+        ranges: int64 array of [start, stop) cells at MAX_ORDER with shape (n_ranges, 2)
+    '''
+
+    def __init__(self, ranges: np.ndarray = None):
+        if ranges is None:
+            ranges = np.empty((0, 2), dtype=np.int64)
+        ranges = np.asarray(ranges, dtype=np.int64).reshape(-1, 2)
+        self.ranges = _merge(ranges[np.argsort(ranges[:, 0], kind="stable")])
+
+
+    def __len__(self) -> int:
+        return len(self.ranges)
+
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, MOC) and np.array_equal(self.ranges, other.ranges)
+
+
+    def __or__(self, other):
+        return self.union(other)
+
+
+    def __and__(self, other):
+        return self.intersection(other)
+
+
+    def __sub__(self, other):
+        return self.difference(other)
+
+
+    @staticmethod
+    def from_pixels(pixels: np.ndarray, order: int, nest: bool = True):
+        '''
+            pixels: healpix pixel indices at the order (nside = 2**order)
+        '''
+        pixels = np.asarray(pixels, dtype=np.int64)
+        if not nest:
+            pixels = hp.ring2nest(2**order, pixels)
+        shift = 2*(MAX_ORDER - order)
+        return MOC(coverage.pixels_to_ranges(pixels) << shift)
+
+
+    @staticmethod
+    def from_polygons(polygons: list, order: int, inclusive: bool = False, workers: int = None, nest: bool = True):
+        '''
+            the union of the polygons of (ra, dec) vertices, pixelized at the order (nside = 2**order).
+            nest=False pixelizes in RING ordering, healpy's inclusive pixelization differs slightly
+            between the two, so this matches a pixel mask of a RING skymap exactly
+        '''
+        shards = list(coverage.polygon_ranges(polygons, 2**order, nest=nest, inclusive=inclusive, workers=workers))
+        if not nest:
+            return MOC.from_pixels(coverage.ranges_to_pixels(np.concatenate(shards)), order, nest=False)
+        return MOC(np.concatenate(shards) << 2*(MAX_ORDER - order))
+
+
+    def _combine(self, other, keep) -> 'MOC':
+        a = _boundaries(self.ranges)
+        b = _boundaries(other.ranges)
+        edges = np.union1d(a, b)
+        if len(edges) < 2:
+            return MOC()
+        #every elementary interval between consecutive edges is either fully in or out of each operand
+        selected = keep(_contains(a, edges[:-1]), _contains(b, edges[:-1]))
+        return MOC(np.stack([edges[:-1][selected], edges[1:][selected]], axis=-1))
+
+
+    def union(self, other) -> 'MOC':
+        return self._combine(other, lambda in_a, in_b: in_a | in_b)
+
+
+    def intersection(self, other) -> 'MOC':
+        return self._combine(other, lambda in_a, in_b: in_a & in_b)
+
+
+    def difference(self, other) -> 'MOC':
+        return self._combine(other, lambda in_a, in_b: in_a & ~in_b)
+
+
+    def cells_below(self, positions: np.ndarray) -> np.ndarray:
+        '''
+            number of covered cells before each order 29 cell position
+        '''
+        positions = np.asarray(positions, dtype=np.int64)
+        cumulative = np.concatenate([[0], np.cumsum(self.ranges[:, 1] - self.ranges[:, 0])])
+        k = np.searchsorted(self.ranges[:, 0], positions, side="right")
+        #cells of the range a position falls inside that lie beyond it
+        overshoot = np.maximum(self.ranges[np.maximum(k - 1, 0), 1] - positions, 0) if len(self.ranges) else 0
+        return cumulative[k] - np.where(k > 0, overshoot, 0)
+
+
+    def n_cells(self) -> int:
+        return int(np.sum(self.ranges[:, 1] - self.ranges[:, 0]))
+
+
+    def area(self) -> float:
+        '''
+            exact covered area in deg^2
+        '''
+        return self.n_cells() * hp.nside2pixarea(2**MAX_ORDER, degrees=True)
+
+
+    def pixels(self, order: int, nest: bool = True) -> np.ndarray:
+        '''
+            the pixels at the order (nside = 2**order) that are at least partly covered
+        '''
+        shift = 2*(MAX_ORDER - order)
+        starts = self.ranges[:, 0] >> shift
+        stops = (self.ranges[:, 1] + (1 << shift) - 1) >> shift
+        pixels = np.unique(coverage.ranges_to_pixels(np.stack([starts, stops], axis=-1)))
+        if not nest:
+            pixels = hp.nest2ring(2**order, pixels)
+        return pixels
+
+
+    def probability(self, skymap: np.ndarray, nest: bool = False) -> float:
+        '''
+            summed probability of a flat skymap of any nside inside the coverage.
+            pixels that are partly covered contribute their covered fraction
+        '''
+        skymap = np.asarray(skymap)
+        nside = hp.npix2nside(len(skymap))
+        if not nest:
+            skymap = hp.reorder(skymap, r2n=True)
+        if len(self.ranges) == 0:
+            return 0.0
+
+        shift = 2*(MAX_ORDER - hp.nside2order(nside))
+        cumulative = np.concatenate([[0.0], np.cumsum(skymap, dtype=float)])
+
+        def integral(positions):
+            #probability in cells [0, position), with a uniform density inside each skymap pixel
+            pixel = positions >> shift
+            fraction = (positions - (pixel << shift)) / float(1 << shift)
+            return cumulative[pixel] + fraction * skymap[np.minimum(pixel, len(skymap) - 1)]
+
+        return float(np.sum(integral(self.ranges[:, 1]) - integral(self.ranges[:, 0])))
+
+
+    def to_payload(self) -> dict:
+        '''
+            the range boundaries delta encoded, which compress to a few bytes per range
+        '''
+        return {"moc_boundaries": np.diff(_boundaries(self.ranges), prepend=0)}
+
+
+    @staticmethod
+    def from_payload(payload: dict):
+        return MOC(np.cumsum(payload["moc_boundaries"]).reshape(-1, 2))
+
+
+    def to_bytes(self) -> bytes:
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **self.to_payload())
+        return buffer.getvalue()
+
+
+    @staticmethod
+    def from_bytes(data: bytes):
+        with np.load(io.BytesIO(data)) as payload:
+            return MOC.from_payload(payload)
@@ -0,0 +1,273 @@
+import numpy as np
+import healpy as hp
+from ligo.skymap import moc as ligo_moc
+from ligo.skymap.io import read_sky_map
+
+from .moc import MAX_ORDER, MOC
+
+#contours and plots of a multi-order skymap are traced on a flat grid of this resolution
+CONTOUR_NSIDE = 512
+
+#credible region kept by a SparseSkymap
+DEFAULT_SPARSE_CREDIBLE = 0.999
+
+#coarsest level of a skymap's resolution pyramid
+PYRAMID_MIN_NSIDE = 64
+
+
+def pyramid_nside(nside: int, resolution: int = None) -> int:
+    '''
+        the pyramid level to use for a flat skymap of nside: the coarsest level that is at
+        least as fine as the requested resolution (an nside). default = nside itself
+    '''
+    if resolution is None or resolution >= nside:
+        return nside
+    level = max(int(resolution), PYRAMID_MIN_NSIDE)
+    #round up to a power of two
+    return min(1 << (level - 1).bit_length(), nside)
+
+
+def greedy_sort(skymap: np.ndarray) -> np.ndarray:
+    '''
+        the pixels of a flat skymap from the most to the least probable, as int32 when npix allows
+    '''
+    dtype = np.int32 if len(skymap) < 2**31 else np.int64
+    return np.flipud(np.argsort(skymap)).astype(dtype)
+
+
+def greedy_credible_levels(skymap: np.ndarray, sort: np.ndarray = None) -> np.ndarray:
+    '''
+        the greedy credible level (0-1) of each pixel of a flat skymap, as find_greedy_credible_levels.
+        sort: the skymap's greedy_sort, if already known
+    '''
+    if sort is None:
+        sort = greedy_sort(skymap)
+    levels = np.empty(len(skymap))
+    levels[sort] = np.cumsum(skymap[sort])
+    return levels
+
+
+def skymap_pyramid(skymap: np.ndarray):
+    '''
+        yields (nside, skymap) for the probability preserving downgrades of a flat RING skymap,
+        halving nside down to PYRAMID_MIN_NSIDE. each level is summed from the one before it
+    '''
+    nside = hp.npix2nside(len(skymap))
+    level = hp.reorder(np.asarray(skymap, dtype=float), r2n=True)
+    while nside > PYRAMID_MIN_NSIDE:
+        nside //= 2
+        level = hp.ud_grade(level, nside, order_in="NESTED", order_out="NESTED", power=-2)
+        yield nside, hp.reorder(level, n2r=True)
+
+
+def _children(first: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    #concatenated aranges of every [first, first + count) run of child pixels
+    return np.repeat(first, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+
+class MultiOrderSkymap():
+    '''
+        A multi-order (NUNIQ) skymap: pixels of mixed HEALPix orders, each with a uniform
+        probability density. Coarse pixels cover the low probability sky, so the map is
+        far smaller than the flat map at its finest resolution. Coverage is measured
+        against it exactly with a MOC, and it is only flattened by rasterize.
+
+        uniq: int64 array of NUNIQ pixel indices
+        probdensity: float array of the probability density (1/sr) of each pixel
+        total: float - probability of the whole sky. default = the sum over the pixels
+    '''
+
+    def __init__(self, uniq: np.ndarray, probdensity: np.ndarray, total: float = None):
+        uniq = np.asarray(uniq, dtype=np.int64)
+        probdensity = np.asarray(probdensity, dtype=float)
+
+        order, ipix = ligo_moc.uniq2nest(uniq)
+        order = np.asarray(order, dtype=np.int64)
+        shift = 2*(MAX_ORDER - order)
+        starts = np.asarray(ipix, dtype=np.int64) << shift
+
+        #kept in sky order, so the pixels are consecutive disjoint ranges of order 29 cells
+        sort = np.argsort(starts, kind="stable")
+        self.uniq = uniq[sort]
+        self.probdensity = probdensity[sort]
+        self.order = order[sort]
+        self.starts = starts[sort]
+        self.stops = self.starts + (np.int64(1) << shift[sort])
+        self.total = float(np.sum(self.prob())) if total is None else float(total)
+
+
+    def __len__(self) -> int:
+        return len(self.uniq)
+
+
+    @staticmethod
+    def from_fits(path: str):
+        '''
+            read a multi-order or flat skymap fits file, flat maps are merged into multi-order pixels
+        '''
+        skymap = read_sky_map(path, moc=True)
+        return MultiOrderSkymap(uniq=np.asarray(skymap["UNIQ"]), probdensity=np.asarray(skymap["PROBDENSITY"]))
+
+
+    @staticmethod
+    def from_flat(skymap: np.ndarray, nest: bool = False):
+        '''
+            the flat probability map as a single order multi-order skymap
+        '''
+        skymap = np.asarray(skymap, dtype=float)
+        nside = hp.npix2nside(len(skymap))
+        if not nest:
+            skymap = hp.reorder(skymap, r2n=True)
+        order = hp.nside2order(nside)
+        uniq = ligo_moc.nest2uniq(np.int8(order), np.arange(len(skymap), dtype=np.int64))
+        return MultiOrderSkymap(uniq=uniq, probdensity=skymap / hp.nside2pixarea(nside))
+
+
+    @property
+    def max_order(self) -> int:
+        return int(self.order.max())
+
+
+    @property
+    def nside(self) -> int:
+        '''
+            nside of the finest pixels
+        '''
+        return 2**self.max_order
+
+
+    def pixel_area(self) -> np.ndarray:
+        '''
+            area of each pixel in sr
+        '''
+        return 4*np.pi / (12 * 4.0**self.order)
+
+
+    def prob(self) -> np.ndarray:
+        '''
+            probability in each pixel
+        '''
+        return self.probdensity * self.pixel_area()
+
+
+    def covered_fraction(self, moc: MOC) -> np.ndarray:
+        '''
+            fraction of each pixel's area inside the MOC
+        '''
+        covered = moc.cells_below(self.stops) - moc.cells_below(self.starts)
+        return covered / (self.stops - self.starts).astype(float)
+
+
+    def probability(self, moc: MOC) -> float:
+        '''
+            exact probability inside the MOC, pixels partly inside contribute their covered fraction
+        '''
+        return float(np.sum(self.prob() * self.covered_fraction(moc)))
+
+
+    def renormalized(self, moc: MOC, order: int = None):
+        '''
+            the skymap with the MOC's cells set to zero, renormalized to 1. pixels coarser than
+            order (default = the finest order of the skymap) that the MOC partly covers are split
+            into their children at that order, and the children inside the MOC are removed
+        '''
+        if order is None:
+            order = self.max_order
+
+        fraction = self.covered_fraction(moc)
+        split = (fraction > 0) & (fraction < 1) & (self.order < order)
+        keep = (fraction < 1) & ~split
+
+        shift = 2*(MAX_ORDER - order)
+        n_children = 4**(order - self.order[split])
+        child_ipix = _children(self.starts[split] >> shift, n_children)
+        child_density = np.repeat(self.probdensity[split], n_children)
+        child_starts = child_ipix << shift
+        child_keep = moc.cells_below(child_starts + (1 << shift)) - moc.cells_below(child_starts) < (1 << shift)
+
+        uniq = np.concatenate([self.uniq[keep], ligo_moc.nest2uniq(np.int8(order), child_ipix[child_keep])])
+        probdensity = np.concatenate([self.probdensity[keep], child_density[child_keep]])
+        remaining = self.total - self.probability(moc)
+        return type(self)(uniq=uniq, probdensity=probdensity / remaining, total=1.0)
+
+
+    def credible_levels(self) -> np.ndarray:
+        '''
+            the credible level (0-1) of each pixel, filling the densest pixels first
+        '''
+        sort = np.argsort(self.probdensity, kind="stable")[::-1]
+        levels = np.empty(len(self))
+        levels[sort] = np.cumsum(self.prob()[sort])
+        return levels
+
+
+    def rasterize(self, nside: int = None, nest: bool = False, values: np.ndarray = None) -> np.ndarray:
+        '''
+            flatten to a HEALPix map at nside (default = the finest order's).
+            default values are the probability of each flat pixel. pass per pixel values
+            (e.g. credible_levels()) to paint them instead, a flat pixel holding several
+            finer pixels then takes their smallest value.
+        '''
+        if nside is None:
+            nside = self.nside
+        order = hp.nside2order(nside)
+        npix = hp.nside2npix(nside)
+        shift = 2*(MAX_ORDER - order)
+
+        first = self.starts >> shift
+        coarse = self.order <= order
+        n_children = 4**(order - self.order[coarse])
+        flat_ipix = _children(first[coarse], n_children)
+
+        if values is None:
+            flat = np.zeros(npix)
+            flat[flat_ipix] = np.repeat(self.probdensity[coarse], n_children) * hp.nside2pixarea(nside)
+            np.add.at(flat, first[~coarse], self.prob()[~coarse])
+        else:
+            flat = np.full(npix, np.inf)
+            flat[flat_ipix] = np.repeat(np.asarray(values)[coarse], n_children)
+            np.minimum.at(flat, first[~coarse], np.asarray(values)[~coarse])
+
+        if not nest:
+            flat = hp.reorder(flat, n2r=True)
+        return flat
+
+
+    def to_payload(self) -> dict:
+        return {"uniq": self.uniq, "probdensity": self.probdensity, "total": np.asarray([self.total])}
+
+
+    @classmethod
+    def from_payload(cls, payload: dict):
+        total = payload["total"][0] if "total" in payload else None
+        return cls(uniq=payload["uniq"], probdensity=payload["probdensity"], total=total)
+
+
+class SparseSkymap(MultiOrderSkymap):
+    '''
+        The pixels of a flat skymap inside its top credible region, at the flat map's order.
+        The rest of the sky is dropped, so sums and coverage checks run over the region's
+        pixels only, while total keeps the probability of the whole map so the covered
+        probability and renormalization match the flat map's.
+    '''
+
+    @staticmethod
+    def from_flat(skymap: np.ndarray, credible: float = DEFAULT_SPARSE_CREDIBLE, nest: bool = False):
+        '''
+            skymap: flat probability map
+            credible: float - keep the smallest set of pixels holding this fraction of the probability
+        '''
+        skymap = np.asarray(skymap)
+        nside = hp.npix2nside(len(skymap))
+        total = float(np.sum(skymap, dtype=float))
+
+        sort = np.argsort(skymap, kind="stable")[::-1]
+        cumulative = np.cumsum(skymap[sort], dtype=float)
+        n_pixels = min(int(np.searchsorted(cumulative, credible * total, side="left")) + 1, len(skymap))
+        ipix = sort[:n_pixels]
+        prob = skymap[ipix].astype(float)
+        if not nest:
+            ipix = hp.ring2nest(nside, ipix)
+
+        uniq = ligo_moc.nest2uniq(np.int8(hp.nside2order(nside)), ipix.astype(np.int64))
+        return SparseSkymap(uniq=uniq, probdensity=prob / hp.nside2pixarea(nside), total=total)
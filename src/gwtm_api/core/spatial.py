@@ -0,0 +1,114 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, List
+import numpy as np
+import healpy as hp
+
+from . import util
+
+if TYPE_CHECKING:
+    from ..pointing import Pointing
+
+#~1.8 deg buckets, small next to typical fields of view and search radii
+DEFAULT_INDEX_NSIDE = 32
+
+
+class PointingIndex():
+    '''
+        In-memory spatial index of pointing centers, built once from a list of pointings.
+        The centers are bucketed by their nested HEALPix pixel, so a query only visits
+        the buckets that overlap it, then filters their pointings exactly.
+
+        pointings: List[Pointing] - the pointings to index
+        nside: int - resolution of the buckets
+    '''
+
+    def __init__(self, pointings: List[Pointing], nside: int = DEFAULT_INDEX_NSIDE):
+        self.pointings = list(pointings)
+        self.nside = nside
+
+        self.ra = np.asarray([x.ra for x in self.pointings], dtype=float)
+        self.dec = np.asarray([x.dec for x in self.pointings], dtype=float)
+        self.uvecs = np.stack(util.ra_dec_to_uvec(self.ra, self.dec), axis=-1).reshape(-1, 3)
+
+        pixels = hp.ang2pix(nside, self.ra, self.dec, lonlat=True, nest=True)
+        self._order = np.argsort(pixels, kind="stable")
+        self._sorted_pixels = pixels[self._order]
+
+
+    def __len__(self) -> int:
+        return len(self.pointings)
+
+
+    def _bucket_indices(self, pixels: np.ndarray) -> np.ndarray:
+        starts = np.searchsorted(self._sorted_pixels, pixels, side="left")
+        stops = np.searchsorted(self._sorted_pixels, pixels, side="right")
+        lengths = stops - starts
+        #concatenated aranges of every [start, stop) bucket slice
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return self._order[positions]
+
+
+    def cone_search_indices(self, ra: float, dec: float, radius: float) -> np.ndarray:
+        '''
+            indices of the pointings centered within radius (deg) of (ra, dec), in index order
+        '''
+        if len(self) == 0:
+            return np.empty(0, dtype=np.int64)
+        vec = np.asarray(util.ra_dec_to_uvec(ra, dec))
+        pixels = hp.query_disc(self.nside, vec, np.deg2rad(radius), inclusive=True, nest=True)
+        candidates = self._bucket_indices(pixels)
+        inside = self.uvecs[candidates] @ vec > np.cos(np.deg2rad(radius))
+        return np.sort(candidates[inside])
+
+
+    def cone_search(self, ra: float, dec: float, radius: float) -> List[Pointing]:
+        '''
+            pointings centered within radius (deg) of (ra, dec)
+        '''
+        return [self.pointings[i] for i in self.cone_search_indices(ra, dec, radius)]
+
+
+    def polygon_search_indices(self, polygon) -> np.ndarray:
+        '''
+            indices of the pointings centered inside the convex polygon of (ra, dec) vertices, in index order
+        '''
+        if len(self) == 0:
+            return np.empty(0, dtype=np.int64)
+        pixels = hp.query_polygon(self.nside, util.polygon_to_uvecs(polygon), inclusive=True, nest=True)
+        candidates = self._bucket_indices(pixels)
+        inside = util.points_in_polygons(self.ra[candidates], self.dec[candidates], [polygon])[:, 0]
+        return np.sort(candidates[inside])
+
+
+    def polygon_search(self, polygon) -> List[Pointing]:
+        '''
+            pointings centered inside the convex polygon of (ra, dec) vertices
+        '''
+        return [self.pointings[i] for i in self.polygon_search_indices(polygon)]
+
+
+    def nearest_indices(self, ra: float, dec: float, k: int = 1) -> np.ndarray:
+        '''
+            indices of the k pointings centered closest to (ra, dec), nearest first
+        '''
+        k = min(k, len(self))
+        if k == 0:
+            return np.empty(0, dtype=np.int64)
+
+        #grow the search cone until it holds k pointings, at which point no closer pointing can lie outside it
+        radius = np.rad2deg(hp.nside2resol(self.nside))
+        while True:
+            candidates = self.cone_search_indices(ra, dec, radius) if radius < 180 else np.arange(len(self))
+            if len(candidates) >= k:
+                break
+            radius *= 2
+
+        distances = util.gc_dist(self.ra[candidates], self.dec[candidates], ra, dec)
+        return candidates[np.argsort(distances, kind="stable")[:k]]
+
+
+    def nearest(self, ra: float, dec: float, k: int = 1) -> List[Pointing]:
+        '''
+            the k pointings centered closest to (ra, dec), nearest first
+        '''
+        return [self.pointings[i] for i in self.nearest_indices(ra, dec, k)]
@@ -1,79 +1,1285 @@
 import os
+import contextlib
+import io
 import json
+import socket
+import sqlite3
+import tempfile
+from collections import OrderedDict
+import threading
+import time
+import uuid
+import numpy as np
 import healpy as hp
 from pathlib import Path
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 CACHE_TYPES = [
     "json",
-    "fits"
+    "fits",
+    "npz",
+    "npy"
 ]
 
-class TMCache():
+EVICTION_POLICIES = [
+    "lru",
+    "lfu"
+]
 
-    def __init__(self, filename: str=None, cache_type=None):
-        if cache_type not in CACHE_TYPES:
-            raise ValueError(f"Invalid Cache Type: {cache_type}")
+#byte budget of the cache directory, can be set with the GWTM_CACHE_MAX_BYTES environment variable
+DEFAULT_MAX_BYTES = 10 * 2**30
+INDEX_FILENAME = ".tmcache_index.json"
+#reads append to this log instead of rewriting the index, it is folded into the index by writes
+#and, once it grows past ACCESS_LOG_MAX_BYTES, by the read that grew it
+ACCESS_LOG_FILENAME = ".tmcache_access.log"
+ACCESS_LOG_MAX_BYTES = 2**20
+LOCK_DIRECTORY = ".locks"
+META_SUFFIX = ".meta"
+#database of the sqlite store, in the cache directory
+SQLITE_FILENAME = "tmcache.sqlite"
+SQLITE_TIMEOUT = 60
+#a key's lock row is taken over when its process has died, or after this long (seconds)
+SQLITE_LOCK_EXPIRY = 3600
+SQLITE_LOCK_POLL = 0.05
+#arrays and fits larger than this are kept as files next to the database instead of as blobs,
+#a blob is built in memory and sqlite rejects blobs over its length limit (1e9 bytes by default)
+SQLITE_INLINE_MAX_BYTES = 64 * 2**20
 
-        self.cache_home = os.path.join(f"{Path.home()}", ".tmcache")
-        self._set_cache_home()
-        self.cache_path = os.path.join(self.cache_home, filename)
-        self.cache_type = cache_type
+#in-process memory tier in front of the directory, GWTM_CACHE_MEMORY_BYTES sets its byte budget
+DEFAULT_MEMORY_MAX_BYTES = 512 * 2**20
+DEFAULT_MEMORY_MAX_ENTRIES = 256
+#hits served from memory are written to the index at most this often per entry (seconds)
+MEMORY_TOUCH_INTERVAL = 60
 
-        self.get_dict = {
-            "json" : self._get_cached_json,
-            "fits" : self._get_cached_fits
-        }
+_config = {
+    "max_bytes": int(os.getenv("GWTM_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)),
+    "policy": "lru",
+    "store": os.getenv("GWTM_CACHE_STORE", "directory")
+}
+_stores = {}
+_stores_lock = threading.Lock()
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+_held_locks = threading.local()
 
-        self.put_dict = {
-            "json" : self._put_cached_json,
-            "fits" : self._put_cached_fits
-        }
 
+def _cache_home() -> str:
+    return os.path.join(f"{Path.home()}", ".tmcache")
 
-    def get(self, **kwargs):
-        if os.path.exists(self.cache_path):
-            return self.get_dict[self.cache_type](**kwargs)
+
+@contextlib.contextmanager
+def _key_lock(key, process_lock):
+    '''
+        exclusive lock on key between threads, and between processes with the process_lock
+        context manager. re-entrant within a thread
+    '''
+    held = getattr(_held_locks, "keys", None)
+    if held is None:
+        held = _held_locks.keys = set()
+    if key in held:
+        yield
+        return
+
+    #[lock, number of threads holding or waiting for it], dropped when the last one releases it
+    with _thread_locks_guard:
+        entry = _thread_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+
+    try:
+        with entry[0]:
+            held.add(key)
+            try:
+                with process_lock():
+                    yield
+            finally:
+                held.discard(key)
+    finally:
+        with _thread_locks_guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _thread_locks[key]
+
+
+@contextlib.contextmanager
+def _flock(path: str):
+    '''
+        exclusive fcntl lock on the file at path, which only exists while the lock is held:
+        it is removed before it is unlocked, and a waiter that then gets the lock on the
+        removed file opens the path again
+    '''
+    if fcntl is None:
+        #no cross-process locks on platforms without fcntl, writes are still atomic
+        yield
+        return
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        except BaseException:
+            os.close(fd)
+            raise
+        os.close(fd)
+
+    try:
+        yield
+    finally:
+        os.remove(path)
+        os.close(fd)
+
+
+def _file_lock(path: str):
+    '''
+        exclusive lock on path between threads and, with fcntl, between processes.
+        re-entrant within a thread
+    '''
+    return _key_lock(path, lambda: _flock(path))
+
+
+def _index_lock():
+    return _file_lock(os.path.join(_cache_home(), LOCK_DIRECTORY, f"{INDEX_FILENAME}.lock"))
+
+
+@contextlib.contextmanager
+def _atomic_path(path: str):
+    '''
+        yields a temporary path next to path, renamed over it once the block completes,
+        so readers only ever see a complete file
+    '''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _file_stamp(path: str):
+    #changes whenever the file is replaced or rewritten, by this process or another
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def _payload_nbytes(payload, stored_size: int) -> int:
+    #memory-mapped arrays live in the page cache, not in the process
+    if isinstance(payload, np.memmap):
+        return 0
+    if isinstance(payload, np.ndarray):
+        return payload.nbytes
+    if isinstance(payload, dict) and all(isinstance(x, np.ndarray) for x in payload.values()):
+        return sum(_payload_nbytes(x, stored_size) for x in payload.values())
+    #parsed json, estimated from its stored size
+    return stored_size
+
+
+def _read_only(payload):
+    #payloads held in memory are shared by every caller
+    if isinstance(payload, np.ndarray):
+        payload.flags.writeable = False
+    elif isinstance(payload, dict):
+        for value in payload.values():
+            if isinstance(value, np.ndarray):
+                value.flags.writeable = False
+    return payload
+
+
+class _MemoryTier():
+    '''
+        Least recently used payloads read from the cache directory, bounded by their total
+        size and their number. Each one is kept with the stamp of the file it was read from,
+        and is only served while the file on disk still has that stamp, so entries rewritten
+        or evicted by other processes are never served stale.
+    '''
+
+    def __init__(self, max_bytes: int, max_entries: int):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+
+    def get(self, path: str, stamp):
+        with self._lock:
+            entry = self.entries.get(path)
+            if entry is None or entry["stamp"] != stamp:
+                if entry is not None:
+                    self._remove(path)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(path)
+            self.hits += 1
+            return entry["payload"]
+
+
+    def put(self, path: str, stamp, payload, nbytes: int):
+        with self._lock:
+            if path in self.entries:
+                self._remove(path)
+            if self.max_entries <= 0 or nbytes > self.max_bytes:
+                return
+            self.entries[path] = {"stamp": stamp, "payload": payload, "nbytes": nbytes, "touched": time.time()}
+            self.nbytes += nbytes
+            while len(self.entries) > self.max_entries or self.nbytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+
+    def touch(self, path: str) -> bool:
+        '''
+            True when the entry's last access should be written through to the index
+        '''
+        with self._lock:
+            entry = self.entries.get(path)
+            if entry is None or time.time() - entry["touched"] < MEMORY_TOUCH_INTERVAL:
+                return False
+            entry["touched"] = time.time()
+            return True
+
+
+    def discard(self, path: str):
+        with self._lock:
+            if path in self.entries:
+                self._remove(path)
+
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.nbytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+    def _remove(self, path: str):
+        self.nbytes -= self.entries.pop(path)["nbytes"]
+
+
+_memory = _MemoryTier(
+    max_bytes=int(os.getenv("GWTM_CACHE_MEMORY_BYTES", DEFAULT_MEMORY_MAX_BYTES)),
+    max_entries=DEFAULT_MEMORY_MAX_ENTRIES
+)
+
+
+def _log_access(cache_home: str, filename: str, hit: bool) -> int:
+    '''
+        append a hit on filename (or a miss) to the access log, without taking the index lock.
+        a single short O_APPEND write, so lines from concurrent processes don't interleave.
+        returns the size of the log
+    '''
+    line = json.dumps([filename if hit else None, time.time()]) + "\n"
+    fd = os.open(os.path.join(cache_home, ACCESS_LOG_FILENAME), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode("utf-8"))
+        return os.fstat(fd).st_size
+    finally:
+        os.close(fd)
+
+
+def _entry_files(filename: str) -> list:
+    #an npy entry is the array and its json header, any entry can have a metadata file
+    files = [filename]
+    if filename.endswith(".npy"):
+        files.append(f"{filename}.json")
+    files.append(f"{filename}{META_SUFFIX}")
+    return files
+
+
+class _CacheIndex():
+    '''
+        Size, last access, hit count and pins of the entries in the cache directory,
+        kept in a json file next to them. Entries written by older versions (or removed
+        by hand) are picked up (or dropped) when the index is reconciled with the directory.
+    '''
+
+    def __init__(self, cache_home: str):
+        self.cache_home = cache_home
+        self.path = os.path.join(cache_home, INDEX_FILENAME)
+        self.entries = {}
+        self.pinned = []
+        self.misses = 0
+
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as input_file:
+                    index = json.load(input_file)
+                self.entries = index["entries"]
+                self.pinned = index["pinned"]
+                self.misses = index["misses"]
+            except:  # noqa: E722
+                #a corrupt index is rebuilt from the directory
+                self.entries = {}
+                self.reconcile()
+        else:
+            self.reconcile()
+        self.apply_access_log()
+
+
+    def save(self):
+        with _atomic_path(self.path) as tmp_path:
+            with open(tmp_path, "w") as output_file:
+                json.dump({"entries": self.entries, "pinned": self.pinned, "misses": self.misses}, output_file)
+
+
+    def size(self, filename: str) -> int:
+        return sum(
+            os.path.getsize(os.path.join(self.cache_home, x))
+            for x in _entry_files(filename) if os.path.exists(os.path.join(self.cache_home, x))
+        )
+
+
+    def record(self, filename: str, hit: bool = False):
+        entry = self.entries.setdefault(filename, {"hits": 0})
+        entry["size"] = self.size(filename)
+        entry["last_access"] = time.time()
+        if hit:
+            entry["hits"] += 1
+
+
+    def apply_access_log(self):
+        '''
+            fold the hits and misses logged since the last fold into the index. only called under
+            the index lock, and the log is moved aside first, so reads logged meanwhile start a new one
+        '''
+        log_path = os.path.join(self.cache_home, ACCESS_LOG_FILENAME)
+        folding_path = f"{log_path}.{os.getpid()}.tmp"
+        try:
+            os.replace(log_path, folding_path)
+        except FileNotFoundError:
+            return
+
+        try:
+            with open(folding_path, "r") as input_file:
+                for line in input_file:
+                    try:
+                        filename, when = json.loads(line)
+                    except ValueError:
+                        #a line cut short by a crash
+                        continue
+                    if filename is None:
+                        self.misses += 1
+                    elif filename in self.entries:
+                        entry = self.entries[filename]
+                        entry["hits"] += 1
+                        entry["last_access"] = max(entry["last_access"], when)
+        finally:
+            os.remove(folding_path)
+
+
+    def reconcile(self):
+        names = set(os.listdir(self.cache_home))
+        for filename in [x for x in self.entries if x not in names]:
+            del self.entries[filename]
+
+        for filename in names:
+            is_header = filename.endswith(".npy.json") and filename[:-len(".json")] in names
+            is_header |= filename.endswith(META_SUFFIX) and filename[:-len(META_SUFFIX)] in names
+            is_scratch = filename.endswith(".tmp") or filename.endswith(".part")
+            is_database = filename.startswith(SQLITE_FILENAME)
+            if filename in [INDEX_FILENAME, ACCESS_LOG_FILENAME] or is_scratch or is_header or is_database or \
+                not os.path.isfile(os.path.join(self.cache_home, filename)):
+                continue
+            if filename not in self.entries:
+                self.entries[filename] = {
+                    "hits": 0,
+                    "size": self.size(filename),
+                    "last_access": os.path.getmtime(os.path.join(self.cache_home, filename))
+                }
+
+
+    def is_pinned(self, filename: str) -> bool:
+        return any(key in filename for key in self.pinned)
+
+
+    def total_bytes(self) -> int:
+        return sum(x["size"] for x in self.entries.values())
+
+
+    def evict(self, max_bytes: int, policy: str, keep: str = None) -> list:
+        '''
+            remove unpinned entries, least recently (lru) or least frequently (lfu) used first,
+            until the entries fit in max_bytes. returns the removed filenames
+        '''
+        if policy == "lfu":
+            rank = lambda x: (self.entries[x]["hits"], self.entries[x]["last_access"])  # noqa: E731
         else:
+            rank = lambda x: self.entries[x]["last_access"]  # noqa: E731
+
+        total = self.total_bytes()
+        evicted = []
+        for filename in sorted(self.entries, key=rank):
+            if total <= max_bytes:
+                break
+            if filename == keep or self.is_pinned(filename):
+                continue
+            for x in _entry_files(filename):
+                if os.path.exists(os.path.join(self.cache_home, x)):
+                    os.remove(os.path.join(self.cache_home, x))
+            _memory.discard(os.path.join(self.cache_home, filename))
+            total -= self.entries.pop(filename)["size"]
+            evicted.append(filename)
+        return evicted
+
+
+
+
+class DirectoryStore():
+    '''
+        The default TMCache backend: one file per entry in the cache directory, and the size,
+        last access and hit count of every entry in a json index next to them. Reads only append
+        to an access log, which is folded into the index under its lock.
+
+        A backend (see SQLiteStore) has a location and the methods stamp, size, read, write,
+        get_meta, put_meta, record_access, lock, entries, stats, prune, pin and unpin, keyed by
+        filename. stamp must change whenever an entry is rewritten, the memory tier relies on it.
+    '''
+    name = "directory"
+
+    def __init__(self, cache_home: str):
+        self.cache_home = cache_home
+        self.location = cache_home
+        self.read_dict = {
+            "json" : self._read_json,
+            "fits" : self._read_fits,
+            "npz" : self._read_npz,
+            "npy" : self._read_npy
+        }
+        self.write_dict = {
+            "json" : self._write_json,
+            "fits" : self._write_fits,
+            "npz" : self._write_npz,
+            "npy" : self._write_npy
+        }
+
+
+    def path(self, filename: str) -> str:
+        return os.path.join(self.cache_home, filename)
+
+
+    def stamp(self, filename: str):
+        return _file_stamp(self.path(filename))
+
+
+    def size(self, filename: str) -> int:
+        return os.path.getsize(self.path(filename))
+
+
+    def read(self, filename: str, cache_type: str, **kwargs):
+        return self.read_dict[cache_type](self.path(filename), **kwargs)
+
+
+    def write(self, filename: str, cache_type: str, payload, graceid: str = None, **kwargs):
+        self.write_dict[cache_type](self.path(filename), payload=payload, **kwargs)
+
+        with _index_lock():
+            index = _CacheIndex(self.cache_home)
+            index.record(filename)
+            if index.total_bytes() > _config["max_bytes"]:
+                index.reconcile()
+                index.evict(_config["max_bytes"], _config["policy"], keep=filename)
+            index.save()
+
+
+    def lock(self, filename: str):
+        '''
+            context manager holding the entry's lock, through a lock file that only exists while it is held
+        '''
+        return _file_lock(os.path.join(self.cache_home, LOCK_DIRECTORY, f"{filename}.lock"))
+
+
+    def get_meta(self, filename: str) -> dict:
+        try:
+            with open(self.path(filename) + META_SUFFIX, "r") as input_file:
+                return json.load(input_file)
+        except FileNotFoundError:
             return None
+        except:  # noqa: E722
+            raise Exception("Error reading cache metadata")
 
 
-    def put(self, payload, overwrite=False, **kwargs):
-        if not os.path.exists(self.cache_path) or overwrite:
-            self.put_dict[self.cache_type](payload=payload, **kwargs)
+    def put_meta(self, filename: str, meta: dict):
+        try:
+            with _atomic_path(self.path(filename) + META_SUFFIX) as tmp_path:
+                with open(tmp_path, "w") as output_file:
+                    json.dump(meta, output_file)
+        except:  # noqa: E722
+            raise Exception("Error in writing cache metadata")
 
 
-    def _set_cache_home(self):
-        if not os.path.exists(self.cache_home):
-            os.makedirs(self.cache_home)
+    def record_access(self, filename: str, hit: bool):
+        #logged, so a read costs one small append however large the index is
+        if _log_access(self.cache_home, filename, hit) > ACCESS_LOG_MAX_BYTES:
+            with _index_lock():
+                _CacheIndex(self.cache_home).save()
+
+
+    def entries(self, graceid: str = None, kind: str = None) -> list:
+        '''
+            the entries, optionally only those whose filename contains graceid and/or ends in
+            the kind (cache type), most recently used first
+        '''
+        return self._entries(graceid, kind)[0]
+
+
+    def stats(self) -> dict:
+        files, index = self._entries()
+        return {
+            "entries": len(files),
+            "bytes": index.total_bytes(),
+            "hits": sum(x["hits"] for x in files),
+            "misses": index.misses,
+            "pinned": list(index.pinned),
+            "files": files
+        }
+
+
+    def _entries(self, graceid: str = None, kind: str = None):
+        with _index_lock():
+            index = _CacheIndex(self.cache_home)
+            index.reconcile()
+            index.save()
+
+        files = [
+            {"filename": filename, **entry, "pinned": index.is_pinned(filename)}
+            for filename, entry in index.entries.items()
+            if (graceid is None or graceid in filename) and (kind is None or filename.endswith(f".{kind}"))
+        ]
+        files.sort(key=lambda x: x["last_access"], reverse=True)
+        return files, index
+
+
+    def prune(self, max_bytes: int, policy: str) -> list:
+        with _index_lock():
+            index = _CacheIndex(self.cache_home)
+            index.reconcile()
+            evicted = index.evict(max_bytes, policy)
+            index.save()
+        return evicted
+
+
+    def pin(self, key: str):
+        with _index_lock():
+            index = _CacheIndex(self.cache_home)
+            if key not in index.pinned:
+                index.pinned.append(key)
+            index.save()
+
+
+    def unpin(self, key: str):
+        with _index_lock():
+            index = _CacheIndex(self.cache_home)
+            index.pinned = [x for x in index.pinned if x != key]
+            index.save()
 
 
-    def _get_cached_json(self, **kwargs):
+    def _read_json(self, path, **kwargs):
         try:
-            with open(self.cache_path, "r") as input_file:
+            with open(path, "r") as input_file:
                 payload = json.load(input_file)
             return payload
         except:  # noqa: E722
             raise Exception("Error reading json cache")
 
 
-    def _get_cached_fits(self, **kwargs):
+    def _read_fits(self, path, **kwargs):
         try:
-            skymap = hp.read_map(self.cache_path)
+            skymap = hp.read_map(path)
             return skymap
         except:  # noqa: E722
             raise Exception("Error in reading cached fits file")
 
 
-    def _put_cached_json(self, payload, **kwargs):
+    def _write_json(self, path, payload, **kwargs):
         try:
-            with open(self.cache_path, "w") as output_file:
-                json.dump(payload, output_file)
+            with _atomic_path(path) as tmp_path:
+                with open(tmp_path, "w") as output_file:
+                    json.dump(payload, output_file)
         except:  # noqa: E722
             raise Exception("Error in writing payload cache to json")
 
-    
-    def _put_cached_fits(self, payload, **kwargs):
+
+    def _write_fits(self, path, payload, **kwargs):
         try:
-            hp.write_map(self.cache_path, payload, **kwargs)
+            with _atomic_path(path) as tmp_path:
+                hp.write_map(tmp_path, payload, overwrite=True, **kwargs)
         except:  # noqa: E722
             raise Exception("Error in writing skymap cache")
+
+
+    def _read_npz(self, path, **kwargs):
+        try:
+            with np.load(path) as payload:
+                return {key: payload[key] for key in payload.files}
+        except:  # noqa: E722
+            raise Exception("Error in reading cached npz file")
+
+
+    def _write_npz(self, path, payload, **kwargs):
+        try:
+            #write through a file handle, np.savez would append .npz to the cache path
+            with _atomic_path(path) as tmp_path:
+                with open(tmp_path, "wb") as output_file:
+                    np.savez_compressed(output_file, **payload)
+        except:  # noqa: E722
+            raise Exception("Error in writing npz cache")
+
+
+    def _read_npy(self, path, **kwargs):
+        #the header is written last, a map without one was never completely written
+        header_path = f"{path}.json"
+        if not os.path.exists(header_path):
+            return None
+        try:
+            with open(header_path, "r") as input_file:
+                header = json.load(input_file)
+            skymap = np.load(path, mmap_mode="r")
+        except:  # noqa: E722
+            raise Exception("Error in reading cached npy skymap")
+
+        if skymap.dtype != np.dtype(header["dtype"]) or len(skymap) != hp.nside2npix(header["nside"]):
+            raise Exception(f"Error in reading cached npy skymap, it does not match its header: {header}")
+        return skymap
+
+
+    def _write_npy(self, path, payload, ordering="RING", **kwargs):
+        try:
+            skymap = np.asarray(payload)
+            with _atomic_path(path) as tmp_path:
+                with open(tmp_path, "wb") as output_file:
+                    np.save(output_file, skymap)
+            with _atomic_path(f"{path}.json") as tmp_path:
+                with open(tmp_path, "w") as output_file:
+                    json.dump({
+                        "nside": hp.npix2nside(len(skymap)),
+                        "ordering": ordering,
+                        "dtype": skymap.dtype.str
+                    }, output_file)
+        except:  # noqa: E722
+            raise Exception("Error in writing npy skymap cache")
+
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    filename TEXT PRIMARY KEY,
+    graceid TEXT,
+    kind TEXT NOT NULL,
+    json TEXT,
+    blob BLOB,
+    file TEXT,
+    meta TEXT,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_access REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+CREATE INDEX IF NOT EXISTS entries_hits ON entries (hits, last_access);
+CREATE INDEX IF NOT EXISTS entries_graceid ON entries (graceid, kind);
+CREATE INDEX IF NOT EXISTS entries_kind ON entries (kind);
+CREATE TABLE IF NOT EXISTS pins (key TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS locks (filename TEXT PRIMARY KEY, owner TEXT NOT NULL, acquired REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+INSERT OR IGNORE INTO counters VALUES ('bytes', 0), ('hits', 0), ('misses', 0);
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+    UPDATE counters SET value = value + NEW.size WHERE name = 'bytes';
+END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+    UPDATE counters SET value = value - OLD.size WHERE name = 'bytes';
+END;
+CREATE TRIGGER IF NOT EXISTS entries_resize AFTER UPDATE OF size ON entries BEGIN
+    UPDATE counters SET value = value + NEW.size - OLD.size WHERE name = 'bytes';
+END;
+"""
+
+_SQLITE_ENTRY_COLUMNS = "filename, graceid, kind, size, created, last_access, hits"
+
+
+class SQLiteStore():
+    '''
+        TMCache backend keeping every entry as a row of one SQLite database: json payloads as
+        text, arrays and fits as binary blobs, with the graceid, kind (cache type), size,
+        creation and last access time and hit count as indexed columns. Lookups, eviction and
+        stats are queries, with no directory scans, and the running total of the entries'
+        size is kept by triggers. The database is in WAL mode, so many processes can share it,
+        and the lock of an entry is a row of its locks table, so no lock files are created.
+
+        Arrays and fits larger than SQLITE_INLINE_MAX_BYTES, e.g. high resolution skymaps, are
+        kept as files in a directory next to the database, with only their row in it, and npy
+        ones are memory-mapped on a read. Smaller arrays are decoded from their blob into memory.
+
+        path: str - the database file
+    '''
+    name = "sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        self.location = path
+        self._local = threading.local()
+        #the writers and readers of the entries kept as files
+        self._files = DirectoryStore(f"{path}.files")
+
+        #created in one transaction, processes opening a new database at once wait on each other
+        self._connection().executescript(f"BEGIN IMMEDIATE; {_SQLITE_SCHEMA} COMMIT;")
+        with self._transaction() as connection:
+            #databases created before large entries were kept as files
+            if "file" not in [x[1] for x in connection.execute("PRAGMA table_info(entries)")]:
+                connection.execute("ALTER TABLE entries ADD COLUMN file TEXT")
+
+
+    def _connection(self) -> sqlite3.Connection:
+        #one connection per thread, opened again in a forked process
+        if getattr(self._local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+
+    def stamp(self, filename: str):
+        return self._connection().execute(
+            "SELECT created, size FROM entries WHERE filename = ?", (filename,)
+        ).fetchone()
+
+
+    def size(self, filename: str) -> int:
+        row = self._connection().execute("SELECT size FROM entries WHERE filename = ?", (filename,)).fetchone()
+        return row[0] if row is not None else 0
+
+
+    def read(self, filename: str, cache_type: str, **kwargs):
+        row = self._connection().execute(
+            "SELECT json, blob, file FROM entries WHERE filename = ?", (filename,)
+        ).fetchone()
+        if row is None:
+            return None
+        text, blob, file = row
+        if file is not None:
+            return self._files.read(file, cache_type, **kwargs)
+        try:
+            if cache_type == "json":
+                return json.loads(text)
+            if cache_type == "npy":
+                return np.load(io.BytesIO(blob))
+            if cache_type == "npz":
+                with np.load(io.BytesIO(blob)) as payload:
+                    return {key: payload[key] for key in payload.files}
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                fits_path = os.path.join(tmp_dir, filename)
+                with open(fits_path, "wb") as output_file:
+                    output_file.write(blob)
+                return hp.read_map(fits_path)
+        except:  # noqa: E722
+            raise Exception(f"Error in reading cached {cache_type} entry {filename}")
+
+
+    def write(self, filename: str, cache_type: str, payload, graceid: str = None, **kwargs):
+        text, blob, file = None, None, None
+        if cache_type != "json" and self._payload_bytes(cache_type, payload) > SQLITE_INLINE_MAX_BYTES:
+            #a new file for every write, so removing the file of a replaced or evicted row never
+            #removes the file of a row written since
+            file = f"{uuid.uuid4().hex[:16]}_{filename}"
+            os.makedirs(self._files.cache_home, exist_ok=True)
+            self._files.write_dict[cache_type](self._files.path(file), payload=payload, **kwargs)
+            size = sum(
+                os.path.getsize(self._files.path(x)) for x in _entry_files(file) if os.path.exists(self._files.path(x))
+            )
+        else:
+            try:
+                if cache_type == "json":
+                    text = json.dumps(payload)
+                elif cache_type in ["npy", "npz"]:
+                    buffer = io.BytesIO()
+                    if cache_type == "npy":
+                        np.save(buffer, np.asarray(payload))
+                    else:
+                        np.savez_compressed(buffer, **payload)
+                    blob = buffer.getvalue()
+                else:
+                    with tempfile.TemporaryDirectory() as tmp_dir:
+                        fits_path = os.path.join(tmp_dir, filename)
+                        hp.write_map(fits_path, payload, overwrite=True, **kwargs)
+                        with open(fits_path, "rb") as input_file:
+                            blob = input_file.read()
+            except:  # noqa: E722
+                raise Exception(f"Error in writing {cache_type} cache entry {filename}")
+            size = len(text.encode("utf-8")) if text is not None else len(blob)
+
+        now = time.time()
+        try:
+            with self._transaction() as connection:
+                replaced = connection.execute("SELECT file FROM entries WHERE filename = ?", (filename,)).fetchone()
+                connection.execute(
+                    "INSERT INTO entries (filename, graceid, kind, json, blob, file, size, created, last_access) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (filename) DO UPDATE SET "
+                    "graceid = excluded.graceid, kind = excluded.kind, json = excluded.json, blob = excluded.blob, "
+                    "file = excluded.file, meta = NULL, size = excluded.size, created = excluded.created, "
+                    "last_access = excluded.last_access",
+                    (filename, graceid, cache_type, text, blob, file, size, now, now)
+                )
+                evicted, files = [], []
+                if self._total_bytes(connection) > _config["max_bytes"]:
+                    evicted, files = self._evict(connection, _config["max_bytes"], _config["policy"], keep=filename)
+        except BaseException:
+            if file is not None:
+                self._remove_files([file])
+            raise
+
+        #the files of the row this write replaced, and of the evicted rows
+        self._remove_files(files + ([replaced[0]] if replaced is not None else []))
+
+
+    @staticmethod
+    def _payload_bytes(cache_type: str, payload) -> int:
+        if cache_type == "npz":
+            return sum(np.asarray(x).nbytes for x in payload.values())
+        return np.asarray(payload).nbytes
+
+
+    def _remove_files(self, files: list):
+        '''
+            remove the files of deleted or replaced rows, once their transaction is committed.
+            a file is never reused by another write, and one still referenced by a row is kept
+        '''
+        connection = self._connection()
+        for file in files:
+            if file is None or connection.execute("SELECT 1 FROM entries WHERE file = ?", (file,)).fetchone() is not None:
+                continue
+            for x in _entry_files(file):
+                if os.path.exists(self._files.path(x)):
+                    os.remove(self._files.path(x))
+
+
+    def get_meta(self, filename: str) -> dict:
+        row = self._connection().execute("SELECT meta FROM entries WHERE filename = ?", (filename,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return json.loads(row[0])
+
+
+    def put_meta(self, filename: str, meta: dict):
+        self._connection().execute("UPDATE entries SET meta = ? WHERE filename = ?", (json.dumps(meta), filename))
+
+
+    def lock(self, filename: str):
+        '''
+            context manager holding the entry's lock, a row of the locks table taken in a BEGIN IMMEDIATE transaction
+        '''
+        return _key_lock((self.path, filename), lambda: self._row_lock(filename))
+
+
+    @contextlib.contextmanager
+    def _row_lock(self, filename: str):
+        owner = f"{socket.gethostname()}:{os.getpid()}"
+        while True:
+            with self._transaction() as connection:
+                row = connection.execute("SELECT owner, acquired FROM locks WHERE filename = ?", (filename,)).fetchone()
+                acquired = row is None or self._is_stale(*row)
+                if acquired:
+                    connection.execute("INSERT OR REPLACE INTO locks VALUES (?, ?, ?)", (filename, owner, time.time()))
+            if acquired:
+                break
+            time.sleep(SQLITE_LOCK_POLL)
+
+        try:
+            yield
+        finally:
+            self._connection().execute("DELETE FROM locks WHERE filename = ? AND owner = ?", (filename, owner))
+
+
+    @staticmethod
+    def _is_stale(owner: str, acquired: float) -> bool:
+        if time.time() - acquired > SQLITE_LOCK_EXPIRY:
+            return True
+        host, pid = owner.rsplit(":", 1)
+        #only a process on this host can be checked, and os.kill would terminate it on windows
+        if host != socket.gethostname() or os.name != "posix":
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+
+    def record_access(self, filename: str, hit: bool):
+        connection = self._connection()
+        if hit:
+            connection.execute(
+                "UPDATE entries SET hits = hits + 1, last_access = ? WHERE filename = ?", (time.time(), filename)
+            )
+        else:
+            connection.execute("UPDATE counters SET value = value + 1 WHERE name = 'misses'")
+
+
+    def entries(self, graceid: str = None, kind: str = None) -> list:
+        '''
+            the entries, optionally only those of a graceid and/or kind, most recently used first
+            returns [{"filename", "graceid", "kind", "size", "created", "last_access", "hits", "pinned"}]
+        '''
+        conditions, parameters = [], []
+        if graceid is not None:
+            conditions.append("graceid = ?")
+            parameters.append(graceid)
+        if kind is not None:
+            conditions.append("kind = ?")
+            parameters.append(kind)
+        where = f"WHERE {' AND '.join(conditions)}" if len(conditions) else ""
+
+        connection = self._connection()
+        rows = connection.execute(
+            f"SELECT {_SQLITE_ENTRY_COLUMNS}, EXISTS (SELECT 1 FROM pins WHERE instr(filename, pins.key) > 0) "
+            f"FROM entries {where} ORDER BY last_access DESC", parameters
+        ).fetchall()
+        keys = _SQLITE_ENTRY_COLUMNS.split(", ") + ["pinned"]
+        return [{**dict(zip(keys, row)), "pinned": bool(row[-1])} for row in rows]
+
+
+    def stats(self) -> dict:
+        connection = self._connection()
+        n_entries, hits = connection.execute("SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM entries").fetchone()
+        misses = connection.execute("SELECT value FROM counters WHERE name = 'misses'").fetchone()[0]
+        return {
+            "entries": n_entries,
+            "bytes": self._total_bytes(connection),
+            "hits": hits,
+            "misses": misses,
+            "pinned": self._pinned(connection),
+            "files": self.entries()
+        }
+
+
+    def prune(self, max_bytes: int, policy: str) -> list:
+        with self._transaction() as connection:
+            evicted, files = self._evict(connection, max_bytes, policy)
+        self._remove_files(files)
+        return evicted
+
+
+    def pin(self, key: str):
+        self._connection().execute("INSERT OR IGNORE INTO pins VALUES (?)", (key,))
+
+
+    def unpin(self, key: str):
+        self._connection().execute("DELETE FROM pins WHERE key = ?", (key,))
+
+
+    def _pinned(self, connection) -> list:
+        return [x[0] for x in connection.execute("SELECT key FROM pins ORDER BY rowid")]
+
+
+    def _total_bytes(self, connection) -> int:
+        return connection.execute("SELECT value FROM counters WHERE name = 'bytes'").fetchone()[0]
+
+
+    def _evict(self, connection, max_bytes: int, policy: str, keep: str = None) -> tuple:
+        '''
+            delete unpinned entries in eviction order until the total fits in max_bytes,
+            within the caller's transaction. returns the removed filenames, and the files of those
+            kept as files, which the caller removes once the transaction is committed
+        '''
+        excess = self._total_bytes(connection) - max_bytes
+        if excess <= 0:
+            return [], []
+
+        order = "hits, last_access" if policy == "lfu" else "last_access"
+        rows = connection.execute(
+            f"SELECT filename, size, file FROM entries WHERE filename IS NOT ? AND "
+            f"NOT EXISTS (SELECT 1 FROM pins WHERE instr(filename, pins.key) > 0) ORDER BY {order}", (keep,)
+        )
+        evicted, files = [], []
+        for filename, size, file in rows:
+            if excess <= 0:
+                break
+            evicted.append(filename)
+            files.append(file)
+            excess -= size
+        rows.close()
+
+        connection.executemany("DELETE FROM entries WHERE filename = ?", [(x,) for x in evicted])
+        for filename in evicted:
+            _memory.discard(os.path.join(self.location, filename))
+        return evicted, files
+
+
+STORES = {
+    "directory": lambda cache_home: DirectoryStore(cache_home),
+    "sqlite": lambda cache_home: SQLiteStore(os.path.join(cache_home, SQLITE_FILENAME))
+}
+
+
+def _get_store():
+    store = _config["store"]
+    if not isinstance(store, str):
+        return store
+
+    cache_home = TMCache._home()
+    with _stores_lock:
+        if (store, cache_home) not in _stores:
+            _stores[(store, cache_home)] = STORES[store](cache_home)
+        return _stores[(store, cache_home)]
+
+
+class TMCache():
+    '''
+        A cache in ~/.tmcache. Every entry's size, last access and hit count is tracked, and
+        writes that take the cache over its byte budget evict the least recently used (or least
+        frequently used) entries. Entries matching a pinned key are never evicted.
+
+        Entries are stored by a backend, see configure: a file per entry in the directory
+        (the default), or rows of an SQLite database. Files are written to a temporary file and
+        renamed into place, so a reader never loads a partial entry, and writers of one key are
+        serialized by a per-key lock. The cache can be shared by many processes, see get_or_fetch.
+
+        Entries read from the backend are also kept in a bounded in-process memory tier, so
+        repeated reads of a hot entry skip the disk and the parsing. The payloads returned are
+        shared between callers: arrays are read-only, and parsed json must not be modified.
+
+        graceid: str - the event the entry belongs to, kept as a column by the SQLite store
+    '''
+
+    def __init__(self, filename: str=None, cache_type=None, graceid: str = None):
+        if cache_type not in CACHE_TYPES:
+            raise ValueError(f"Invalid Cache Type: {cache_type}")
+
+        self.cache_home = _cache_home()
+        self._set_cache_home()
+        self.filename = filename
+        self.cache_path = os.path.join(self.cache_home, filename)
+        self.cache_type = cache_type
+        self.graceid = graceid
+        self.store = _get_store()
+        self._memory_key = os.path.join(self.store.location, filename)
+
+
+    def get(self, **kwargs):
+        stamp = self.store.stamp(self.filename)
+        payload = _memory.get(self._memory_key, stamp)
+        if payload is not None:
+            if _memory.touch(self._memory_key):
+                self.store.record_access(self.filename, hit=True)
+            return payload
+
+        payload = self._read_store(stamp, **kwargs)
+        self.store.record_access(self.filename, hit=payload is not None)
+        return payload
+
+
+    def put(self, payload, overwrite=False, **kwargs):
+        with self.lock():
+            if self.store.stamp(self.filename) is not None and not overwrite:
+                return
+            self.store.write(self.filename, self.cache_type, payload, graceid=self.graceid, **kwargs)
+
+
+    def get_or_fetch(self, fetch):
+        '''
+            the cached entry, or on a miss the entry cached from fetch(). concurrent misses on
+            the same key, from threads or processes, wait for the one fetch in progress and
+            then read its entry instead of fetching again.
+
+            fetch: callable - returns the payload to cache
+        '''
+        payload = self.get()
+        if payload is not None:
+            return payload
+
+        with self.lock():
+            #filled while this caller waited for the lock
+            payload = self._read()
+            if payload is None:
+                self.put(payload=fetch(), overwrite=True)
+                payload = self._read()
+        return payload
+
+
+    def get_meta(self) -> dict:
+        '''
+            the metadata stored with the entry by put_meta, or None
+        '''
+        return self.store.get_meta(self.filename)
+
+
+    def put_meta(self, meta: dict):
+        '''
+            store a small json dict with the entry, e.g. the validators of a cached response.
+            it is evicted with the entry
+        '''
+        self.store.put_meta(self.filename, meta)
+
+
+    def lock(self):
+        '''
+            context manager holding this key's lock, across threads and processes
+        '''
+        return self.store.lock(self.filename)
+
+
+    def _read(self, **kwargs):
+        stamp = self.store.stamp(self.filename)
+        if stamp is None:
+            return None
+        payload = _memory.get(self._memory_key, stamp)
+        if payload is not None:
+            return payload
+        return self._read_store(stamp, **kwargs)
+
+
+    def _read_store(self, stamp, **kwargs):
+        if stamp is None:
+            return None
+        try:
+            payload = self.store.read(self.filename, self.cache_type, **kwargs)
+        except:  # noqa: E722
+            #evicted while it was being read
+            if self.store.stamp(self.filename) is None:
+                return None
+            raise
+
+        #only kept when the entry was not replaced while it was being read
+        if payload is not None and self.store.stamp(self.filename) == stamp:
+            nbytes = _payload_nbytes(payload, self.store.size(self.filename))
+            _memory.put(self._memory_key, stamp, _read_only(payload), nbytes)
+        return payload
+
+
+    @staticmethod
+    def configure(max_bytes: int = None, policy: str = None, memory_max_bytes: int = None,
+        memory_max_entries: int = None, store=None):
+        '''
+            only the arguments given are changed, the others keep their current setting
+            (initially the defaults, or their environment variables)
+
+            max_bytes: int - byte budget of the cache. GWTM_CACHE_MAX_BYTES sets the default
+            policy: str - evict the least recently ("lru") or least frequently ("lfu") used entries first
+            memory_max_bytes: int - byte budget of the in-process memory tier. memory-mapped skymaps count as 0.
+                GWTM_CACHE_MEMORY_BYTES sets the default
+            memory_max_entries: int - number of entries kept in memory, 0 turns the memory tier off
+            store: str - "directory" (a file per entry) or "sqlite" (one database in the cache directory),
+                or a backend instance, see DirectoryStore. GWTM_CACHE_STORE sets the default
+        '''
+        if policy is not None and policy not in EVICTION_POLICIES:
+            raise ValueError(f"Invalid Eviction Policy: {policy}")
+        if isinstance(store, str) and store not in STORES:
+            raise ValueError(f"Invalid Cache Store: {store}")
+
+        if max_bytes is not None:
+            _config["max_bytes"] = max_bytes
+        if policy is not None:
+            _config["policy"] = policy
+        if store is not None:
+            _config["store"] = store
+
+        _memory.clear()
+        if memory_max_bytes is not None:
+            _memory.max_bytes = memory_max_bytes
+        if memory_max_entries is not None:
+            _memory.max_entries = memory_max_entries
+
+
+    @staticmethod
+    def stats() -> dict:
+        '''
+            returns {
+                "store": the backend's name, "entries": number of entries, "bytes": their total size,
+                "max_bytes": the budget, "hits", "misses", "pinned": pinned keys,
+                "files": [{"filename", "size", "last_access", "hits", "pinned"}] most recently used first,
+                "memory": {"entries", "bytes", "max_entries", "max_bytes", "hits", "misses"} of this process's memory tier
+            }
+        '''
+        store = _get_store()
+        return {
+            "store": store.name,
+            **store.stats(),
+            "max_bytes": _config["max_bytes"],
+            "memory": _memory.stats()
+        }
+
+
+    @staticmethod
+    def entries(graceid: str = None, kind: str = None) -> list:
+        '''
+            the cached entries of a graceid and/or kind ("json", "npz", ...), most recently used first.
+            an indexed query with the SQLite store
+            returns [{"filename", "size", "last_access", "hits", "pinned", ...}]
+        '''
+        return _get_store().entries(graceid=graceid, kind=kind)
+
+
+    @staticmethod
+    def prune(max_bytes: int = None, policy: str = None) -> list:
+        '''
+            evict unpinned entries until the cache fits in max_bytes (default = the configured budget).
+            prune(max_bytes=0) removes everything that is not pinned.
+            returns the removed filenames
+        '''
+        return _get_store().prune(
+            _config["max_bytes"] if max_bytes is None else max_bytes,
+            _config["policy"] if policy is None else policy
+        )
+
+
+    @staticmethod
+    def pin(key: str):
+        '''
+            never evict the entries whose filename contains key, e.g. the graceid of the current event
+        '''
+        _get_store().pin(key)
+
+
+    @staticmethod
+    def unpin(key: str):
+        _get_store().unpin(key)
+
+
+    @staticmethod
+    def _home() -> str:
+        cache_home = _cache_home()
+        if not os.path.exists(cache_home):
+            os.makedirs(cache_home)
+        return cache_home
+
+
+    def _set_cache_home(self):
+        if not os.path.exists(self.cache_home):
+            os.makedirs(self.cache_home)
@@ -21,7 +21,7 @@ COLORS = [
 
 def non_none_locals(locals: dict) -> dict:
     ignore_locals = [
-        "self", "__class__", "base", "api_version", "urlencode", "debug", "cache"
+        "self", "__class__", "base", "api_version", "urlencode", "debug", "cache", "progress", "moc", "resolution"
     ]
 
     non_none_keys = [key for key, value in locals.items() if value is not None and key not in ignore_locals]
@@ -84,6 +84,133 @@ def z_rot(theta_deg):
     ])
 
 
+def _x_rots(theta_deg: np.ndarray) -> np.ndarray:
+    theta = np.deg2rad(theta_deg)
+    c, s = np.cos(theta), np.sin(theta)
+    rot = np.zeros(theta.shape + (3, 3))
+    rot[..., 0, 0] = 1
+    rot[..., 1, 1], rot[..., 1, 2] = c, -s
+    rot[..., 2, 1], rot[..., 2, 2] = s, c
+    return rot
+
+
+def _y_rots(theta_deg: np.ndarray) -> np.ndarray:
+    theta = np.deg2rad(theta_deg)
+    c, s = np.cos(theta), np.sin(theta)
+    rot = np.zeros(theta.shape + (3, 3))
+    rot[..., 1, 1] = 1
+    rot[..., 0, 0], rot[..., 0, 2] = c, s
+    rot[..., 2, 0], rot[..., 2, 2] = -s, c
+    return rot
+
+
+def _z_rots(theta_deg: np.ndarray) -> np.ndarray:
+    theta = np.deg2rad(theta_deg)
+    c, s = np.cos(theta), np.sin(theta)
+    rot = np.zeros(theta.shape + (3, 3))
+    rot[..., 2, 2] = 1
+    rot[..., 0, 0], rot[..., 0, 1] = c, -s
+    rot[..., 1, 0], rot[..., 1, 1] = s, c
+    return rot
+
+
+def uvecs_to_ra_dec(uvecs: np.ndarray):
+    '''
+        vectorized uvec_to_ra_dec for an array of vectors with shape (..., 3)
+        returns (ra, dec) arrays with shape (...)
+    '''
+    x, y, z = uvecs[..., 0], uvecs[..., 1], uvecs[..., 2]
+    r = np.sqrt(x**2 + y**2 + z**2)
+    theta = np.arctan2(y, x)
+    phi = np.arccos(np.clip(z / r, -1.0, 1.0))
+    dec = 90 - np.rad2deg(phi)
+    ra = np.rad2deg(theta)
+    ra = np.where(theta < 0, 360 + ra, ra)
+    return ra, dec
+
+
+def rotation_matrices(ra, dec, pos_angle) -> np.ndarray:
+    '''
+        composed footprint rotation x_rot(-pos_angle) @ y_rot(dec) @ z_rot(-ra)
+        for arrays of pointings. returns an array with shape (n, 3, 3)
+        that rotates row vectors: v @ R
+    '''
+    ra = np.atleast_1d(np.asarray(ra, dtype=float))
+    dec = np.atleast_1d(np.asarray(dec, dtype=float))
+    #pointings without a position angle are unrotated
+    pos_angle = np.nan_to_num(np.atleast_1d(np.asarray(pos_angle, dtype=float)), nan=0.0)
+    ra, dec, pos_angle = np.broadcast_arrays(ra, dec, pos_angle)
+
+    return _x_rots(-pos_angle) @ _y_rots(dec) @ _z_rots(-ra)
+
+
+def polygon_to_uvecs(polygon) -> np.ndarray:
+    '''
+        polygon: list of (ra, dec) vertices in degrees. a closing vertex is dropped
+        returns the vertices as unit vectors with shape (n_vertices, 3), as expected by hp.query_polygon
+    '''
+    polygon = np.asarray(polygon, dtype=float)
+    if len(polygon) > 1 and np.array_equal(polygon[0], polygon[-1]):
+        polygon = polygon[:-1]
+    return np.stack(ra_dec_to_uvec(polygon[:, 0], polygon[:, 1]), axis=-1)
+
+
+def polygon_edge_normals(polygons) -> np.ndarray:
+    '''
+        polygons: list of K convex polygons of (ra, dec) vertices in degrees, optionally closed
+        returns the great circle normals of the polygon edges, signed to point into the polygon,
+        with shape (K, n_vertices, 3). polygons with fewer vertices are padded with zero normals
+    '''
+    uvecs = [polygon_to_uvecs(polygon) for polygon in polygons]
+    n_vertices = max([len(x) for x in uvecs])
+
+    #pad by repeating the first vertex, which only adds zero length edges
+    vertices = np.empty((len(uvecs), n_vertices, 3))
+    for i, polygon in enumerate(uvecs):
+        vertices[i, :len(polygon)] = polygon
+        vertices[i, len(polygon):] = polygon[0]
+
+    normals = np.cross(vertices, np.roll(vertices, -1, axis=1))
+    #the vertex centroid is inside a convex polygon, so orient every edge towards it
+    centroids = vertices.sum(axis=1, keepdims=True)
+    return normals * np.sign(np.sum(normals * centroids, axis=-1, keepdims=True))
+
+
+def points_in_polygons(ra, dec, polygons, tolerance: float = 1e-12) -> np.ndarray:
+    '''
+        exact spherical point in convex polygon test of M points against K polygons at once.
+        a point is inside when it is on the inner side of every edge's great circle,
+        points on an edge count as inside
+
+        ra, dec: arrays of M positions in degrees
+        polygons: list of K convex polygons of (ra, dec) vertices in degrees, optionally closed
+        returns a boolean array with shape (M, K)
+    '''
+    ra = np.atleast_1d(np.asarray(ra, dtype=float))
+    dec = np.atleast_1d(np.asarray(dec, dtype=float))
+    if len(ra) == 0 or len(polygons) == 0:
+        return np.zeros((len(ra), len(polygons)), dtype=bool)
+
+    points = np.stack(ra_dec_to_uvec(ra, dec), axis=-1)
+    normals = polygon_edge_normals(polygons)
+    sides = np.einsum('mi,kvi->mkv', points, normals)
+    return np.all(sides >= -tolerance, axis=-1)
+
+
+def paired_points_in_polygons(ra, dec, normals: np.ndarray, tolerance: float = 1e-12) -> np.ndarray:
+    '''
+        the test of points_in_polygons for P (point, polygons) pairs, against edge normals that were
+        computed once, e.g. for every ccd of every pointing, and gathered for each pair
+
+        ra, dec: arrays of P positions in degrees
+        normals: the polygon_edge_normals of each point's K polygons, with shape (P, K, n_vertices, 3)
+        returns a boolean array with shape (P, K)
+    '''
+    points = np.stack(ra_dec_to_uvec(np.asarray(ra, dtype=float), np.asarray(dec, dtype=float)), axis=-1)
+    sides = np.einsum('pi,pkvi->pkv', points.reshape(-1, 3), normals)
+    return np.all(sides >= -tolerance, axis=-1)
+
+
 def instrument_color(integer):
     #GWTM friendly colors
     colorlist=[
@@ -1,343 +1,919 @@
+from __future__ import annotations
+import asyncio
+import datetime
+import hashlib
 import json
-from typing import Any, List, Tuple
+import threading
+from typing import Any, Dict, List, Tuple
 import ligo.skymap.plot  # noqa: F401
 from matplotlib import pyplot as plt
 from matplotlib.patches import Polygon
 import numpy as np
-import pandas as pd
-import astropy
 
 import healpy as hp
-from ligo.skymap.postprocess.util import find_greedy_credible_levels
 import ligo.skymap.postprocess
 
 from . import Pointing, Instrument, Footprint, Candidate
 from .alert import Alert as Alert
-from .core.util import instrument_color, gc_dist
+from .core import baseapi
+from .core.util import instrument_color, paired_points_in_polygons, polygon_edge_normals
+from .core.coverage import CoverageMask, grouped_polygon_ranges, ranges_to_pixels
+from .core.moc import MOC
+from .core.skymap import CONTOUR_NSIDE, MultiOrderSkymap, greedy_sort, greedy_credible_levels
+from .core.spatial import PointingIndex
+from .core.tmcache import TMCache
+
+#DECam's full footprint is too expensive to pixelize, so it is always approximated
+DECAM_ID = 38
+
+#in-process coverage states, keyed by (graceid, approximate)
+_COVERAGE_STATES = {}
+_COVERAGE_STATES_LOCK = threading.Lock()
+
+#pointing centers are keyed to 1e-6 deg and position angles to 1e-4 deg in the footprint pixel cache
+POINTING_KEY_SCALES = (10**6, 10**6, 10**4)
+#the footprint pixel cache is split into one TMCache entry per pixel of this nside, by pointing center
+PIXEL_CACHE_REGION_NSIDE = 4
+#(candidate, pointing) pairs tested at once by batch_candidate_pointings, bounding its memory
+CANDIDATE_PAIR_CHUNK = 4096
+
+
+async def fetch_event_data_async(api_token: str, graceid: str, pointings: List[Pointing] = [],
+    cache=False, approximate=True) -> Tuple[List[Pointing], Any, List[Any], List[Instrument]]:
+    '''
+    inputs:
+        api_token: str - valid GWTM api_token
+        graceid: str - the GW event
+        pointings: List[Pointing] - pointings to use. default = all completed pointings for the graceid
+        cache: bool - use the local TMCache for the skymap and contours
+        approximate: bool - use the approximated instrument footprints
+
+    fetches the pointings, skymap and contours concurrently, then the instruments (with footprints)
+    of the pointings, over the shared connection pool.
+    returns (pointings, skymap, contour_polygons, instruments)
+    '''
 
+    fetches = [
+        Alert.fetch_skymap_async(graceid=graceid, api_token=api_token, cache=cache),
+        Alert.fetch_contours_async(graceid=graceid, api_token=api_token, cache=cache)
+    ]
+    if len(pointings) == 0:
+        fetches.append(Pointing.get_async(graceid=graceid, api_token=api_token, status='completed'))
 
-def plot_coverage(api_token: str, graceid: str, pointings: List[Pointing] = [],
-    cache=False, projection='astro hours mollweide') -> None:
-    
-    if len(pointings) == 0 and graceid is None:
-        raise Exception("Pointings list or graceid is required")
+    results = await asyncio.gather(*fetches)
+    skymap, contour_polygons = results[0], results[1]
+    if len(pointings) == 0:
+        pointings = results[2]
 
-    if len(pointings) == 0 and graceid is not None:
-        pointings = Pointing.get(graceid = graceid, api_token=api_token, status='completed')
+    instrument_ids = list(set([x.instrumentid for x in pointings]))
+    instruments = []
+    if len(instrument_ids):
+        instruments = await Instrument.get_async(
+            ids=instrument_ids, include_footprint=True, api_token=api_token, approximate_footprint=approximate
+        )
 
-    #fetch skymap data
-    skymap_data = Alert.fetch_skymap(graceid=graceid, api_token=api_token, cache=cache)
+    return pointings, skymap, contour_polygons, instruments
 
-    #fetch contour data
-    contour_polygons = Alert.fetch_contours(graceid=graceid, api_token=api_token, cache=cache)
 
-    #query for footprint info
-    instrument_ids = list(set([x.instrumentid for x in pointings]))
-    inst_footprints =  Instrument.get(ids=instrument_ids, include_footprint=True, api_token=api_token)
+def project_pointings(instrument: Instrument, pointings: List[Pointing]) -> List[List[Tuple[float, float]]]:
+    '''
+    projects the instrument footprint onto all of the pointings in one batch
+    returns a list of ccd polygons [(ra, dec), ...], ordered by pointing then ccd
+    '''
+    if len(pointings) == 0:
+        return []
 
-    #set up the plot
-    subplot_kw = {
-        'projection': projection,
-        #'center': SkyCoord(alert_info.avgra, alert_info.avgdec, unit="deg")
-    }
-    fig, ax = plt.subplots(1, 1, layout="constrained", subplot_kw=subplot_kw)
-    ax.grid()
+    projected = np.round(instrument.project_batch(
+        [x.ra for x in pointings],
+        [x.dec for x in pointings],
+        [x.pos_angle for x in pointings]
+    ), 3)
+    ccd_lengths = [len(ccd.polygon) for ccd in instrument.footprint]
 
-    #plot each of the instrument footprints
-    instrument_enumeration_dict = {}
-    for i, iid in enumerate(instrument_ids):
-        instrument_enumeration_dict[iid] = i
+    polygon_arr = []
+    for pointing_ccds in projected:
+        for ccd, n_vertices in zip(pointing_ccds, ccd_lengths):
+            polygon_arr.append([(x, y) for x, y in ccd[:n_vertices].tolist()])
+    return polygon_arr
 
-    for i in instrument_ids:
-        polygon_arr = []
-        instrument_pointings = [x for x in pointings if x.instrumentid == i]
 
-        if cache:
-            cached_footprints = Footprint.get_cached_footprints(
-                graceid=graceid,
-                instrument_id=i,
-                pointings=instrument_pointings
-            )
-            if cached_footprints:
-                polygon_arr.extend(
-                    cached_footprints
-                )
+class FootprintPixelCache():
+    '''
+    The pixels of an instrument's footprint projected onto single pointings, cached in the TMCache
+    across events and calls. An entry is keyed by (footprint, rounded ra, dec, pos_angle, nside) and
+    holds the nested pixel ranges of the projected footprint as a MOC, so the coverage of any set of
+    pointings is the union of their entries, and only pointings never seen before are projected and
+    pixelized. The footprint is identified by its ccd polygons, so the entries are shared by every
+    event, and go stale on their own when a footprint changes.
 
-        inst_footprint = [x for x in inst_footprints if x.id == i][0]
-        
-        if len(polygon_arr) == 0:
-            for p in instrument_pointings:
-                projected_footprint = inst_footprint.project(p.ra, p.dec, p.pos_angle)
-                for ccd in projected_footprint:
-                    ra_deg, dec_deg = zip(*[(coord_deg[0], coord_deg[1])
-                                            for coord_deg in ccd])
-                    
-                    list_o_coords = []
-                    for x, y in zip(ra_deg, dec_deg):
-                        list_o_coords.append((x, y))
-                    polygon_arr.append(list_o_coords)
+    The entries of a footprint at one nside are kept in one npz per sky region (the pointing
+    center's pixel at PIXEL_CACHE_REGION_NSIDE), so an event only loads the regions it observed.
 
-        if cache:
-            Footprint.put_cached_footprints(
-                polygon_arr,
-                graceid=graceid,
-                instrument_id=i,
-                pointings=instrument_pointings
-            )
+    inputs:
+        instrument: Instrument - with its footprint
+        nside: int - resolution the footprints are pixelized at
+        inclusive: bool - also count the pixels that the ccd edges pass through
+        nest: bool - ordering the footprints are pixelized in. healpy's inclusive pixelization differs
+            slightly between orderings, so use the ordering of the coverage the entries are merged into
+    '''
 
-        for j,arr in enumerate(polygon_arr):
-            if j == 0:
-                label = inst_footprint.nickname if inst_footprint.nickname is not None else inst_footprint.name
-            else:
-                label = None
+    def __init__(self, instrument: Instrument, nside: int, inclusive=True, nest=False):
+        self.instrument = instrument
+        self.nside = nside
+        self.inclusive = inclusive
+        self.nest = nest
+
+        polygons = json.dumps([ccd.polygon for ccd in instrument.footprint])
+        self.footprint_key = hashlib.sha1(polygons.encode()).hexdigest()[:16]
+
+
+    def _filename(self, region: int) -> str:
+        mode = f"{'inclusive' if self.inclusive else 'exact'}_{'nest' if self.nest else 'ring'}"
+        return f"footprint_pixels_{self.instrument.id}_{self.footprint_key}_nside{self.nside}_{mode}_{region}.npz"
+
+
+    @staticmethod
+    def pointing_keys(pointings: List[Pointing]) -> np.ndarray:
+        '''
+        the rounded (ra, dec, pos_angle) of each pointing as integers, with shape (n, 3)
+        '''
+        centers = np.asarray([
+            [x.ra, x.dec, x.pos_angle if x.pos_angle is not None else 0.0] for x in pointings
+        ], dtype=float).reshape(-1, 3)
+        return np.round(centers * np.asarray(POINTING_KEY_SCALES)).astype(np.int64)
+
+
+    @staticmethod
+    def _read_entries(payload) -> dict:
+        if payload is None:
+            return {}
+        counts = payload["counts"]
+        ranges = np.cumsum(payload["moc_boundaries"]).reshape(-1, 2)
+        stops = np.cumsum(counts)
+        return {
+            tuple(key): ranges[stop - count:stop] for key, count, stop in zip(payload["keys"].tolist(), counts, stops)
+        }
+
+
+    @staticmethod
+    def _entries_payload(entries: dict) -> dict:
+        ranges = [x for x in entries.values()]
+        boundaries = np.concatenate(ranges).reshape(-1) if len(ranges) else np.empty(0, dtype=np.int64)
+        return {
+            "keys": np.asarray(list(entries.keys()), dtype=np.int64).reshape(-1, 3),
+            "counts": np.asarray([len(x) for x in ranges], dtype=np.int64),
+            "moc_boundaries": np.diff(boundaries, prepend=0)
+        }
+
+
+    def pointing_mocs(self, pointings: List[Pointing], workers: int = None) -> List[MOC]:
+        '''
+        the MOC of the footprint projected onto each pointing, in order. pointings that are not
+        cached are projected, pixelized (on workers processes) and added to the cache
+        '''
+        if len(pointings) == 0:
+            return []
+        keys = [tuple(x) for x in self.pointing_keys(pointings).tolist()]
+        ra = np.asarray([x.ra for x in pointings], dtype=float)
+        dec = np.asarray([x.dec for x in pointings], dtype=float)
+        regions = hp.ang2pix(PIXEL_CACHE_REGION_NSIDE, ra, dec, lonlat=True, nest=True)
+
+        ranges = [None] * len(pointings)
+        for region in np.unique(regions):
+            members = np.flatnonzero(regions == region)
+            region_cache = TMCache(filename=self._filename(region), cache_type="npz")
+            entries = self._read_entries(region_cache.get())
+
+            missing = [i for i in members if keys[i] not in entries]
+            if len(missing):
+                new_entries = self._pixelize([pointings[i] for i in missing], workers)
+                with region_cache.lock():
+                    #entries added by other callers while these were pixelized are kept
+                    entries = {
+                        **self._read_entries(region_cache.get()), **dict(zip([keys[i] for i in missing], new_entries))
+                    }
+                    region_cache.put(payload=self._entries_payload(entries), overwrite=True)
+
+            for i in members:
+                ranges[i] = entries[keys[i]]
+        return [MOC(x) for x in ranges]
+
+
+    def moc(self, pointings: List[Pointing], workers: int = None) -> MOC:
+        '''
+        the union of the footprint projected onto the pointings
+        '''
+        ranges = [x.ranges for x in self.pointing_mocs(pointings, workers)]
+        return MOC(np.concatenate(ranges)) if len(ranges) else MOC()
+
+
+    def _pixelize(self, pointings: List[Pointing], workers: int = None) -> List[np.ndarray]:
+        polygon_arr = project_pointings(self.instrument, pointings)
+        n_ccds = len(polygon_arr) // len(pointings)
+        groups = [polygon_arr[j*n_ccds:(j+1)*n_ccds] for j in range(len(pointings))]
+
+        order = hp.nside2order(self.nside)
+        mocs = [
+            MOC.from_pixels(ranges_to_pixels(x), order, nest=self.nest)
+            for x in grouped_polygon_ranges(groups, self.nside, nest=self.nest, inclusive=self.inclusive, workers=workers)
+        ]
+        return [x.ranges for x in mocs]
 
-            #cut_dateline(arr)[0]
-            poly = Polygon(
-                np.asarray(arr), 
-                transform=ax.get_transform('world'),
-                edgecolor=instrument_color(instrument_enumeration_dict[i]), 
-                facecolor='None', 
-                linewidth=0.5, 
-                alpha=1.0,
-                zorder=9900,
-                label=label
-            )
-            ax.add_patch(poly)
 
-    #plot thee 90/50 contoturs
-    for contour_polygon in contour_polygons:
-        ra_deg, dec_deg = zip(*[(coord_deg[0], coord_deg[1])
-                                for coord_deg in contour_polygon])
-                                
-        list_o_coords = []
-        for x, y in zip(ra_deg, dec_deg):
-                list_o_coords.append((x, y))
-        arr = np.asarray(list_o_coords)
-
-        poly = Polygon(
-            arr, 
-            transform=ax.get_transform('world'),
-            edgecolor='r', 
-            facecolor='None', 
-            linewidth=0.5,
-            alpha=1.0,
-            zorder=9900
-        )
-        ax.add_patch(poly)
+class CoverageEngine():
+    '''
+    The fetch -> project -> pixelize pipeline for a (graceid, pointings) pair.
+    Each input is fetched once, each instrument's footprint is projected onto its pointings
+    once, and the covered pixels are kept, so the probability, area, renormalized skymap,
+    contours, plot and candidate checks are all answered from the same state.
 
-    #plot the skymap:
-    if skymap_data is not None:
+    inputs:
+        api_token: str - valid GWTM api_token
+        graceid: str - the GW event
+        pointings: List[Pointing] - pointings to evaluate. default = all completed pointings for the graceid
+        cache: bool - use the local TMCache for the skymap, contours, instruments, projected footprints
+            and the pixels of each projected footprint, see FootprintPixelCache
+        approximate: bool - use the approximated instrument footprints
+        workers: int - pixelize the projected footprints on this many processes. default = serial
+        multiorder: bool - fetch the skymap as a MultiOrderSkymap. its coverage is a MOC at the
+            skymap's finest order instead of a pixel mask, and it is never flattened
+        sparse: float - fetch only the pixels of this credible region (e.g. 0.999) as a SparseSkymap,
+            handled like a multi-order skymap
+        resolution: int - nside that is fine enough for the answer, e.g. 128 for a quick look. a flat
+            or sparse skymap is fetched at the cheapest pyramid level that meets it, see Alert.fetch_skymap
+        skymap, contour_polygons, instruments - already fetched inputs, e.g. from fetch_event_data_async.
+            skymap can be a flat map, a MultiOrderSkymap or a SparseSkymap
+    '''
 
-        _90_50_levels = find_greedy_credible_levels(np.asarray(skymap_data))
-        ax.contourf_hpx(
-            _90_50_levels, 
-            cmap='OrRd_r', 
-            levels=[0.0, 0.5, 0.9], 
-            alpha=0.75
+    def __init__(self, api_token: str, graceid: str, pointings: List[Pointing] = [], cache=False,
+        approximate=True, workers: int = None, multiorder=False, sparse: float = None, resolution: int = None,
+        skymap=None, contour_polygons=None, instruments: List[Instrument] = None):
+
+        if len(pointings) == 0 and graceid is None:
+            raise Exception("Pointings list or graceid is required")
+
+        self.api_token = api_token
+        self.graceid = graceid
+        self.cache = cache
+        self.approximate = approximate
+        self.workers = workers
+        self.multiorder = multiorder
+        self.sparse = sparse
+        self.resolution = resolution
+
+        self._pointings = pointings if len(pointings) else None
+        self._skymap = skymap
+        self._skymap_given = skymap is not None
+        self._contour_polygons = contour_polygons
+        self._instruments = instruments
+        self._polygons = None
+        self._coverage = {}
+        self._moc = {}
+        self._credible = None
+
+
+    def load(self) -> CoverageEngine:
+        '''
+        fetch the skymap, contours and pointings concurrently, then the instruments
+        '''
+        baseapi.map_concurrent(
+            lambda fetch: fetch(),
+            [lambda: self.skymap, lambda: self.contour_polygons, lambda: self.pointings]
         )
+        _ = self.instruments
+        return self
 
-    plt.legend(bbox_to_anchor=(0, 0), loc="lower left",
-                bbox_transform=fig.transFigure,  ncol=4)
-    plt.title(f"Reported Coverage for {graceid}")
-    plt.show()
 
+    @property
+    def pointings(self) -> List[Pointing]:
+        if self._pointings is None:
+            self._pointings = Pointing.get(graceid=self.graceid, api_token=self.api_token, status='completed')
+        return self._pointings
 
-def calculate_coverage(api_token: str, graceid: str, pointings: List[Pointing] = [],
-    cache=False, approximate=True) -> Tuple[float, float]:
-    DECam_id = 38
-    if len(pointings) == 0 and graceid is None:
-        raise Exception("Pointings list or graceid is required")
 
-    if len(pointings) == 0 and graceid is not None:
-        pointings = Pointing.get(graceid = graceid, api_token=api_token, status='completed')
+    @property
+    def skymap(self) -> Any:
+        if self._skymap is None and self.sparse is not None:
+            self._skymap = Alert.fetch_sparse_skymap(
+                graceid=self.graceid, api_token=self.api_token, credible=self.sparse, cache=self.cache,
+                resolution=self.resolution
+            )
+        elif self._skymap is None:
+            #a multi-order skymap keeps its own resolution
+            self._skymap = Alert.fetch_skymap(
+                graceid=self.graceid, api_token=self.api_token, cache=self.cache, moc=self.multiorder,
+                resolution=None if self.multiorder else self.resolution
+            )
+        return self._skymap
 
-    skymap = Alert.fetch_skymap(graceid=graceid, api_token=api_token, cache=cache)
 
-    instrument_ids = list(set([x.instrumentid for x in pointings]))
+    @property
+    def is_multiorder(self) -> bool:
+        '''
+        the skymap is a MultiOrderSkymap (or SparseSkymap), measured against MOC coverage instead of a pixel mask
+        '''
+        return isinstance(self.skymap, MultiOrderSkymap)
 
-    if DECam_id in instrument_ids:
-        print("Warning: DECam footprint will be automatically approximated")
-        approximate = True
 
-    inst_footprints =  Instrument.get(ids=instrument_ids, include_footprint=True, api_token=api_token, approximate_footprint=approximate)
+    @property
+    def contour_polygons(self) -> List[Any]:
+        if self._contour_polygons is None:
+            self._contour_polygons = Alert.fetch_contours(graceid=self.graceid, api_token=self.api_token, cache=self.cache)
+        return self._contour_polygons
 
-    instrument_enumeration_dict = {}
-    for i, iid in enumerate(instrument_ids):
-        instrument_enumeration_dict[iid] = i
 
-    skymap_nside = hp.npix2nside(len(skymap))
+    @property
+    def instrument_ids(self) -> List[int]:
+        return list(set([x.instrumentid for x in self.pointings]))
 
-    qps = []
-    NSIDE4area = 512 #this gives pixarea of 0.013 deg^2 per pixel
-    pixarea = hp.nside2pixarea(NSIDE4area, degrees=True)
 
-    for i in instrument_ids:
-        polygon_arr = []
-        instrument_pointings = [x for x in pointings if x.instrumentid == i]
+    @property
+    def instruments(self) -> List[Instrument]:
+        if self._instruments is None:
+            approximate = self.approximate
+            if DECAM_ID in self.instrument_ids and not approximate:
+                print("Warning: DECam footprint will be automatically approximated")
+                approximate = True
 
-        if cache:
-            cached_footprints = Footprint.get_cached_footprints(
-                graceid=graceid,
-                instrument_id=i,
-                pointings=instrument_pointings
+            self._instruments = Instrument.get(
+                ids=self.instrument_ids, include_footprint=True, api_token=self.api_token, approximate_footprint=approximate,
+                cache=self.cache
             )
-            if cached_footprints:
-                polygon_arr.extend(
-                    cached_footprints
-                )
+        return self._instruments
 
-        inst_footprint = [x for x in inst_footprints if x.id == i][0]
-        
-        if len(polygon_arr) == 0:
-            for p in instrument_pointings:
-                projected_footprint = inst_footprint.project(p.ra, p.dec, p.pos_angle)
-                for ccd in projected_footprint:
-                    ra_deg, dec_deg = zip(*[(coord_deg[0], coord_deg[1])
-                                            for coord_deg in ccd])
-                    
-                    list_o_coords = []
-                    for x, y in zip(ra_deg, dec_deg):
-                        list_o_coords.append((x, y))
-                    polygon_arr.append(list_o_coords)
 
-        if cache:
-            Footprint.put_cached_footprints(
-                polygon_arr,
-                graceid=graceid,
-                instrument_id=i,
+    def instrument(self, instrument_id: int) -> Instrument:
+        return [x for x in self.instruments if x.id == instrument_id][0]
+
+
+    def instrument_pointings(self, instrument_id: int) -> List[Pointing]:
+        return [x for x in self.pointings if x.instrumentid == instrument_id]
+
+
+    @property
+    def polygons(self) -> dict:
+        '''
+        projected ccd polygons for each instrument id, ordered by pointing then ccd
+        '''
+        if self._polygons is None:
+            self._polygons = {}
+            for i in self.instrument_ids:
+                self._polygons[i] = self._project_instrument(i)
+        return self._polygons
+
+
+    def _project_instrument(self, instrument_id: int) -> List[List[Tuple[float, float]]]:
+        instrument_pointings = self.instrument_pointings(instrument_id)
+
+        polygon_arr = None
+        if self.cache:
+            polygon_arr = Footprint.get_cached_footprints(
+                graceid=self.graceid,
+                instrument_id=instrument_id,
                 pointings=instrument_pointings
             )
 
-        for j,arr in enumerate(polygon_arr):
-            ras_poly = [x[0] for x in arr][:-1]
-            decs_poly = [x[1] for x in arr][:-1]
-            xyzpoly = astropy.coordinates.spherical_to_cartesian(1, np.deg2rad(decs_poly), np.deg2rad(ras_poly))
-            qp = hp.query_polygon(skymap_nside,np.array(xyzpoly).T, inclusive=True)
-            qps.extend(qp)
-
-            # qparea = hp.query_polygon(NSIDE4area, np.array(xyzpoly).T)
-            # qpsarea.extend(qparea)
-
-            #deduplicate indices, so that pixels already covered are not double counted
-            deduped_indices=list(dict.fromkeys(qps))
-            # deduped_indices_area = list(dict.fromkeys(qpsarea))
-
-            # area = pixarea * len(deduped_indices_area)
-
-            #prob = 0
-            #for ind in deduped_indices:
-            #    prob += skymap[ind]
-            #elapsed = p.time - time_of_signal
-            #elapsed = elapsed.total_seconds()/3600
-            #times.append(elapsed)
-            #probs.append(prob)
-            
-    prob = np.sum(skymap[deduped_indices])
-    area = pixarea * len(deduped_indices)
-    return prob, area
+        if not polygon_arr:
+            polygon_arr = project_pointings(self.instrument(instrument_id), instrument_pointings)
 
-def renormalize_skymap(api_token: str, graceid: str, pointings: List[Pointing] = [],
-    cache=False) -> Any:
+            if self.cache:
+                Footprint.put_cached_footprints(
+                    polygon_arr,
+                    graceid=self.graceid,
+                    instrument_id=instrument_id,
+                    pointings=instrument_pointings
+                )
 
+        return polygon_arr
 
-    if len(pointings) == 0 and graceid is None:
-        raise Exception("Pointings list or graceid is required")
 
-    if len(pointings) == 0 and graceid is not None:
-        pointings = Pointing.get(graceid = graceid, api_token=api_token, status='completed')
+    def pointing_polygons(self, instrument_id: int) -> List[List[List[Tuple[float, float]]]]:
+        '''
+        the projected ccd polygons of the instrument, grouped per pointing in instrument_pointings order
+        '''
+        polygon_arr = self.polygons[instrument_id]
+        instrument_pointings = self.instrument_pointings(instrument_id)
+        if len(instrument_pointings) == 0:
+            return []
 
-    skymap = Alert.fetch_skymap(graceid=graceid, api_token=api_token, cache=cache)
+        n_ccds = len(polygon_arr) // len(instrument_pointings)
+        return [polygon_arr[j*n_ccds:(j+1)*n_ccds] for j in range(len(instrument_pointings))]
 
-    instrument_ids = list(set([x.instrumentid for x in pointings]))
-    inst_footprints =  Instrument.get(ids=instrument_ids, include_footprint=True, api_token=api_token)
 
-    instrument_enumeration_dict = {}
-    for i, iid in enumerate(instrument_ids):
-        instrument_enumeration_dict[iid] = i
+    @property
+    def skymap_nside(self) -> int:
+        '''
+        nside of the flat skymap, or of the finest pixels of a multi-order skymap
+        '''
+        if self.is_multiorder:
+            return self.skymap.nside
+        return hp.npix2nside(len(self.skymap))
 
-    skymap_nside = hp.npix2nside(len(skymap))
 
-    qps = []
+    def _flat_skymap_required(self, name: str):
+        if self.is_multiorder:
+            raise Exception(f"Error in CoverageEngine.{name}(). It needs a flat skymap, use skymap.rasterize() or moc()")
 
-    for i in instrument_ids:
-        polygon_arr = []
-        instrument_pointings = [x for x in pointings if x.instrumentid == i]
 
-        if cache:
-            cached_footprints = Footprint.get_cached_footprints(
-                graceid=graceid,
-                instrument_id=i,
-                pointings=instrument_pointings
+    def coverage(self, inclusive=True) -> CoverageMask:
+        '''
+        covered pixels of the skymap. inclusive also counts the pixels that the polygon edges pass through
+        '''
+        self._flat_skymap_required("coverage")
+        if inclusive not in self._coverage:
+            coverage = CoverageMask(self.skymap_nside)
+            if self.cache:
+                moc = self._cached_moc(self.skymap_nside, inclusive=inclusive, nest=False)
+                coverage.add(moc.pixels(hp.nside2order(self.skymap_nside), nest=False))
+            else:
+                polygons = [arr for polygon_arr in self.polygons.values() for arr in polygon_arr]
+                coverage.add_polygons(polygons, inclusive=inclusive, workers=self.workers)
+            self._coverage[inclusive] = coverage
+        return self._coverage[inclusive]
+
+
+    def probability(self, inclusive=True) -> float:
+        if self.is_multiorder:
+            return self.skymap.probability(self.moc(inclusive=inclusive))
+        return self.coverage(inclusive).probability(self.skymap)
+
+
+    def moc(self, order: int = None, inclusive=True) -> MOC:
+        '''
+        the coverage as a MOC. default order = the skymap's finest, pixelized as the pixel mask of a
+        flat skymap is so the results agree, and reusing that mask for a flat skymap
+        '''
+        nest = order is not None
+        if order is None:
+            order = hp.nside2order(self.skymap_nside)
+            if not self.is_multiorder:
+                return MOC.from_pixels(self.coverage(inclusive).pixels(), order, nest=False)
+
+        if (order, inclusive) not in self._moc:
+            if self.cache:
+                self._moc[(order, inclusive)] = self._cached_moc(2**order, inclusive=inclusive, nest=nest)
+            else:
+                polygons = [arr for polygon_arr in self.polygons.values() for arr in polygon_arr]
+                self._moc[(order, inclusive)] = MOC.from_polygons(
+                    polygons, order, inclusive=inclusive, workers=self.workers, nest=nest
+                )
+        return self._moc[(order, inclusive)]
+
+
+    def _cached_moc(self, nside: int, inclusive=True, nest=False) -> MOC:
+        '''
+        the coverage as the union of the pointings' FootprintPixelCache entries, only the
+        pointings missing from the cache are projected and pixelized
+        '''
+        ranges = [
+            FootprintPixelCache(self.instrument(i), nside, inclusive=inclusive, nest=nest).moc(
+                self.instrument_pointings(i), workers=self.workers
+            ).ranges
+            for i in self.instrument_ids
+        ]
+        return MOC(np.concatenate(ranges)) if len(ranges) else MOC()
+
+
+    def area(self, inclusive=True) -> float:
+        if self.is_multiorder:
+            return self.moc(inclusive=inclusive).area()
+        return self.coverage(inclusive).area()
+
+
+    def renormalized_skymap(self) -> Any:
+        '''
+        the skymap with the covered pixels set to zero, renormalized to 1.
+        a MultiOrderSkymap for a multi-order skymap, with the pixels on the coverage edge split to its finest order
+        '''
+        if self.is_multiorder:
+            return self.skymap.renormalized(self.moc(inclusive=False))
+
+        normed_skymap = np.where(self.coverage(inclusive=False).mask, 0.0, self.skymap)
+        normed_skymap /= np.sum(normed_skymap)
+        return normed_skymap
+
+
+    def _credible_levels_and_sort(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self._credible is None:
+            if self.cache and not self._skymap_given:
+                self._credible = Alert.fetch_credible_levels(
+                    graceid=self.graceid, api_token=self.api_token, cache=True, resolution=self.resolution
+                )
+            else:
+                sort = greedy_sort(self.skymap)
+                self._credible = (greedy_credible_levels(self.skymap, sort), sort)
+        return self._credible
+
+
+    def credible_levels(self) -> np.ndarray:
+        '''
+        flat map of the greedy credible level (0-1) of each skymap pixel. it is computed once, and
+        with cache=True kept in the TMCache. multi-order skymaps are painted onto a grid of at most CONTOUR_NSIDE
+        '''
+        if self.is_multiorder:
+            return self.skymap.rasterize(min(self.skymap_nside, CONTOUR_NSIDE), values=self.skymap.credible_levels())
+        return self._credible_levels_and_sort()[0]
+
+
+    def renormalized_contours(self) -> str:
+        '''
+        50/90 credible contours of the renormalized skymap as a GeoJSON FeatureCollection
+        '''
+        normed_skymap = self.renormalized_skymap()
+        if self.is_multiorder:
+            cls = normed_skymap.rasterize(min(normed_skymap.nside, CONTOUR_NSIDE), values=normed_skymap.credible_levels()) * 100
+        else:
+            #the uncovered pixels keep the skymap's ranking, so its sort is reused and the covered pixels go last
+            sort = self._credible_levels_and_sort()[1]
+            cls = np.empty_like(normed_skymap)
+            cls[sort] = np.cumsum(normed_skymap[sort]) * 100
+            cls[self.coverage(inclusive=False).mask] = 100
+        paths = list(ligo.skymap.postprocess.contour(cls, [50, 90], nest=False, degrees=True, simplify=True))
+
+        contours_json = json.dumps({
+            'type': 'FeatureCollection',
+            'features': [
+                {
+                    'type': 'Feature',
+                    'properties': {
+                        'credible_level': contour
+                    },
+                    'geometry': {
+                        'type': 'MultiLineString',
+                        'coordinates': path
+                    }
+                }
+                for contour, path in zip([50,90], paths)
+            ]
+        })
+        return contours_json
+
+
+    def plot(self, projection='astro hours mollweide') -> None:
+
+        #set up the plot
+        subplot_kw = {
+            'projection': projection,
+            #'center': SkyCoord(alert_info.avgra, alert_info.avgdec, unit="deg")
+        }
+        fig, ax = plt.subplots(1, 1, layout="constrained", subplot_kw=subplot_kw)
+        ax.grid()
+
+        #plot each of the instrument footprints
+        for enumeration, (i, polygon_arr) in enumerate(self.polygons.items()):
+            inst_footprint = self.instrument(i)
+
+            for j,arr in enumerate(polygon_arr):
+                if j == 0:
+                    label = inst_footprint.nickname if inst_footprint.nickname is not None else inst_footprint.instrument_name
+                else:
+                    label = None
+
+                #cut_dateline(arr)[0]
+                poly = Polygon(
+                    np.asarray(arr), 
+                    transform=ax.get_transform('world'),
+                    edgecolor=instrument_color(enumeration), 
+                    facecolor='None', 
+                    linewidth=0.5, 
+                    alpha=1.0,
+                    zorder=9900,
+                    label=label
+                )
+                ax.add_patch(poly)
+
+        #plot thee 90/50 contoturs
+        for contour_polygon in self.contour_polygons:
+            poly = Polygon(
+                np.asarray([(x[0], x[1]) for x in contour_polygon]), 
+                transform=ax.get_transform('world'),
+                edgecolor='r', 
+                facecolor='None', 
+                linewidth=0.5,
+                alpha=1.0,
+                zorder=9900
             )
-            if cached_footprints:
-                polygon_arr.extend(
-                    cached_footprints
+            ax.add_patch(poly)
+
+        #plot the skymap:
+        if self.skymap is not None:
+
+            _90_50_levels = self.credible_levels()
+            ax.contourf_hpx(
+                _90_50_levels, 
+                cmap='OrRd_r', 
+                levels=[0.0, 0.5, 0.9], 
+                alpha=0.75
+            )
+
+        plt.legend(bbox_to_anchor=(0, 0), loc="lower left",
+                    bbox_transform=fig.transFigure,  ncol=4)
+        plt.title(f"Reported Coverage for {self.graceid}")
+        plt.show()
+
+
+    def candidate_pointings(self, candidate: Candidate, distance_thresh: float = 5.0) -> List[Pointing]:
+        '''
+        returns the pointings centered within distance_thresh (deg) of the candidate that have it in their FOV
+        '''
+        return self.batch_candidate_pointings([candidate], distance_thresh=distance_thresh)[candidate]
+
+
+    def batch_candidate_pointings(self, candidates: List[Candidate], distance_thresh: float = 5.0,
+        pairs: Tuple[np.ndarray, np.ndarray] = None) -> Dict[Candidate, List[Pointing]]:
+        '''
+        returns {candidate: pointings centered within distance_thresh (deg) of the candidate that have it in their FOV}
+        the edge normals of every projected ccd are computed once per instrument, and every nearby
+        (candidate, pointing) pair is tested against the ccds of its pointing in one vectorized step
+
+        pairs: (candidate indices, indices into the pointings) of the nearby pairs, when they are already
+            known, e.g. from a PointingIndex. default = a cone search of distance_thresh around each candidate
+        '''
+
+        candidate_ra = np.asarray([x.ra for x in candidates], dtype=float)
+        candidate_dec = np.asarray([x.dec for x in candidates], dtype=float)
+
+        if pairs is None:
+            index = PointingIndex(self.pointings)
+            nearby = [index.cone_search_indices(ra, dec, distance_thresh) for ra, dec in zip(candidate_ra, candidate_dec)]
+            pair_candidates = np.repeat(np.arange(len(candidates)), [len(x) for x in nearby])
+            pair_pointings = np.concatenate(nearby) if len(nearby) else np.empty(0, dtype=np.int64)
+        else:
+            pair_candidates, pair_pointings = [np.asarray(x, dtype=np.int64) for x in pairs]
+
+        #the instrument of each pointing, and its position in instrument_pointings
+        instrument_of = np.asarray([x.instrumentid for x in self.pointings])
+        position = np.empty(len(self.pointings), dtype=np.int64)
+
+        covered = [set() for _ in candidates]
+        for i in self.instrument_ids:
+            members = np.flatnonzero(instrument_of == i)
+            position[members] = np.arange(len(members))
+            selected = np.isin(pair_pointings, members)
+            if not selected.any():
+                continue
+
+            #(pointings, ccds, vertices, 3)
+            n_ccds = len(self.polygons[i]) // len(members)
+            normals = polygon_edge_normals(self.polygons[i])
+            normals = normals.reshape(len(members), n_ccds, *normals.shape[1:])
+
+            k, j = pair_candidates[selected], pair_pointings[selected]
+            for chunk in range(0, len(k), CANDIDATE_PAIR_CHUNK):
+                kk, jj = k[chunk:chunk + CANDIDATE_PAIR_CHUNK], j[chunk:chunk + CANDIDATE_PAIR_CHUNK]
+                inside = paired_points_in_polygons(candidate_ra[kk], candidate_dec[kk], normals[position[jj]]).any(axis=1)
+                for candidate_index, pointing_index in zip(kk[inside], jj[inside]):
+                    covered[candidate_index].add(pointing_index)
+
+        return {
+            candidate: [self.pointings[j] for j in sorted(pointing_indices)]
+            for candidate, pointing_indices in zip(candidates, covered)
+        }
+
+
+    def timeline(self, time_of_signal: datetime.datetime = None, per_instrument=False) -> dict:
+        '''
+        cumulative coverage versus time, in one pass over the pointings sorted by Pointing.time.
+        each pointing only adds the pixels it newly covers to the running probability and area.
+
+        inputs:
+            time_of_signal: datetime - zero point of the elapsed time. default = the event's time_of_signal
+            per_instrument: bool - also return a curve for each instrument on its own
+
+        returns {
+            "hours": elapsed hours of each pointing, "probability": cumulative probability,
+            "area": cumulative area (deg^2), "pointing_ids": ids in time order,
+            "instruments": {instrument_id: {"hours", "probability", "area", "pointing_ids"}} (if per_instrument)
+        }
+        '''
+        self._flat_skymap_required("timeline")
+        if time_of_signal is None:
+            time_of_signal = Alert.get(graceid=self.graceid, api_token=self.api_token, cache=self.cache).time_of_signal
+
+        timed_polygons = []
+        for i in self.instrument_ids:
+            for pointing, polygons in zip(self.instrument_pointings(i), self.pointing_polygons(i)):
+                timed_polygons.append((pointing, polygons))
+        timed_polygons.sort(key=lambda x: x[0].time)
+
+        timeline = self._cumulative_coverage(timed_polygons, time_of_signal, CoverageMask(self.skymap_nside))
+
+        if per_instrument:
+            #one scratch mask, cleared between instruments, instead of a mask per instrument
+            scratch = CoverageMask(self.skymap_nside)
+            timeline["instruments"] = {}
+            for i in self.instrument_ids:
+                scratch.mask[:] = False
+                timeline["instruments"][i] = self._cumulative_coverage(
+                    [x for x in timed_polygons if x[0].instrumentid == i], time_of_signal, scratch
                 )
 
-        inst_footprint = [x for x in inst_footprints if x.id == i][0]
-        
-        if len(polygon_arr) == 0:
-            for p in instrument_pointings:
-                projected_footprint = inst_footprint.project(p.ra, p.dec, p.pos_angle)
-                for ccd in projected_footprint:
-                    ra_deg, dec_deg = zip(*[(coord_deg[0], coord_deg[1])
-                                            for coord_deg in ccd])
-                    
-                    list_o_coords = []
-                    for x, y in zip(ra_deg, dec_deg):
-                        list_o_coords.append((x, y))
-                    polygon_arr.append(list_o_coords)
+        return timeline
+
+
+    def _cumulative_coverage(self, timed_polygons: list, time_of_signal: datetime.datetime, coverage: CoverageMask) -> dict:
+        pixarea = hp.nside2pixarea(coverage.nside, degrees=True)
+        hours = np.empty(len(timed_polygons))
+        probs = np.empty(len(timed_polygons))
+        areas = np.empty(len(timed_polygons))
+
+        prob, n_pixels = 0.0, 0
+        for k, (pointing, polygons) in enumerate(timed_polygons):
+            for arr in polygons:
+                new_pixels = coverage.add_polygon(arr, inclusive=True)
+                prob += float(np.sum(self.skymap[new_pixels]))
+                n_pixels += len(new_pixels)
+
+            hours[k] = (pointing.time - time_of_signal).total_seconds()/3600
+            probs[k] = prob
+            areas[k] = n_pixels * pixarea
 
+        return {
+            "hours": hours,
+            "probability": probs,
+            "area": areas,
+            "pointing_ids": np.asarray([x[0].id for x in timed_polygons])
+        }
+
+
+class CoverageState():
+    '''
+    The covered pixels of an event's skymap and the ids of the pointings already ingested into them.
+    update() only projects and pixelizes the pointings it has not seen, and keeps a running probability
+    and pixel count, so the cost of an update is proportional to the new pointings. The coverage is
+    also kept as a MOC that each update extends by its new pixels, which is what save() persists, and
+    the instruments are kept so an update only fetches the ones it has not seen.
+
+    inputs:
+        graceid: str - the GW event
+        skymap: np.ndarray - the event's skymap
+        approximate: bool - use the approximated instrument footprints
+    '''
+
+    def __init__(self, graceid: str, skymap: np.ndarray, approximate=True, pointing_ids: List[int] = [],
+        coverage: CoverageMask = None, moc: MOC = None):
+        self.graceid = graceid
+        self.skymap = skymap
+        self.approximate = approximate
+        self.pointing_ids = set(pointing_ids)
+        self.order = hp.nside2order(hp.npix2nside(len(skymap)))
+        if moc is None:
+            moc = MOC() if coverage is None else MOC.from_pixels(coverage.pixels(), self.order, nest=False)
+        self.coverage = coverage if coverage is not None else CoverageMask(hp.npix2nside(len(skymap)))
+        self.moc = moc
+        self.instruments = {}
+        self.saved = True
+
+        self.prob = self.coverage.probability(skymap)
+        self.n_pixels = self.coverage.count()
+
+
+    def area(self) -> float:
+        return self.n_pixels * hp.nside2pixarea(self.coverage.nside, degrees=True)
+
+
+    def update(self, api_token: str, pointings: List[Pointing]) -> Tuple[float, float]:
+        '''
+        ingest the pointings that have not been seen yet
+        returns the updated (probability, area)
+        '''
+        new_pointings = [x for x in pointings if x.id is None or x.id not in self.pointing_ids]
+        if len(new_pointings) == 0:
+            return self.prob, self.area()
+
+        instrument_ids = set([x.instrumentid for x in new_pointings])
+        missing = [x for x in new_pointings if x.instrumentid not in self.instruments]
+        if len(missing):
+            fetched = CoverageEngine(
+                api_token=api_token, graceid=self.graceid, pointings=missing, approximate=self.approximate, skymap=self.skymap
+            ).instruments
+            self.instruments.update({x.id: x for x in fetched})
+
+        engine = CoverageEngine(
+            api_token=api_token, graceid=self.graceid, pointings=new_pointings, approximate=self.approximate, skymap=self.skymap,
+            instruments=[self.instruments[i] for i in instrument_ids]
+        )
+        new_pixels = []
+        for polygon_arr in engine.polygons.values():
+            for arr in polygon_arr:
+                new_pixels.append(self.coverage.add_polygon(arr, inclusive=True))
+                self.prob += float(np.sum(self.skymap[new_pixels[-1]]))
+                self.n_pixels += len(new_pixels[-1])
+
+        if len(new_pixels):
+            self.moc = self.moc.union(MOC.from_pixels(np.concatenate(new_pixels), self.order, nest=False))
+        self.pointing_ids.update([x.id for x in new_pointings if x.id is not None])
+        self.saved = False
+        return self.prob, self.area()
+
+
+    def _cache(self) -> TMCache:
+        return TMCache(
+            filename=f"coverage_state_{self.graceid}_{self.approximate}.npz", cache_type="npz", graceid=self.graceid
+        )
+
+
+    def save(self):
+        '''
+        persist the MOC and the pointing ids, when an update has changed them since the last save.
+        the state saved by another process since this one was loaded is merged in first, so
+        concurrent updates of one event never drop each other's pointings
+        '''
+        if self.saved:
+            return
+        cache = self._cache()
+        with cache.lock():
+            self.merge(cache.get())
+            cache.put(payload={
+                "nside": np.asarray([self.coverage.nside]),
+                "pointing_ids": np.asarray(sorted(self.pointing_ids), dtype=np.int64),
+                **self.moc.to_payload()
+            }, overwrite=True)
+        self.saved = True
+
+
+    def merge(self, payload):
+        '''
+        add the coverage and pointing ids of a saved state to this one. a state pixelized at
+        another resolution belongs to a different skymap, and is ignored
+        '''
+        if payload is None or payload["nside"][0] != self.coverage.nside:
+            return
+        saved = MOC.from_payload(payload)
+        new_pixels = self.coverage.add((saved - self.moc).pixels(self.order, nest=False))
+        self.prob += float(np.sum(self.skymap[new_pixels]))
+        self.n_pixels += len(new_pixels)
+        self.moc = self.moc.union(saved)
+        self.pointing_ids.update(payload["pointing_ids"].tolist())
+
+
+    @staticmethod
+    def load(api_token: str, graceid: str, cache=False, approximate=True) -> CoverageState:
+        '''
+        the event's coverage state from this process, or the TMCache, or a new empty one
+        '''
+        key = (graceid, approximate)
+        with _COVERAGE_STATES_LOCK:
+            if key in _COVERAGE_STATES:
+                return _COVERAGE_STATES[key]
+
+        skymap = Alert.fetch_skymap(graceid=graceid, api_token=api_token, cache=cache)
+        state = CoverageState(graceid=graceid, skymap=skymap, approximate=approximate)
         if cache:
-            Footprint.put_cached_footprints(
-                polygon_arr,
-                graceid=graceid,
-                instrument_id=i,
-                pointings=instrument_pointings
-            )
+            state.merge(state._cache().get())
+
+        #a state loaded by another thread meanwhile is kept, so every caller shares one
+        with _COVERAGE_STATES_LOCK:
+            return _COVERAGE_STATES.setdefault(key, state)
+
+
+    @staticmethod
+    def clear(graceid: str = None):
+        with _COVERAGE_STATES_LOCK:
+            for key in [x for x in _COVERAGE_STATES.keys() if graceid is None or x[0] == graceid]:
+                del _COVERAGE_STATES[key]
+
 
-        for j,arr in enumerate(polygon_arr):
-            ras_poly = [x[0] for x in arr][:-1]
-            decs_poly = [x[1] for x in arr][:-1]
-            xyzpoly = astropy.coordinates.spherical_to_cartesian(1, np.deg2rad(decs_poly), np.deg2rad(ras_poly))
-            qp = hp.query_polygon(skymap_nside,np.array(xyzpoly).T)
-            qps.extend(qp)
+def plot_coverage(api_token: str, graceid: str, pointings: List[Pointing] = [],
+    cache=False, projection='astro hours mollweide', multiorder=False, sparse: float = None, resolution: int = None,
+    skymap=None) -> None:
 
-            deduped_indices=list(dict.fromkeys(qps))
+    engine = CoverageEngine(
+        api_token=api_token, graceid=graceid, pointings=pointings, cache=cache,
+        multiorder=multiorder, sparse=sparse, resolution=resolution, skymap=skymap
+    )
+    engine.plot(projection=projection)
 
-    skymap[deduped_indices] = 0
-    normed_skymap = skymap/np.sum(skymap)
 
-    return normed_skymap
+def calculate_coverage(api_token: str, graceid: str, pointings: List[Pointing] = [],
+    cache=False, approximate=True, workers: int = None, multiorder=False, sparse: float = None, resolution: int = None,
+    skymap=None) -> Tuple[float, float]:
+
+    engine = CoverageEngine(
+        api_token=api_token, graceid=graceid, pointings=pointings, cache=cache, approximate=approximate, workers=workers,
+        multiorder=multiorder, sparse=sparse, resolution=resolution, skymap=skymap
+    )
+    return engine.probability(), engine.area()
+
+
+def renormalize_skymap(api_token: str, graceid: str, pointings: List[Pointing] = [],
+    cache=False, workers: int = None, multiorder=False, sparse: float = None, resolution: int = None, skymap=None) -> Any:
+
+    engine = CoverageEngine(
+        api_token=api_token, graceid=graceid, pointings=pointings, cache=cache, workers=workers,
+        multiorder=multiorder, sparse=sparse, resolution=resolution, skymap=skymap
+    )
+    return engine.renormalized_skymap()
+
 
 def renormed_skymap_contours(api_token: str, graceid: str, pointings: List[Pointing] = [],
-    cache=False) -> Any:
-
-    normed_skymap = renormalize_skymap(api_token=api_token, graceid=graceid, pointings=pointings, cache=cache)
-
-    i = np.flipud(np.argsort(normed_skymap))
-    cumsum = np.cumsum(normed_skymap[i])
-    cls = np.empty_like(normed_skymap)
-    cls[i] = cumsum * 100
-    paths = list(ligo.skymap.postprocess.contour(cls, [50, 90], nest=False, degrees=True, simplify=True))
-
-    contours_json = json.dumps({
-        'type': 'FeatureCollection',
-        'features': [
-            {
-                'type': 'Feature',
-                'properties': {
-                    'credible_level': contour
-                },
-                'geometry': {
-                    'type': 'MultiLineString',
-                    'coordinates': path
-                }
-            }
-            for contour, path in zip([50,90], paths)
-        ]
-    })
-    return contours_json
+    cache=False, workers: int = None, multiorder=False, sparse: float = None, resolution: int = None, skymap=None) -> Any:
+
+    engine = CoverageEngine(
+        api_token=api_token, graceid=graceid, pointings=pointings, cache=cache, workers=workers,
+        multiorder=multiorder, sparse=sparse, resolution=resolution, skymap=skymap
+    )
+    return engine.renormalized_contours()
 
 
 def candidate_coverage(api_token: str, candidate: Candidate, pointings: List[Pointing] = None, distance_thresh: float = 5.0) -> List[Pointing]:
@@ -351,66 +927,102 @@ def candidate_coverage(api_token: str, candidate: Candidate, pointings: List[Poi
     returns all pointings associated with the graceid that have had that candidate in its FOV
     '''
 
-    #set an arbitarily high nside
-    skymap_nside = 1024
-    #find our candidates healpix
-    candidate_healpix = hp.ang2pix(skymap_nside, candidate.ra, candidate.dec, lonlat=True, nest=True)
+    return batch_candidate_coverage(
+        api_token=api_token, candidates=[candidate], pointings=pointings, distance_thresh=distance_thresh
+    )[candidate]
 
-    #query for all pointings
-    if not pointings:
-        pointings = Pointing.get(api_token=api_token, graceid=candidate.graceid)
 
-    #convert them a pandas dataframe for vectorized distance culling
-    pointings_df = pd.DataFrame([x.__dict__ for x in pointings])
+def update_coverage(api_token: str, graceid: str, pointings: List[Pointing] = [],
+    cache=False, approximate=True) -> Tuple[float, float]:
+    '''
+    inputs:
+        api_token: str - valid GWTM api_token
+        graceid: str - the GW event
+        pointings: List[Pointing] - the event's pointings so far. default = all completed pointings for the graceid
+        cache: bool - persist the coverage state in the TMCache between processes
+        approximate: bool - use the approximated instrument footprints
+
+    incremental calculate_coverage for an active event. only the pointings that have not been
+    ingested by a previous call are projected and pixelized.
+    returns the total (probability, area) covered by all ingested pointings
+    '''
+    state = CoverageState.load(api_token=api_token, graceid=graceid, cache=cache, approximate=approximate)
+
+    if len(pointings) == 0:
+        pointings = Pointing.get(graceid=graceid, api_token=api_token, status='completed')
 
-    #calculate the distance for each pointing from the candidate, and cull them
-    pointings_df["_DIST"] = gc_dist(
-        pointings_df["ra"], pointings_df["dec"], candidate.ra, candidate.dec
-    )
-    culled_pointings = pointings_df.loc[pointings_df["_DIST"] < distance_thresh]
+    prob, area = state.update(api_token=api_token, pointings=pointings)
+    if cache:
+        state.save()
 
-    #return nothing if there aren't any pointings associated
-    if len(culled_pointings) == 0:
-        return []
+    return prob, area
 
-    #grab the instrument information for each pointing
-    instrument_ids = culled_pointings["instrumentid"].values.tolist()
-    instruments = Instrument.get(api_token=api_token, ids=instrument_ids, include_footprint=True)
 
-    vals = zip(
-        culled_pointings["ra"].values,
-        culled_pointings["dec"].values,
-        culled_pointings["pos_angle"].values,
-        culled_pointings["id"].values,
-        culled_pointings["instrumentid"].values
+def coverage_timeline(api_token: str, graceid: str, pointings: List[Pointing] = [],
+    cache=False, approximate=True, per_instrument=False, resolution: int = None) -> dict:
+    '''
+    inputs:
+        api_token: str - valid GWTM api_token
+        graceid: str - the GW event
+        pointings: List[Pointing] - pointings to evaluate. default = all completed pointings for the graceid
+        cache: bool - use the local TMCache for the skymap and projected footprints
+        approximate: bool - use the approximated instrument footprints
+        per_instrument: bool - also return a curve for each instrument on its own
+        resolution: int - nside that is fine enough, see CoverageEngine
+
+    returns arrays of the hours since the event's time_of_signal, cumulative probability and cumulative
+    area (deg^2) after each pointing, computed in a single time ordered pass. see CoverageEngine.timeline
+    '''
+    engine = CoverageEngine(
+        api_token=api_token, graceid=graceid, pointings=pointings, cache=cache, approximate=approximate, resolution=resolution
     )
+    return engine.timeline(per_instrument=per_instrument)
+
+
+def batch_candidate_coverage(api_token: str, candidates: List[Candidate], pointings: List[Pointing] = None,
+    distance_thresh: float = 5.0) -> Dict[Candidate, List[Pointing]]:
+    '''
+    inputs:
+        api_token: str - valid GWTM api_token
+        candidates: List[Candidate] - the candidates you want to evaluate the coverage for
+        pointings: List[Pointing] - you can query for your own pointings to evaluate the coverage.
+            default = all pointings of each candidate's graceid
+        distance_threshold: float - distance in degrees. Only evaluate the pointings that are this distance from a candidate. default = 5.0 (deg)
+
+    candidate_coverage for many candidates. the pointings and instruments are fetched once per graceid,
+    and the footprints of the pointings near any candidate are projected once.
+    returns {candidate: all pointings that have had that candidate in its FOV}
+    '''
 
-    return_ids = []
-
-    #iterate over our pointing values
-    for pra, pdec, ppos_angle, pid, pinstid in vals:
-        #project the instrument footprint for each pointing
-        instrument = [x for x in instruments if x.id == pinstid][0]
-        projected = instrument.project(pra, pdec, ppos_angle)
-
-        #prepare the polygon for hp.query_polygon
-        polygon_arr = []
-        for ccd in projected:
-            ra_deg, dec_deg = zip(*[(coord_deg[0], coord_deg[1])
-                                    for coord_deg in ccd])
-            
-            list_o_coords = []
-            for x, y in zip(ra_deg, dec_deg):
-                list_o_coords.append((x, y))
-            polygon_arr.append(list_o_coords)
-        
-        #query the polygons and append the pointing.id if the healpix pixel is in the polygon query
-        for j,arr in enumerate(polygon_arr):
-            ras_poly = [x[0] for x in arr][:-1]
-            decs_poly = [x[1] for x in arr][:-1]
-            xyzpoly = astropy.coordinates.spherical_to_cartesian(1, np.deg2rad(decs_poly), np.deg2rad(ras_poly))
-            qp = hp.query_polygon(skymap_nside,np.array(xyzpoly).T, nest=True)
-            if candidate_healpix in qp:
-                return_ids.append(pid)
-    #so she goes
-    return [x for x in pointings if x.id in return_ids]
\ No newline at end of file
+    if pointings:
+        candidate_groups = {None: candidates}
+    else:
+        candidate_groups = {}
+        for candidate in candidates:
+            candidate_groups.setdefault(candidate.graceid, []).append(candidate)
+
+    ret = {}
+    for graceid, group in candidate_groups.items():
+        group_pointings = pointings if pointings else Pointing.get(api_token=api_token, graceid=graceid)
+        if len(group_pointings) == 0:
+            ret.update({candidate: [] for candidate in group})
+            continue
+
+        #the index is built once, and only the pointings near any of the candidates are projected
+        index = PointingIndex(group_pointings)
+        nearby = [index.cone_search_indices(candidate.ra, candidate.dec, distance_thresh) for candidate in group]
+        pair_candidates = np.repeat(np.arange(len(group)), [len(x) for x in nearby])
+        pair_pointings = np.concatenate(nearby) if len(nearby) else np.empty(0, dtype=np.int64)
+        if len(pair_pointings) == 0:
+            ret.update({candidate: [] for candidate in group})
+            continue
+
+        culled, pair_pointings = np.unique(pair_pointings, return_inverse=True)
+        culled_pointings = [group_pointings[j] for j in culled]
+
+        engine = CoverageEngine(api_token=api_token, graceid=graceid or group[0].graceid, pointings=culled_pointings)
+        ret.update(engine.batch_candidate_pointings(
+            group, distance_thresh=distance_thresh, pairs=(pair_candidates, pair_pointings.reshape(-1))
+        ))
+
+    return ret
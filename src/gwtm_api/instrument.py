@@ -2,6 +2,7 @@ from __future__ import annotations
 import datetime
 import json
 import hashlib
+import threading
 from typing import List
 import numpy as np
 
@@ -18,6 +19,10 @@ APPROXIMATION_DICT = {
     38 : 98, #DECAM
 }
 
+#footprints never change for an instrument, so they are downloaded once per process
+_FOOTPRINT_REGISTRY = {}
+_FOOTPRINT_REGISTRY_LOCK = threading.Lock()
+
 class Footprint(apimodels._Table):
     id = None
     footprint = None
@@ -39,11 +44,19 @@ class Footprint(apimodels._Table):
 
  
     @staticmethod
-    def get(api_token: str, instrumentid: int, approximate_footprint: bool = True):
+    def get(api_token: str, instrumentid: int, approximate_footprint: bool = True, use_registry: bool = True,
+        cache: bool = False):
+
+        approximated = approximate_footprint and instrumentid in APPROXIMATION_DICT.keys()
+        registry_key = (instrumentid, approximated)
+        if use_registry:
+            with _FOOTPRINT_REGISTRY_LOCK:
+                if registry_key in _FOOTPRINT_REGISTRY:
+                    return list(_FOOTPRINT_REGISTRY[registry_key])
 
         api = baseapi.api(target="footprints")
 
-        if approximate_footprint and instrumentid in APPROXIMATION_DICT.keys():
+        if approximated:
             inst_id = APPROXIMATION_DICT[instrumentid]
         else:
             inst_id = instrumentid
@@ -57,8 +70,10 @@ class Footprint(apimodels._Table):
             "d_json": get_dict
         }
 
-        req = api._get(r_json=r_json)
-        request_json = json.loads(req.text)
+        status_code, request_json = api._get_json(r_json=r_json, cache=cache)
+        if status_code != 200:
+            raise Exception(f"Error in Footprint.get(). Request: {request_json[0:1000]}")
+
         inst_footprints = []
         for f in request_json:
             if isinstance(f, str):
@@ -67,7 +82,25 @@ class Footprint(apimodels._Table):
                 footprint_json = f
             inst_footprints.append(Footprint(kwdict=footprint_json))
 
-        return inst_footprints
+        if use_registry:
+            with _FOOTPRINT_REGISTRY_LOCK:
+                _FOOTPRINT_REGISTRY[registry_key] = inst_footprints
+
+        return list(inst_footprints)
+
+
+    @staticmethod
+    def clear_registry():
+        with _FOOTPRINT_REGISTRY_LOCK:
+            _FOOTPRINT_REGISTRY.clear()
+
+
+    @staticmethod
+    async def get_async(*args, **kwargs) -> List[Footprint]:
+        '''
+            Awaitable Footprint.get, run on the shared connection pool
+        '''
+        return await baseapi.run_async(Footprint.get, *args, **kwargs)
 
 
     def sanatize_polygon(self):
@@ -81,24 +114,30 @@ class Footprint(apimodels._Table):
         self.polygon = polygon
 
 
+    def uvecs(self) -> np.ndarray:
+        '''
+            zero-centered footprint vertices as unit vectors, shape (n_vertices, 3)
+        '''
+        polygon = np.asarray(self.polygon, dtype=float)
+        return np.stack(util.ra_dec_to_uvec(polygon[:, 0], polygon[:, 1]), axis=-1)
+
+
+    def project_batch(self, ra, dec, pos_angle) -> np.ndarray:
+        '''
+            project the footprint onto arrays of pointing centers
+            returns an ndarray of (ra, dec) vertices with shape (n_pointings, n_vertices, 2)
+        '''
+        rotations = util.rotation_matrices(ra, dec, pos_angle)
+        projected = np.einsum('vi,nij->nvj', self.uvecs(), rotations)
+        return np.stack(util.uvecs_to_ra_dec(projected), axis=-1)
+
+
     def project(self, ra: float, dec: float, pos_angle: float):
         if pos_angle is None:
             pos_angle = 0.0
 
-        footprint_zero_center_ra = np.asarray([pt[0] for pt in self.polygon])
-        footprint_zero_center_dec = np.asarray([pt[1] for pt in self.polygon])
-        footprint_zero_center_uvec = util.ra_dec_to_uvec(footprint_zero_center_ra, footprint_zero_center_dec)
-        footprint_zero_center_x, footprint_zero_center_y, footprint_zero_center_z = footprint_zero_center_uvec
-
-        proj_footprint = []
-        for idx in range(footprint_zero_center_x.shape[0]):
-            vec = np.asarray([footprint_zero_center_x[idx], footprint_zero_center_y[idx], footprint_zero_center_z[idx]])
-            new_vec = vec @ util.x_rot(-pos_angle) @ util.y_rot(dec) @ util.z_rot(-ra)
-            new_x, new_y, new_z = new_vec.flat
-            pt_ra, pt_dec = util.uvec_to_ra_dec(new_x, new_y, new_z)
-            proj_footprint.append([round(pt_ra, 3), round(pt_dec, 3)])
-
-        return proj_footprint
+        proj_footprint = np.round(self.project_batch(ra, dec, pos_angle)[0], 3)
+        return proj_footprint.tolist()
 
 
     @staticmethod
@@ -106,7 +145,7 @@ class Footprint(apimodels._Table):
         pointingids = [x.id for x in pointings]
         hashpointingids =  hashlib.sha1(json.dumps(pointingids).encode()).hexdigest()
         cache_name = f"footprints_{graceid}_{instrument_id}_{hashpointingids}"
-        cache = tmcache.TMCache(filename=cache_name, cache_type="json")
+        cache = tmcache.TMCache(filename=cache_name, cache_type="json", graceid=graceid)
         return cache.get()
 
     @staticmethod
@@ -114,7 +153,7 @@ class Footprint(apimodels._Table):
         pointingids = [x.id for x in pointings]
         hashpointingids =  hashlib.sha1(json.dumps(pointingids).encode()).hexdigest()
         cache_name = f"footprints_{graceid}_{instrument_id}_{hashpointingids}"
-        cache = tmcache.TMCache(filename=cache_name, cache_type="json")
+        cache = tmcache.TMCache(filename=cache_name, cache_type="json", graceid=graceid)
         cache.put(payload=footprints)
 
 
@@ -147,13 +186,37 @@ class Instrument(apimodels._Table):
         super().__init__(payload=selfdict)
 
     
+    def project_batch(self, ra, dec, pos_angle) -> np.ndarray:
+        '''
+            project every ccd of the footprint onto arrays of pointing centers with a single einsum
+            returns an ndarray of (ra, dec) vertices with shape (n_pointings, n_ccds, n_vertices, 2)
+            ccds with fewer vertices than the largest are padded with nan
+        '''
+        if self.footprint is None:
+            raise Exception("Footprint Polygon is not included")
+
+        ccd_uvecs = [ccd.uvecs() for ccd in self.footprint]
+        n_vertices = max([x.shape[0] for x in ccd_uvecs])
+        uvecs = np.full((len(ccd_uvecs), n_vertices, 3), np.nan)
+        for i, ccd in enumerate(ccd_uvecs):
+            uvecs[i, :ccd.shape[0]] = ccd
+
+        rotations = util.rotation_matrices(ra, dec, pos_angle)
+        projected = np.einsum('cvi,nij->ncvj', uvecs, rotations)
+        return np.stack(util.uvecs_to_ra_dec(projected), axis=-1)
+
+
     def project(self, ra: float, dec: float, pos_angle: float):
         if self.footprint is None:
             raise Exception("Footprint Polygon is not included")
-        
+        if pos_angle is None:
+            pos_angle = 0.0
+
+        projected = np.round(self.project_batch(ra, dec, pos_angle)[0], 3)
+
         proj_footprint = []
-        for ccd in self.footprint:
-            proj_footprint.append(ccd.project(ra, dec, pos_angle))
+        for ccd, proj_ccd in zip(self.footprint, projected):
+            proj_footprint.append(proj_ccd[:len(ccd.polygon)].tolist())
 
         return proj_footprint
 
@@ -162,8 +225,12 @@ class Instrument(apimodels._Table):
     def get(
             api_token: str, id: int = None, ids: List[int] = None, name: str = None,
             names: List[str] = None, type: apimodels.instrument_type = None,
-            include_footprint=False, approximate_footprint=True, urlencode=False
+            include_footprint=False, approximate_footprint=True, urlencode=False, cache=False
         ) -> List[Instrument]:
+        '''
+            cache: bool - keep the response, and the footprints with include_footprint, in the TMCache.
+                revalidated with the server after baseapi.CACHE_TTLS["instruments"] seconds
+        '''
         get_dict = util.non_none_locals(locals=locals())
 
         r_json = {
@@ -171,11 +238,10 @@ class Instrument(apimodels._Table):
         }
 
         api = baseapi.api(target="instruments")
-        req = api._get(r_json=r_json, urlencode=urlencode)
+        status_code, request_json = api._get_json(r_json=r_json, urlencode=urlencode, cache=cache)
 
         ret = []
-        if req.status_code == 200:
-            request_json = json.loads(req.text)
+        if status_code == 200:
             for i in request_json:
                 if isinstance(i, str):
                     instrument_json = json.loads(i)
@@ -183,13 +249,26 @@ class Instrument(apimodels._Table):
                     instrument_json = i
                 ret.append(Instrument(kwdict=instrument_json))
         else:
-            raise Exception(f"Error in Instrument.get(). Request: {req.text[0:1000]}")
+            raise Exception(f"Error in Instrument.get(). Request: {request_json[0:1000]}")
         
         if include_footprint:
-            for inst in ret:
-                inst.footprint = Footprint.get(
-                    api_token=api_token, instrumentid=inst.id, approximate_footprint=approximate_footprint
-                )
+            #the footprints endpoint takes a single id, so fetch them concurrently
+            footprints = baseapi.map_concurrent(
+                lambda inst: Footprint.get(
+                    api_token=api_token, instrumentid=inst.id, approximate_footprint=approximate_footprint, cache=cache
+                ),
+                ret
+            )
+            for inst, footprint in zip(ret, footprints):
+                inst.footprint = footprint
 
         return ret
-        
\ No newline at end of file
+        
+
+
+    @staticmethod
+    async def get_async(*args, **kwargs) -> List[Instrument]:
+        '''
+            Awaitable Instrument.get, run on the shared connection pool
+        '''
+        return await baseapi.run_async(Instrument.get, *args, **kwargs)
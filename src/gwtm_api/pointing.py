@@ -183,7 +183,12 @@ class Pointing(apimodels._Table):
             frequency_regime: List[float] = None, frequency_unit: apimodels.frequency_units = None,
             depth_gt: float = None, depth_lt: float = None, depth_unit: apimodels.depth_unit = None,
             base: str = "https://treasuremap.space/api/", api_version: str ="v1", urlencode: bool = False, 
+            cache: bool = False
         ) -> List[Pointing]:
+        '''
+            cache: bool - keep the response in the TMCache (memory and disk), keyed by the query.
+                it is served for baseapi.CACHE_TTLS["pointings"] seconds, then revalidated with the server
+        '''
 
         get_dict = util.non_none_locals(locals=locals())
 
@@ -192,11 +197,10 @@ class Pointing(apimodels._Table):
         }
 
         api = baseapi.api(target="pointings", base=base, api_version=api_version)
-        req = api._get(r_json=r_json, urlencode=urlencode)
+        status_code, request_json = api._get_json(r_json=r_json, urlencode=urlencode, cache=cache)
 
-        if req.status_code == 200:
+        if status_code == 200:
             ret: List[Pointing] = []
-            request_json = json.loads(req.text)
             for p in request_json:
                 if 'v0' in api.base:
                     pointing_json = json.loads(p)
@@ -205,7 +209,15 @@ class Pointing(apimodels._Table):
                 ret.append(Pointing(kwdict=pointing_json))
             return ret
         else:
-            raise Exception(f"Error in Pointing.get(). Request: {req.text[0:1000]}")
+            raise Exception(f"Error in Pointing.get(). Request: {request_json[0:1000]}")
+
+
+    @staticmethod
+    async def get_async(*args, **kwargs) -> List[Pointing]:
+        '''
+            Awaitable Pointing.get, run on the shared connection pool
+        '''
+        return await baseapi.run_async(Pointing.get, *args, **kwargs)
         
     
     @staticmethod
@@ -0,0 +1,293 @@
+import sys
+import os
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../src'))
+
+import pytest
+
+from gwtm_api import Pointing, Candidate, Instrument, Footprint, Alert
+from gwtm_api.core import baseapi
+
+
+class _Handler(BaseHTTPRequestHandler):
+    '''
+        answers every request with server.respond(handler) -> (status, headers, body),
+        over keep-alive connections
+    '''
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length:
+            self.rfile.read(length)
+        self.server.received.append((self.path, dict(self.headers)))
+
+        status, headers, body = self.server.respond(self)
+        body = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        #a 304 has no body
+        if status != 304:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    httpd.received = []
+    httpd.respond = lambda handler: (200, {}, {"path": handler.path})
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _api(server, target, client) -> baseapi.api:
+    return baseapi.api(target=target, base=f"http://127.0.0.1:{server.server_port}/", client=client)
+
+
+@pytest.fixture
+def shared_client(monkeypatch):
+    #configure replaces the process-wide client, the previous one is put back afterwards
+    monkeypatch.setattr(baseapi, "_client", None)
+    yield
+    if baseapi._client is not None:
+        baseapi._client.close()
+
+
+def _statuses(*statuses):
+    #answers with each status in turn, then 200
+    remaining = list(statuses)
+    return lambda handler: (remaining.pop(0) if len(remaining) else 200, {}, {"v": 1})
+
+
+def test_configure_sizes_the_pool_and_retries(shared_client):
+    first = baseapi.configure(pool_size=4, max_retries=2, backoff_factor=0)
+    assert baseapi.get_client() is first
+    adapter = first.session.get_adapter("http://127.0.0.1/")
+    assert adapter._pool_maxsize == 4
+    assert adapter.max_retries.total == 2
+    assert adapter.max_retries.backoff_factor == 0
+
+    #the previous client is closed when it is replaced
+    first.executor()
+    second = baseapi.configure(pool_size=8)
+    assert baseapi.get_client() is second
+    assert first._executor is None
+    assert second.session.get_adapter("http://127.0.0.1/")._pool_maxsize == 8
+
+
+def test_requests_reuse_pooled_connections(server, shared_client):
+    baseapi.configure(pool_size=2, backoff_factor=0)
+    for i in range(5):
+        assert baseapi.api(target="pointings", base=f"http://127.0.0.1:{server.server_port}/")._get_json(
+            {"d_json": {"i": i}}
+        )[0] == 200
+
+    stats = baseapi.connection_stats()
+    assert stats["requests"] == 5
+    assert stats["connections_opened"] == 1
+    assert stats["connections_reused"] == 4
+
+
+def test_gets_are_retried_on_bad_gateway(server):
+    server.respond = _statuses(502, 503)
+    client = baseapi.Client(max_retries=3, backoff_factor=0)
+
+    assert _api(server, "pointings", client)._get_json({"d_json": {}}) == (200, {"v": 1})
+    assert len(server.received) == 3
+    assert client.stats()["requests"] == 3
+
+    #out of retries, the last response is returned
+    server.received.clear()
+    server.respond = _statuses(503, 503, 503, 503, 503)
+    assert _api(server, "pointings", client)._get({"d_json": {}}).status_code == 503
+    assert len(server.received) == 4
+    client.close()
+
+
+def test_posts_are_not_retried(server):
+    server.respond = _statuses(503)
+    client = baseapi.Client(max_retries=3, backoff_factor=0)
+
+    assert _api(server, "pointings", client)._post({"d_json": {}}).status_code == 503
+    assert len(server.received) == 1
+    client.close()
+
+
+def test_failed_download_releases_its_connection(server, tmp_path):
+    server.respond = lambda handler: (404, {}, b"not found") if "skymap" in handler.path else (200, {}, {"v": 1})
+    client = baseapi.Client(pool_size=1, backoff_factor=0)
+
+    response = _api(server, "skymap", client)._download({"d_json": None}, str(tmp_path / "skymap.fits"))
+    assert response.status_code == 404
+    assert not os.path.exists(tmp_path / "skymap.fits")
+
+    #the error body was read, so the next request reuses the connection
+    assert _api(server, "pointings", client)._get_json({"d_json": {}}) == (200, {"v": 1})
+    stats = client.stats()
+    assert stats["connections_opened"] == 1
+    assert stats["connections_reused"] == 1
+    #json responses are counted as well as streamed ones
+    assert stats["bytes_downloaded"] == len(b"not found") + len(json.dumps({"v": 1}))
+    client.close()
+
+
+def test_map_concurrent_keeps_the_order():
+    #the first items take the longest, so they finish last
+    results = baseapi.map_concurrent(lambda x: time.sleep(0.01 * (10 - x)) or x * x, range(10), max_workers=10)
+    assert results == [x * x for x in range(10)]
+    assert baseapi.map_concurrent(lambda x: x, []) == []
+    assert baseapi.map_concurrent(lambda x: x + 1, [1]) == [2]
+
+
+def test_map_concurrent_raises_the_first_error():
+    def fetch(x):
+        if x == 3:
+            raise ValueError("no footprint 3")
+        return x
+
+    with pytest.raises(ValueError, match="no footprint 3"):
+        baseapi.map_concurrent(fetch, range(6))
+
+
+def test_run_async_is_bounded_by_the_pool(shared_client):
+    baseapi.configure(pool_size=2)
+    in_flight, most = [0], [0]
+    guard = threading.Lock()
+
+    def call(x):
+        with guard:
+            in_flight[0] += 1
+            most[0] = max(most[0], in_flight[0])
+        time.sleep(0.05)
+        with guard:
+            in_flight[0] -= 1
+        return x, threading.current_thread().name
+
+    async def gather():
+        return await asyncio.gather(*[baseapi.run_async(call, x) for x in range(6)])
+
+    results = asyncio.run(gather())
+    assert [x for x, _ in results] == list(range(6))
+    assert all(name.startswith("gwtm_api") for _, name in results)
+    assert most[0] == 2
+
+
+def test_async_wrappers_call_their_blocking_method(monkeypatch):
+    wrappers = [
+        (Pointing, "get", "get_async"),
+        (Candidate, "get", "get_async"),
+        (Instrument, "get", "get_async"),
+        (Footprint, "get", "get_async"),
+        (Alert, "get_all", "get_all_async"),
+        (Alert, "fetch_contours", "fetch_contours_async"),
+        (Alert, "fetch_skymap", "fetch_skymap_async")
+    ]
+    for cls, method, wrapper in wrappers:
+        monkeypatch.setattr(cls, method, staticmethod(lambda *args, **kwargs: (args, kwargs)))
+        assert asyncio.run(getattr(cls, wrapper)("token", graceid="S1")) == (("token",), {"graceid": "S1"})
+
+
+def _versioned(server, version):
+    #answers with the body of the current version, or 304 when the request has its validators
+    def respond(handler):
+        etag, modified = f'"v{version[0]}"', f"Mon, 0{version[0]} Jan 2024 00:00:00 GMT"
+        if handler.headers.get("If-None-Match") == etag:
+            return 304, {"ETag": etag}, b""
+        return 200, {"ETag": etag, "Last-Modified": modified}, {"version": version[0], "path": handler.path}
+    server.respond = respond
+
+
+@pytest.mark.parametrize("store", ["directory", "sqlite"])
+def test_cached_gets_are_revalidated_after_their_ttl(server, fresh_cache, monkeypatch, store):
+    fresh_cache(store)
+    clock = [1000.0]
+    monkeypatch.setattr(baseapi.time, "time", lambda: clock[0])
+    version = [1]
+    _versioned(server, version)
+    client = baseapi.Client(backoff_factor=0)
+
+    def get():
+        return _api(server, "pointings", client)._get({"d_json": {"graceid": "S1"}}, cache=True)
+
+    first = get()
+    assert not first.from_cache and first.json()["version"] == 1
+    assert len(server.received) == 1
+
+    #within the ttl of the endpoint, without a request
+    clock[0] += baseapi.CACHE_TTLS["pointings"] - 1
+    assert get().from_cache
+    assert len(server.received) == 1
+
+    #after it, a conditional request answered with 304 serves the cached body
+    clock[0] += 2
+    revalidated = get()
+    assert revalidated.from_cache and revalidated.json() == first.json()
+    assert len(server.received) == 2
+    headers = server.received[-1][1]
+    assert headers["If-None-Match"] == '"v1"'
+    assert headers["If-Modified-Since"] == "Mon, 01 Jan 2024 00:00:00 GMT"
+
+    #the 304 starts a new ttl
+    clock[0] += baseapi.CACHE_TTLS["pointings"] - 1
+    assert get().from_cache
+    assert len(server.received) == 2
+
+    #a changed body is downloaded and cached again
+    version[0] = 2
+    clock[0] += 2
+    changed = get()
+    assert not changed.from_cache and changed.json()["version"] == 2
+    assert get().json()["version"] == 2
+    assert len(server.received) == 3
+    client.close()
+
+
+@pytest.mark.parametrize("store", ["directory", "sqlite"])
+def test_cache_ttls_are_per_endpoint(server, fresh_cache, monkeypatch, store):
+    fresh_cache(store)
+    clock = [1000.0]
+    monkeypatch.setattr(baseapi.time, "time", lambda: clock[0])
+    _versioned(server, [1])
+    client = baseapi.Client(backoff_factor=0)
+
+    for target in ["pointings", "footprints"]:
+        _api(server, target, client)._get({"d_json": {"id": 1}}, cache=True)
+    clock[0] += baseapi.CACHE_TTLS["pointings"] + 1
+    for target in ["pointings", "footprints"]:
+        _api(server, target, client)._get({"d_json": {"id": 1}}, cache=True)
+
+    #only the pointings were revalidated, the footprints are within their week
+    assert [x[0] for x in server.received] == ["/v1/pointings", "/v1/footprints", "/v1/pointings"]
+
+    #an explicit ttl overrides the endpoint's
+    _api(server, "footprints", client)._get({"d_json": {"id": 1}}, cache=True, ttl=0)
+    assert len(server.received) == 4
+    client.close()
+
+
+def test_failed_gets_are_not_cached(server, fresh_cache):
+    fresh_cache()
+    server.respond = _statuses(404)
+    client = baseapi.Client(backoff_factor=0)
+
+    assert _api(server, "pointings", client)._get({"d_json": {}}, cache=True).status_code == 404
+    assert _api(server, "pointings", client)._get_json({"d_json": {}}, cache=True) == (200, {"v": 1})
+    assert len(server.received) == 2
+    client.close()
@@ -0,0 +1,32 @@
+import sys
+import os
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../src'))
+
+import pytest
+
+from gwtm_api.core import tmcache
+from gwtm_api.core.tmcache import TMCache
+
+
+@pytest.fixture
+def fresh_cache(monkeypatch, tmp_path):
+    '''
+        fresh_cache(store, policy, max_bytes) points the TMCache at a new empty directory under tmp_path,
+        with the memory tier off so every read reaches the store, and returns the directory.
+        the cache settings, stores and HOME are restored after the test
+    '''
+    monkeypatch.setattr(tmcache, "_config", dict(tmcache._config))
+    monkeypatch.setattr(tmcache, "_stores", {})
+    monkeypatch.setattr(tmcache._memory, "max_bytes", tmcache._memory.max_bytes)
+    monkeypatch.setattr(tmcache._memory, "max_entries", tmcache._memory.max_entries)
+
+    def fresh(store="directory", policy="lru", max_bytes=10**9):
+        home = tempfile.mkdtemp(dir=tmp_path)
+        monkeypatch.setenv("HOME", home)
+        TMCache.configure(max_bytes=max_bytes, policy=policy, memory_max_entries=0, store=store)
+        return os.path.join(home, ".tmcache")
+
+    yield fresh
+    tmcache._memory.clear()
@@ -0,0 +1,89 @@
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../src'))
+
+import numpy as np
+import healpy as hp
+
+from gwtm_api.core import util
+from gwtm_api.core.coverage import CoverageMask, pixels_to_ranges, polygon_ranges, ranges_to_pixels
+
+
+def _square(ra, dec, size=1.0):
+    return [
+        [ra - size, dec - size], [ra + size, dec - size], [ra + size, dec + size], [ra - size, dec + size]
+    ]
+
+
+def _polygons(n=40, seed=0):
+    rng = np.random.default_rng(seed)
+    return [_square(ra, dec) for ra, dec in zip(rng.uniform(0, 360, n), rng.uniform(-60, 60, n))]
+
+
+def test_mask_matches_deduplicated_pixel_list():
+    polygons = _polygons(seed=1)
+    skymap = np.random.default_rng(1).random(hp.nside2npix(64))
+    skymap /= skymap.sum()
+
+    #the original path: every polygon's pixels appended to a list, deduplicated after each one
+    qps = []
+    for polygon in polygons:
+        qps.extend(hp.query_polygon(64, util.polygon_to_uvecs(polygon), inclusive=True))
+        deduped_indices = list(dict.fromkeys(qps))
+
+    coverage = CoverageMask(64)
+    for polygon in polygons:
+        coverage.add_polygon(polygon, inclusive=True)
+
+    assert np.array_equal(coverage.pixels(), np.sort(deduped_indices))
+    assert coverage.count() == len(deduped_indices)
+    assert np.isclose(coverage.probability(skymap), np.sum(skymap[deduped_indices]))
+    assert np.isclose(coverage.area(), len(deduped_indices) * hp.nside2pixarea(64, degrees=True))
+
+
+def test_add_returns_only_new_pixels():
+    coverage = CoverageMask(16)
+    assert np.array_equal(coverage.add(np.array([1, 2, 3])), [1, 2, 3])
+    assert np.array_equal(coverage.add(np.array([2, 3, 4, 5])), [4, 5])
+    assert np.array_equal(coverage.add(np.array([1, 5])), [])
+    assert coverage.count() == 5
+
+
+def test_parallel_add_polygons_matches_serial():
+    polygons = _polygons()
+
+    serial = CoverageMask(64)
+    serial.add_polygons(polygons)
+
+    parallel = CoverageMask(64)
+    parallel.add_polygons(polygons, workers=2)
+
+    assert np.array_equal(serial.mask, parallel.mask)
+
+
+def test_add_ranges_matches_add():
+    polygons = _polygons()
+    coverage = CoverageMask(64)
+    for ranges in polygon_ranges(polygons, 64, workers=2):
+        coverage.add_ranges(ranges)
+
+    expected = CoverageMask(64)
+    for polygon in polygons:
+        expected.add(hp.query_polygon(64, util.polygon_to_uvecs(polygon)))
+
+    assert np.array_equal(coverage.mask, expected.mask)
+
+
+def test_add_ranges_only_sets_the_pixels_in_the_ranges():
+    #a shard of small ranges at nside 2048 (50M pixels) is merged into the mask pixel by pixel
+    coverage = CoverageMask(2048)
+    coverage.add(np.array([5, 11]))
+    ranges = pixels_to_ranges(np.array([10, 11, 12, 1000, 1001, hp.nside2npix(2048) - 1]))
+    coverage.add_ranges(ranges)
+    coverage.add_ranges(ranges)
+
+    expected = np.union1d([5, 11], ranges_to_pixels(ranges))
+    assert np.array_equal(coverage.pixels(), expected)
+    assert coverage.count() == len(expected)
+    assert np.array_equal(np.flatnonzero(coverage.mask), expected)
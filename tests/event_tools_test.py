@@ -0,0 +1,278 @@
+import sys
+import os
+import datetime
+import threading
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../src'))
+
+import numpy as np
+import healpy as hp
+import pytest
+
+from gwtm_api import Pointing, Instrument, Footprint, Alert, calculate_coverage, update_coverage, coverage_timeline
+from gwtm_api import event_tools
+from gwtm_api.event_tools import CoverageState
+
+NSIDE = 64
+SKYMAP = np.random.default_rng(0).random(hp.nside2npix(NSIDE))
+SKYMAP /= SKYMAP.sum()
+TIME_OF_SIGNAL = datetime.datetime(2020, 1, 1)
+
+
+def _footprint(id, vertices):
+    polygon = ", ".join(f"{ra} {dec}" for ra, dec in vertices + [vertices[0]])
+    return Footprint(kwdict={"id": id, "footprint": f"POLYGON (({polygon}))"})
+
+
+def _instrument(id, size):
+    instrument = Instrument(id=id, instrument_name=f"inst{id}", nickname=f"inst{id}")
+    instrument.footprint = [
+        _footprint(id, [(-size, -size), (size, -size), (size, size), (-size, size)]),
+        _footprint(id, [(size, -size), (2 * size, -size), (1.5 * size, size)])
+    ]
+    return instrument
+
+
+INSTRUMENTS = {1: _instrument(1, 1.0), 2: _instrument(2, 2.0)}
+
+
+def _pointings(n, instrumentid, decs=(-30, -10), first_id=1, seed=0):
+    #observed over two days, in a band of the sky so that they overlap
+    rng = np.random.default_rng(seed)
+    pointings = []
+    for k in range(n):
+        pointing = Pointing(
+            ra=float(rng.uniform(20, 60)), dec=float(rng.uniform(*decs)), instrumentid=instrumentid,
+            time=TIME_OF_SIGNAL + datetime.timedelta(hours=float(rng.uniform(0, 48))), status="completed",
+            depth=20.0, depth_unit="ab_mag", pos_angle=float(rng.uniform(0, 90))
+        )
+        pointing.id = first_id + k
+        pointings.append(pointing)
+    return pointings
+
+
+@pytest.fixture
+def offline_event(monkeypatch):
+    '''
+        answers the instrument, skymap and alert queries of event S1 locally.
+        returns the instrument ids fetched by each Instrument.get
+    '''
+    fetched = []
+
+    def get_instruments(ids=None, **kwargs):
+        fetched.append(sorted(ids))
+        return [INSTRUMENTS[x] for x in ids]
+
+    def fetch_skymap(**kwargs):
+        #slow enough for concurrent loads to overlap
+        time.sleep(0.05)
+        return SKYMAP
+
+    monkeypatch.setattr(Instrument, "get", staticmethod(get_instruments))
+    monkeypatch.setattr(Alert, "fetch_skymap", staticmethod(fetch_skymap))
+    monkeypatch.setattr(Alert, "get", staticmethod(lambda **kwargs: SimpleNamespace(time_of_signal=TIME_OF_SIGNAL)))
+    monkeypatch.setattr(event_tools, "_COVERAGE_STATES", {})
+    return fetched
+
+
+def _coverage(pointings):
+    return calculate_coverage(api_token="token", graceid="S1", pointings=pointings, skymap=SKYMAP)
+
+
+def test_state_updates_match_calculate_coverage(offline_event):
+    first, second = _pointings(20, 1), _pointings(20, 1, first_id=21, seed=1)
+    state = CoverageState(graceid="S1", skymap=SKYMAP)
+
+    state.update(api_token="token", pointings=first)
+    prob, area = state.update(api_token="token", pointings=first + second)
+    expected_prob, expected_area = _coverage(first + second)
+    assert np.isclose(prob, expected_prob)
+    assert np.isclose(area, expected_area)
+    assert state.pointing_ids == set(range(1, 41))
+
+    #the MOC covers the same pixels as the mask
+    assert np.array_equal(np.sort(state.moc.pixels(state.order, nest=False)), state.coverage.pixels())
+
+
+def test_state_ignores_ingested_pointings(offline_event, monkeypatch):
+    pointings = _pointings(20, 1)
+    state = CoverageState(graceid="S1", skymap=SKYMAP)
+    before = state.update(api_token="token", pointings=pointings)
+    state.saved = True
+
+    projected = []
+    project_pointings = event_tools.project_pointings
+    monkeypatch.setattr(
+        event_tools, "project_pointings", lambda instrument, x: projected.append(len(x)) or project_pointings(instrument, x)
+    )
+    assert state.update(api_token="token", pointings=pointings) == before
+    assert projected == []
+    assert state.saved
+
+    #only the new pointing is projected, and the instrument is not fetched again
+    state.update(api_token="token", pointings=pointings + _pointings(1, 1, first_id=100, seed=2))
+    assert projected == [1]
+    assert offline_event == [[1]]
+
+
+def test_state_save_load_round_trip(offline_event, fresh_cache):
+    fresh_cache()
+    pointings = _pointings(20, 1) + _pointings(10, 2, first_id=21, seed=1)
+    prob, area = update_coverage(api_token="token", graceid="S1", pointings=pointings, cache=True)
+    saved = CoverageState.load(api_token="token", graceid="S1", cache=True)
+
+    CoverageState.clear()
+    loaded = CoverageState.load(api_token="token", graceid="S1", cache=True)
+    assert loaded is not saved
+    assert loaded.moc == saved.moc
+    assert loaded.pointing_ids == set(range(1, 31))
+    assert np.array_equal(loaded.coverage.mask, saved.coverage.mask)
+    assert np.isclose(loaded.prob, prob) and np.isclose(loaded.area(), area)
+
+
+def test_concurrent_saves_are_merged(offline_event, fresh_cache):
+    #two processes load the event's state before either saves
+    fresh_cache()
+    first, second = _pointings(15, 1), _pointings(15, 2, first_id=16, seed=1)
+    a = CoverageState.load(api_token="token", graceid="S1", cache=True)
+    CoverageState.clear()
+    b = CoverageState.load(api_token="token", graceid="S1", cache=True)
+
+    a.update(api_token="token", pointings=first)
+    b.update(api_token="token", pointings=second)
+    a.save()
+    b.save()
+
+    CoverageState.clear()
+    loaded = CoverageState.load(api_token="token", graceid="S1", cache=True)
+    expected_prob, expected_area = _coverage(first + second)
+    assert loaded.pointing_ids == set(range(1, 31))
+    assert np.isclose(loaded.prob, expected_prob) and np.isclose(loaded.area(), expected_area)
+    #the last to save also holds the merged coverage
+    assert b.moc == loaded.moc and np.isclose(b.prob, expected_prob)
+
+
+def test_concurrent_loads_share_one_state(offline_event):
+    states = []
+    threads = [
+        threading.Thread(target=lambda: states.append(CoverageState.load(api_token="token", graceid="S1")))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(states) == 8 and all(x is states[0] for x in states)
+    CoverageState.clear("S1")
+    assert CoverageState.load(api_token="token", graceid="S1") is not states[0]
+
+
+def test_timeline_is_cumulative(offline_event):
+    pointings = _pointings(25, 1) + _pointings(15, 2, first_id=26, seed=1)
+    timeline = coverage_timeline(api_token="token", graceid="S1", pointings=pointings)
+
+    assert np.all(np.diff(timeline["hours"]) >= 0)
+    assert np.all(np.diff(timeline["probability"]) >= 0)
+    assert np.all(np.diff(timeline["area"]) >= 0)
+    times = {x.id: (x.time - TIME_OF_SIGNAL).total_seconds() / 3600 for x in pointings}
+    assert np.allclose(timeline["hours"], [times[x] for x in timeline["pointing_ids"]])
+
+    #after the last pointing, the coverage of them all
+    prob, area = _coverage(pointings)
+    assert np.isclose(timeline["probability"][-1], prob)
+    assert np.isclose(timeline["area"][-1], area)
+
+    #after each pointing, the coverage of the pointings so far
+    for k in [0, 9, 30]:
+        observed = [x for x in pointings if x.id in timeline["pointing_ids"][:k + 1]]
+        assert np.isclose(timeline["probability"][k], _coverage(observed)[0])
+
+
+def test_timeline_per_instrument_adds_up(offline_event):
+    #the instruments observe bands of the sky that don't overlap
+    pointings = _pointings(20, 1, decs=(-30, -10)) + _pointings(20, 2, decs=(10, 30), first_id=21, seed=1)
+    timeline = coverage_timeline(api_token="token", graceid="S1", pointings=pointings, per_instrument=True)
+
+    curves = timeline["instruments"]
+    assert sorted(curves) == [1, 2]
+    for i, curve in curves.items():
+        assert np.all(np.diff(curve["probability"]) >= 0)
+        assert np.isclose(curve["probability"][-1], _coverage([x for x in pointings if x.instrumentid == i])[0])
+
+    #the total after each pointing is the sum of each instrument's curve after its pointings so far
+    for k, pointing_id in enumerate(timeline["pointing_ids"]):
+        prob, area = 0.0, 0.0
+        for curve in curves.values():
+            n = np.sum(np.isin(curve["pointing_ids"], timeline["pointing_ids"][:k + 1]))
+            if n:
+                prob += curve["probability"][n - 1]
+                area += curve["area"][n - 1]
+        assert np.isclose(timeline["probability"][k], prob)
+        assert np.isclose(timeline["area"][k], area)
+
+
+def _count_pixelized(monkeypatch) -> list:
+    #the number of pointings pixelized by each call of the footprint pixel cache
+    pixelized = []
+    grouped_polygon_ranges = event_tools.grouped_polygon_ranges
+
+    def counting(groups, *args, **kwargs):
+        pixelized.append(len(groups))
+        return grouped_polygon_ranges(groups, *args, **kwargs)
+
+    monkeypatch.setattr(event_tools, "grouped_polygon_ranges", counting)
+    return pixelized
+
+
+def _cached_coverage(pointings):
+    return calculate_coverage(api_token="token", graceid="S1", pointings=pointings, skymap=SKYMAP, cache=True)
+
+
+def test_footprint_pixel_cache_matches_uncached(offline_event, fresh_cache):
+    fresh_cache()
+    pointings = _pointings(20, 1) + _pointings(20, 2, first_id=21, seed=1)
+    assert np.allclose(_cached_coverage(pointings), _coverage(pointings))
+    #served from the cache the second time
+    assert np.allclose(_cached_coverage(pointings), _coverage(pointings))
+
+    engine = event_tools.CoverageEngine(api_token="token", graceid="S1", pointings=pointings, skymap=SKYMAP, cache=True)
+    uncached = event_tools.CoverageEngine(api_token="token", graceid="S1", pointings=pointings, skymap=SKYMAP)
+    assert engine.moc(order=8) == uncached.moc(order=8)
+
+
+def test_footprint_pixel_cache_only_pixelizes_new_pointings(offline_event, fresh_cache, monkeypatch):
+    fresh_cache()
+    pixelized = _count_pixelized(monkeypatch)
+    first = _pointings(20, 1)
+    _cached_coverage(first)
+    assert sum(pixelized) == 20
+
+    #a superset, across events: only the new pointings are pixelized
+    more = first + _pointings(5, 1, first_id=21, seed=1)
+    pixelized.clear()
+    prob, area = calculate_coverage(api_token="token", graceid="S2", pointings=more, skymap=SKYMAP, cache=True)
+    assert sum(pixelized) == 5
+    assert np.isclose(prob, _coverage(more)[0]) and np.isclose(area, _coverage(more)[1])
+
+
+def test_footprint_pixel_cache_follows_geometry(offline_event, fresh_cache, monkeypatch):
+    fresh_cache()
+    pixelized = _count_pixelized(monkeypatch)
+    pointings = _pointings(20, 1)
+    _cached_coverage(pointings)
+
+    #a moved or rotated pointing is a new entry of its region
+    pointings[3].pos_angle += 10.0
+    pointings[7].ra += 0.5
+    pixelized.clear()
+    assert np.allclose(_cached_coverage(pointings), _coverage(pointings))
+    assert sum(pixelized) == 2
+
+    #a changed footprint has entries of its own
+    monkeypatch.setitem(INSTRUMENTS, 1, _instrument(1, 1.5))
+    pixelized.clear()
+    assert np.allclose(_cached_coverage(pointings), _coverage(pointings))
+    assert sum(pixelized) == 20
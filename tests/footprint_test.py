@@ -0,0 +1,151 @@
+import sys
+import os
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../src'))
+
+import numpy as np
+
+from gwtm_api import Instrument, Footprint
+from gwtm_api import instrument as instrument_module
+from gwtm_api.core import baseapi, util
+
+
+def _footprint(id, vertices):
+    polygon = ", ".join(f"{ra} {dec}" for ra, dec in vertices + [vertices[0]])
+    return Footprint(kwdict={"id": id, "footprint": f"POLYGON (({polygon}))"})
+
+
+def _instrument():
+    instrument = Instrument(id=1, instrument_name="test", nickname="test")
+    instrument.footprint = [
+        _footprint(1, [(-1, -1), (1, -1), (1, 1), (-1, 1)]),
+        _footprint(2, [(1.2, -0.5), (2.0, -0.5), (1.6, 0.5)]),
+        _footprint(3, [(-2.0, 1.2), (-1.2, 1.2), (-1.0, 2.0), (-1.6, 2.4), (-2.2, 2.0)])
+    ]
+    return instrument
+
+
+def _pointings(n=50, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(0, 360, n), rng.uniform(-89, 89, n), rng.uniform(-180, 180, n)
+
+
+def _project_per_vertex(footprint, ra, dec, pos_angle):
+    #the original one vertex at a time projection
+    x, y, z = util.ra_dec_to_uvec(*np.asarray(footprint.polygon, dtype=float).T)
+    projected = []
+    for vec in np.stack([x, y, z], axis=-1):
+        new_vec = vec @ util.x_rot(-pos_angle) @ util.y_rot(dec) @ util.z_rot(-ra)
+        projected.append(util.uvec_to_ra_dec(*np.asarray(new_vec).flatten()))
+    return np.asarray(projected)
+
+
+def _assert_same_vertices(a, b):
+    a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+    assert a.shape == b.shape
+    #compared on the sky, so ra = 0 and ra = 360 agree
+    assert np.all(util.gc_dist(a[..., 0], a[..., 1], b[..., 0], b[..., 1]) < 1e-8)
+
+
+def test_footprint_project_batch_matches_per_vertex():
+    footprint = _instrument().footprint[0]
+    ras, decs, pos_angles = _pointings()
+
+    batch = footprint.project_batch(ras, decs, pos_angles)
+    assert batch.shape == (len(ras), len(footprint.polygon), 2)
+    for projected, ra, dec, pos_angle in zip(batch, ras, decs, pos_angles):
+        _assert_same_vertices(projected, _project_per_vertex(footprint, ra, dec, pos_angle))
+
+
+def test_instrument_project_batch_matches_footprints():
+    instrument = _instrument()
+    ras, decs, pos_angles = _pointings(seed=1)
+
+    batch = instrument.project_batch(ras, decs, pos_angles)
+    n_vertices = max(len(x.polygon) for x in instrument.footprint)
+    assert batch.shape == (len(ras), len(instrument.footprint), n_vertices, 2)
+
+    for k, ccd in enumerate(instrument.footprint):
+        n = len(ccd.polygon)
+        _assert_same_vertices(batch[:, k, :n], ccd.project_batch(ras, decs, pos_angles))
+        #shorter ccds are padded with nan
+        assert np.all(np.isnan(batch[:, k, n:]))
+
+
+def test_project_matches_per_vertex():
+    instrument = _instrument()
+    projected = instrument.project(ra=123.4, dec=-45.6, pos_angle=None)
+
+    for ccd, proj_ccd in zip(instrument.footprint, projected):
+        expected = np.round(_project_per_vertex(ccd, 123.4, -45.6, 0.0), 3)
+        assert len(proj_ccd) == len(ccd.polygon)
+        _assert_same_vertices(proj_ccd, expected)
+
+
+def _offline_api(monkeypatch):
+    '''
+        answer the instruments and footprints endpoints locally, a square footprint per instrument id.
+        returns the footprint ids requested, and the most footprint requests seen in flight at once
+    '''
+    requested, in_flight, most = [], [0], [0]
+    guard = threading.Lock()
+
+    def get_json(self, r_json, urlencode=False, cache=False, ttl=None):
+        d_json = r_json["d_json"]
+        if self.target == "instruments":
+            return 200, [{"id": x, "instrument_name": f"inst{x}", "nickname": f"inst{x}"} for x in d_json["ids"]]
+
+        with guard:
+            requested.append(d_json["id"])
+            in_flight[0] += 1
+            most[0] = max(most[0], in_flight[0])
+        time.sleep(0.05)
+        with guard:
+            in_flight[0] -= 1
+        size = d_json["id"] / 10
+        return 200, [{"id": d_json["id"], "footprint": f"POLYGON ((0 0, {size} 0, {size} {size}, 0 {size}, 0 0))"}]
+
+    monkeypatch.setattr(baseapi.api, "_get_json", get_json)
+    monkeypatch.setattr(instrument_module, "_FOOTPRINT_REGISTRY", {})
+    return requested, most
+
+
+def test_registry_returns_the_same_footprints(monkeypatch):
+    requested, _ = _offline_api(monkeypatch)
+
+    first = Footprint.get(api_token="token", instrumentid=47)
+    again = Footprint.get(api_token="token", instrumentid=47)
+    #fetched once, the same objects in a new list
+    assert requested == [76]
+    assert again is not first
+    assert all(a is b for a, b in zip(first, again))
+
+    #the full footprint is registered separately from the approximated one
+    full = Footprint.get(api_token="token", instrumentid=47, approximate_footprint=False)
+    assert requested == [76, 47]
+    assert full[0] is not first[0]
+    assert Footprint.get(api_token="token", instrumentid=47, approximate_footprint=False)[0] is full[0]
+
+    #without the registry every call fetches
+    Footprint.get(api_token="token", instrumentid=47, use_registry=False)
+    assert requested == [76, 47, 76]
+
+    Footprint.clear_registry()
+    assert Footprint.get(api_token="token", instrumentid=47)[0] is not first[0]
+
+
+def test_instrument_get_fetches_footprints_concurrently(monkeypatch):
+    requested, most = _offline_api(monkeypatch)
+
+    instruments = Instrument.get(api_token="token", ids=[1, 2, 3, 4, 5, 6], include_footprint=True)
+    assert sorted(requested) == [1, 2, 3, 4, 5, 6]
+    assert most[0] > 1
+    #each instrument gets its own footprint
+    for instrument in instruments:
+        assert np.isclose(np.max(instrument.footprint[0].polygon), instrument.id / 10)
+
+    #the second time every footprint comes from the registry
+    Instrument.get(api_token="token", ids=[1, 2, 3, 4, 5, 6], include_footprint=True)
+    assert len(requested) == 6
@@ -0,0 +1,118 @@
+import sys
+import os
+import io
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../src'))
+
+import numpy as np
+import healpy as hp
+
+from gwtm_api.core.moc import MOC, MAX_ORDER
+
+ORDER = 5
+
+
+def _random_pixels(seed, n=300, order=ORDER):
+    rng = np.random.default_rng(seed)
+    #runs of neighbouring pixels, so the ranges touch, overlap and nest
+    starts = rng.integers(0, hp.order2npix(order) - 20, n // 10)
+    return np.unique(np.concatenate([x + np.arange(rng.integers(1, 20)) for x in starts]))
+
+
+def _children(pixels, order, to_order=ORDER):
+    #the nested pixels at to_order inside pixels at order
+    factor = 4**(to_order - order)
+    return (pixels[:, None] * factor + np.arange(factor)).reshape(-1)
+
+
+A_PIXELS = _random_pixels(0)
+B_PIXELS = _random_pixels(1)
+A = MOC.from_pixels(A_PIXELS, ORDER)
+B = MOC.from_pixels(B_PIXELS, ORDER)
+
+
+def test_set_operations_match_pixel_sets():
+    assert np.array_equal((A | B).pixels(ORDER), np.union1d(A_PIXELS, B_PIXELS))
+    assert np.array_equal((A & B).pixels(ORDER), np.intersect1d(A_PIXELS, B_PIXELS))
+    assert np.array_equal((A - B).pixels(ORDER), np.setdiff1d(A_PIXELS, B_PIXELS))
+    assert np.array_equal((B - A).pixels(ORDER), np.setdiff1d(B_PIXELS, A_PIXELS))
+
+    assert A | B == B | A
+    assert A & B == B & A
+    assert (A - B) | (A & B) == A
+    assert len((A - B) & B) == 0
+
+
+def test_set_operations_across_orders():
+    coarse_pixels = _random_pixels(2, n=40, order=ORDER - 2)
+    coarse = MOC.from_pixels(coarse_pixels, ORDER - 2)
+    fine_pixels = _children(coarse_pixels, ORDER - 2)
+
+    assert coarse == MOC.from_pixels(fine_pixels, ORDER)
+    assert np.array_equal((coarse | A).pixels(ORDER), np.union1d(fine_pixels, A_PIXELS))
+    assert np.array_equal((coarse & A).pixels(ORDER), np.intersect1d(fine_pixels, A_PIXELS))
+    assert np.array_equal((A - coarse).pixels(ORDER), np.setdiff1d(A_PIXELS, fine_pixels))
+
+
+def test_ranges_are_sorted_disjoint_and_merged():
+    for moc in [A, B, A | B, A & B, A - B]:
+        assert np.all(moc.ranges[:, 1] > moc.ranges[:, 0])
+        #a gap between every range and the next, touching ranges are merged
+        assert np.all(moc.ranges[1:, 0] > moc.ranges[:-1, 1])
+
+
+def test_ring_pixels_round_trip():
+    nside = 2**ORDER
+    ring_pixels = hp.nest2ring(nside, A_PIXELS)
+    moc = MOC.from_pixels(ring_pixels, ORDER, nest=False)
+    assert moc == A
+    assert np.array_equal(np.sort(moc.pixels(ORDER, nest=False)), np.sort(ring_pixels))
+
+
+def test_cells_below():
+    positions = np.concatenate([
+        A.ranges.reshape(-1), A.ranges.reshape(-1) + 1, A.ranges.reshape(-1) - 1, [0, 12 * 4**MAX_ORDER]
+    ])
+    positions = np.clip(positions, 0, 12 * 4**MAX_ORDER)
+    lengths = A.ranges[:, 1] - A.ranges[:, 0]
+    expected = [np.sum(np.clip(x - A.ranges[:, 0], 0, lengths)) for x in positions]
+    assert np.array_equal(A.cells_below(positions), expected)
+    assert A.cells_below([12 * 4**MAX_ORDER])[0] == A.n_cells()
+
+
+def test_area():
+    assert np.isclose(A.area(), len(A_PIXELS) * hp.nside2pixarea(2**ORDER, degrees=True))
+    assert np.isclose(MOC.from_pixels(np.arange(12), 0).area(), 4 * np.pi * (180 / np.pi)**2)
+
+
+def test_probability():
+    nside = 2**ORDER
+    skymap = np.random.default_rng(3).random(hp.nside2npix(nside))
+    skymap /= skymap.sum()
+
+    #whole pixels, in either ordering of the skymap
+    assert np.isclose(A.probability(skymap), np.sum(skymap[hp.nest2ring(nside, A_PIXELS)]))
+    assert np.isclose(A.probability(hp.reorder(skymap, r2n=True), nest=True), np.sum(skymap[hp.nest2ring(nside, A_PIXELS)]))
+
+    #a child pixel holds a quarter of its parent's probability
+    nest_skymap = hp.reorder(skymap, r2n=True)
+    child = MOC.from_pixels([4 * 10 + 1], ORDER + 1)
+    assert np.isclose(child.probability(nest_skymap, nest=True), nest_skymap[10] / 4)
+
+    #a coarser skymap than the coverage
+    coarse = hp.ud_grade(skymap, nside // 2, power=-2)
+    assert np.isclose(MOC.from_pixels(np.arange(12 * 4**ORDER), ORDER).probability(coarse), 1.0)
+    assert MOC().probability(skymap) == 0.0
+
+
+def test_payload_round_trip():
+    for moc in [A, A | B, MOC()]:
+        assert MOC.from_payload(moc.to_payload()) == moc
+        assert MOC.from_bytes(moc.to_bytes()) == moc
+
+        #through an npz file, as the TMCache stores it
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **moc.to_payload())
+        buffer.seek(0)
+        with np.load(buffer) as payload:
+            assert MOC.from_payload(payload) == moc
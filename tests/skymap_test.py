@@ -0,0 +1,174 @@
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../src'))
+
+import numpy as np
+import healpy as hp
+import pytest
+from astropy.table import Table
+from ligo.skymap import moc as ligo_moc
+from ligo.skymap.io import write_sky_map
+from ligo.skymap.postprocess import find_greedy_credible_levels
+
+from gwtm_api import Alert
+from gwtm_api.core.moc import MOC
+from gwtm_api.event_tools import CoverageEngine
+from gwtm_api.core.skymap import (
+    MultiOrderSkymap, SparseSkymap, greedy_credible_levels, greedy_sort, pyramid_nside, skymap_pyramid
+)
+
+#half of the sky in order 3 pixels, the other half in order 6 pixels
+COARSE_ORDER, FINE_ORDER = 3, 6
+N_COARSE = 384
+
+
+def _flat(nside=64, seed=0):
+    skymap = np.random.default_rng(seed).random(hp.nside2npix(nside)) ** 4
+    return skymap / skymap.sum()
+
+
+def _multiorder(seed=0) -> MultiOrderSkymap:
+    rng = np.random.default_rng(seed)
+    fine = np.arange(N_COARSE * 4**(FINE_ORDER - COARSE_ORDER), 12 * 4**FINE_ORDER)
+    uniq = np.concatenate([
+        ligo_moc.nest2uniq(np.int8(COARSE_ORDER), np.arange(N_COARSE, dtype=np.int64)),
+        ligo_moc.nest2uniq(np.int8(FINE_ORDER), fine.astype(np.int64))
+    ])
+    skymap = MultiOrderSkymap(uniq=uniq, probdensity=rng.random(len(uniq)))
+    return MultiOrderSkymap(uniq=skymap.uniq, probdensity=skymap.probdensity / skymap.total)
+
+
+def test_pyramid_nside():
+    assert pyramid_nside(1024) == 1024
+    assert pyramid_nside(1024, 2048) == 1024
+    assert pyramid_nside(1024, 256) == 256
+    assert pyramid_nside(1024, 200) == 256
+    #never below the coarsest level, or above the map
+    assert pyramid_nside(1024, 8) == 64
+    assert pyramid_nside(32, 8) == 32
+
+
+def test_skymap_pyramid_matches_ud_grade():
+    skymap = _flat(nside=256)
+    levels = list(skymap_pyramid(skymap))
+    assert [nside for nside, _ in levels] == [128, 64]
+    for nside, level in levels:
+        assert np.allclose(level, hp.ud_grade(skymap, nside, power=-2))
+        assert np.isclose(level.sum(), 1.0)
+
+
+def test_greedy_levels_match_ligo_skymap():
+    skymap = _flat()
+    sort = greedy_sort(skymap)
+    assert sort.dtype == np.int32
+    assert np.all(np.diff(skymap[sort]) <= 0)
+
+    expected = find_greedy_credible_levels(skymap)
+    assert np.allclose(greedy_credible_levels(skymap), expected)
+    assert np.allclose(greedy_credible_levels(skymap, sort), expected)
+
+
+def test_multiorder_credible_levels_match_ligo_skymap():
+    skymap = _multiorder()
+    assert np.allclose(skymap.credible_levels(), find_greedy_credible_levels(skymap.prob(), skymap.probdensity))
+
+    #painted onto the finest order, a coarse pixel's level is that of the last of its children
+    painted = skymap.rasterize(nest=True, values=skymap.credible_levels())
+    flat_levels = find_greedy_credible_levels(skymap.rasterize(nest=True))
+    n_children = 4**(FINE_ORDER - COARSE_ORDER)
+    coarse = flat_levels[:N_COARSE * n_children].reshape(N_COARSE, n_children).max(axis=1)
+    assert np.allclose(painted[:N_COARSE * n_children], np.repeat(coarse, n_children))
+    assert np.allclose(painted[N_COARSE * n_children:], flat_levels[N_COARSE * n_children:])
+
+
+def test_rasterize_preserves_probability():
+    skymap = _multiorder()
+    flat = skymap.rasterize(nest=True)
+    assert len(flat) == hp.nside2npix(2**FINE_ORDER)
+    assert np.isclose(flat.sum(), 1.0)
+
+    #a coarse pixel's probability is spread evenly over its children
+    n_children = 4**(FINE_ORDER - COARSE_ORDER)
+    coarse_prob = skymap.prob()[skymap.order == COARSE_ORDER]
+    assert np.allclose(flat[:N_COARSE * n_children], np.repeat(coarse_prob / n_children, n_children))
+
+    #coarser than the finest order, as ud_grade would sum the finest map
+    for nside in [2**COARSE_ORDER, 16, 32]:
+        expected = hp.ud_grade(flat, nside, order_in="NESTED", order_out="NESTED", power=-2)
+        assert np.allclose(skymap.rasterize(nside=nside, nest=True), expected)
+    assert np.allclose(skymap.rasterize(), hp.reorder(flat, n2r=True))
+
+
+def test_renormalized_matches_the_flat_map():
+    skymap = _multiorder()
+    #a region across both orders
+    covered = np.arange(N_COARSE * 64 - 5000, N_COARSE * 64 + 5000)
+    moc = MOC.from_pixels(covered, FINE_ORDER)
+    flat = skymap.rasterize(nest=True)
+
+    renormalized = skymap.renormalized(moc)
+    assert np.isclose(renormalized.total, 1.0)
+    assert np.isclose(renormalized.probability(moc), 0.0)
+
+    expected = flat.copy()
+    expected[covered] = 0
+    expected /= expected.sum()
+    assert np.allclose(renormalized.rasterize(nest=True), expected)
+    assert np.isclose(skymap.probability(moc), flat[covered].sum())
+
+
+def test_from_fits(tmp_path):
+    skymap = _multiorder()
+    path = str(tmp_path / "moc.fits")
+    write_sky_map(path, Table({"UNIQ": skymap.uniq, "PROBDENSITY": skymap.probdensity}), moc=True)
+
+    read = MultiOrderSkymap.from_fits(path)
+    sort = np.argsort(read.uniq)
+    assert np.array_equal(read.uniq[sort], np.sort(skymap.uniq))
+    assert np.allclose(read.probdensity[sort], skymap.probdensity[np.argsort(skymap.uniq)])
+
+    #a flat file is merged into multi-order pixels, and rasterizes back to the flat map
+    flat = _flat()
+    flat_path = str(tmp_path / "flat.fits")
+    write_sky_map(flat_path, flat, nest=False)
+    read = MultiOrderSkymap.from_fits(flat_path)
+    assert len(read) <= len(flat)
+    assert np.allclose(read.rasterize(nside=64), flat)
+
+
+def test_payload_round_trip():
+    skymap = _multiorder()
+    read = MultiOrderSkymap.from_payload(skymap.to_payload())
+    assert np.array_equal(read.uniq, skymap.uniq) and np.array_equal(read.probdensity, skymap.probdensity)
+    assert read.total == skymap.total
+
+
+def test_sparse_skymap_keeps_the_credible_region():
+    flat = _flat()
+    sparse = SparseSkymap.from_flat(flat, credible=0.9)
+    levels = find_greedy_credible_levels(flat)
+
+    #the pixels up to the 90% level, and the one that crosses it
+    kept = hp.nest2ring(64, ligo_moc.uniq2nest(sparse.uniq)[1])
+    assert np.array_equal(np.sort(kept), np.sort(np.flatnonzero(levels <= levels[kept].max())))
+    assert len(kept) == np.sum(levels < 0.9) + 1
+    assert np.isclose(sparse.total, 1.0)
+
+    #coverage of the region's pixels matches the flat map's, the renormalization keeps the dropped sky's share
+    covered = kept[::3]
+    moc = MOC.from_pixels(covered, 6, nest=False)
+    assert np.isclose(sparse.probability(moc), flat[covered].sum())
+    renormalized = sparse.renormalized(moc)
+    assert np.isclose(renormalized.prob().sum(), (sparse.prob().sum() - flat[covered].sum()) / (1 - flat[covered].sum()))
+
+
+def test_fetch_skymap_rejects_resolution_with_moc(monkeypatch):
+    with pytest.raises(ValueError):
+        Alert.fetch_skymap(api_token="token", graceid="S1", moc=True, resolution=128)
+
+    #the coverage engine only passes a resolution for flat skymaps
+    requested = []
+    monkeypatch.setattr(Alert, "fetch_skymap", staticmethod(lambda **kwargs: requested.append(kwargs) or _multiorder()))
+    CoverageEngine(api_token="token", graceid="S1", multiorder=True, resolution=128).skymap
+    assert requested[0]["moc"] and requested[0]["resolution"] is None
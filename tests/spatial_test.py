@@ -0,0 +1,70 @@
+import sys
+import os
+import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../src'))
+
+import numpy as np
+
+from gwtm_api import Pointing, PointingIndex
+from gwtm_api.core import util
+
+
+def _pointings(n=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    #uniform on the sphere, so the poles and ra = 0 are covered
+    ras = rng.uniform(0, 360, n)
+    decs = np.rad2deg(np.arcsin(rng.uniform(-1, 1, n)))
+    return [
+        Pointing(
+            ra=float(ra), dec=float(dec), instrumentid=1, time=datetime.datetime(2020, 1, 1), status="completed",
+            depth=20.0, depth_unit="ab_mag", pos_angle=0.0
+        )
+        for ra, dec in zip(ras, decs)
+    ]
+
+
+POINTINGS = _pointings()
+INDEX = PointingIndex(POINTINGS)
+RA = np.asarray([x.ra for x in POINTINGS])
+DEC = np.asarray([x.dec for x in POINTINGS])
+QUERIES = [(0.0, 0.0), (359.5, 10.0), (123.4, -45.6), (10.0, 89.0), (250.0, -88.5)]
+
+
+def test_cone_search_matches_brute_force():
+    for ra, dec in QUERIES:
+        for radius in [0.5, 3.0, 15.0, 60.0]:
+            expected = np.flatnonzero(util.gc_dist(RA, DEC, ra, dec) < radius)
+            assert np.array_equal(INDEX.cone_search_indices(ra, dec, radius), expected)
+
+    found = INDEX.cone_search(123.4, -45.6, 15.0)
+    assert [id(x) for x in found] == [id(POINTINGS[i]) for i in INDEX.cone_search_indices(123.4, -45.6, 15.0)]
+
+
+def test_polygon_search_matches_brute_force():
+    polygons = [
+        [(30, -20), (50, -22), (52, -5), (28, -3)],
+        [(350, -10), (10, -10), (10, 10), (350, 10)],
+        [(0, 70), (120, 70), (240, 70)]
+    ]
+    for polygon in polygons:
+        expected = np.flatnonzero(util.points_in_polygons(RA, DEC, [polygon])[:, 0])
+        assert len(expected)
+        assert np.array_equal(INDEX.polygon_search_indices(polygon), expected)
+
+
+def test_nearest_matches_brute_force():
+    for ra, dec in QUERIES:
+        distances = util.gc_dist(RA, DEC, ra, dec)
+        for k in [1, 5, 40]:
+            expected = np.argsort(distances, kind="stable")[:k]
+            assert np.array_equal(INDEX.nearest_indices(ra, dec, k), expected)
+
+    assert len(INDEX.nearest_indices(0.0, 0.0, k=len(POINTINGS) + 10)) == len(POINTINGS)
+
+
+def test_empty_index():
+    index = PointingIndex([])
+    assert len(index.cone_search_indices(0.0, 0.0, 10.0)) == 0
+    assert len(index.polygon_search_indices([(0, 0), (1, 0), (1, 1)])) == 0
+    assert len(index.nearest_indices(0.0, 0.0, 3)) == 0
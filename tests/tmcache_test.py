@@ -0,0 +1,370 @@
+import sys
+import os
+import time
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../src'))
+
+import numpy as np
+
+from gwtm_api.core import tmcache
+from gwtm_api.core.tmcache import TMCache
+
+#each json entry below is ~1000 bytes, so a 2500 byte budget holds two of them
+ENTRY_BYTES = 1000
+BUDGET = 2500
+
+
+def _put(filename: str):
+    TMCache(filename=filename, cache_type="json", graceid=filename.split("_")[0]).put(payload={"d": "x" * (ENTRY_BYTES - 10)})
+    #distinct access times
+    time.sleep(0.01)
+
+
+def _get(filename: str):
+    payload = TMCache(filename=filename, cache_type="json").get()
+    time.sleep(0.01)
+    return payload
+
+
+def _cached(*filenames) -> list:
+    return sorted(x["filename"] for x in TMCache.entries() if x["filename"] in filenames)
+
+
+def _check_lru(fresh_cache, store: str):
+    fresh_cache(store, max_bytes=BUDGET)
+    _put("S1_a.json")
+    _put("S2_b.json")
+    assert _get("S1_a.json") is not None
+
+    #over budget, the least recently used entry goes
+    _put("S3_c.json")
+    assert _cached("S1_a.json", "S2_b.json", "S3_c.json") == ["S1_a.json", "S3_c.json"]
+    assert _get("S2_b.json") is None
+    assert TMCache.stats()["bytes"] <= BUDGET
+
+
+def _check_lfu(fresh_cache, store: str):
+    fresh_cache(store, policy="lfu", max_bytes=BUDGET)
+    _put("S1_a.json")
+    _put("S2_b.json")
+    for _ in range(3):
+        _get("S1_a.json")
+    _get("S2_b.json")
+
+    #the older but more frequently used entry stays
+    _put("S3_c.json")
+    assert _cached("S1_a.json", "S2_b.json", "S3_c.json") == ["S1_a.json", "S3_c.json"]
+
+
+def _check_pinning(fresh_cache, store: str):
+    fresh_cache(store, max_bytes=BUDGET)
+    TMCache.pin("S1")
+    _put("S1_a.json")
+    for name in ["S2_b.json", "S3_c.json", "S4_d.json"]:
+        _put(name)
+    assert "S1_a.json" in _cached("S1_a.json")
+
+    assert sorted(TMCache.prune(max_bytes=0)) == ["S4_d.json"]
+    assert [x["filename"] for x in TMCache.entries()] == ["S1_a.json"]
+    assert TMCache.entries()[0]["pinned"]
+
+    TMCache.unpin("S1")
+    assert TMCache.prune(max_bytes=0) == ["S1_a.json"]
+    assert TMCache.stats()["entries"] == 0
+
+
+def _check_stats(fresh_cache, store: str):
+    fresh_cache(store)
+    _put("S1_a.json")
+    _put("S2_b.json")
+    _get("S1_a.json")
+    _get("S1_a.json")
+    _get("S9_missing.json")
+
+    stats = TMCache.stats()
+    assert stats["entries"] == 2
+    assert stats["hits"] == 2
+    assert stats["misses"] == 1
+    assert stats["files"][0]["filename"] == "S1_a.json"
+    assert [x["filename"] for x in TMCache.entries(graceid="S2")] == ["S2_b.json"]
+
+
+def _fetch_once(store: str, counter_path: str):
+    '''
+        get_or_fetch from a worker process, counting the fetches in counter_path
+    '''
+    TMCache.configure(memory_max_entries=0, store=store)
+
+    def fetch():
+        with open(counter_path, "a") as counter:
+            counter.write("fetch\n")
+        time.sleep(0.3)
+        return {"v": 1}
+
+    return TMCache(filename="S1_shared.json", cache_type="json").get_or_fetch(fetch)
+
+
+def _check_single_flight_threads(fresh_cache, store: str):
+    fresh_cache(store)
+    counter_path = os.path.join(os.environ["HOME"], "fetches")
+
+    with ThreadPoolExecutor(8) as executor:
+        payloads = list(executor.map(lambda _: _fetch_once(store, counter_path), range(8)))
+
+    assert payloads == [{"v": 1}] * 8
+    with open(counter_path) as counter:
+        assert len(counter.readlines()) == 1
+
+
+def _check_single_flight_processes(fresh_cache, store: str):
+    fresh_cache(store)
+    counter_path = os.path.join(os.environ["HOME"], "fetches")
+
+    #spawned processes inherit HOME, so they share the cache
+    with multiprocessing.get_context("spawn").Pool(4) as pool:
+        payloads = pool.starmap(_fetch_once, [(store, counter_path)] * 4)
+
+    assert payloads == [{"v": 1}] * 4
+    with open(counter_path) as counter:
+        assert len(counter.readlines()) == 1
+
+
+def test_lru_eviction(fresh_cache):
+    _check_lru(fresh_cache, "directory")
+
+
+def test_lfu_eviction(fresh_cache):
+    _check_lfu(fresh_cache, "directory")
+
+
+def test_pinned_entries_are_not_evicted(fresh_cache):
+    _check_pinning(fresh_cache, "directory")
+
+
+def test_stats_count_hits_and_misses(fresh_cache):
+    _check_stats(fresh_cache, "directory")
+
+
+def test_reads_do_not_rewrite_the_index(fresh_cache):
+    cache_home = fresh_cache()
+    for i in range(50):
+        _put(f"S{i}_a.json")
+
+    index_path = os.path.join(cache_home, ".tmcache_index.json")
+    stamp = os.stat(index_path).st_mtime_ns
+    for i in range(50):
+        TMCache(filename=f"S{i}_a.json", cache_type="json").get()
+        TMCache(filename=f"S{i}_missing.json", cache_type="json").get()
+    assert os.stat(index_path).st_mtime_ns == stamp
+
+    #the logged reads are folded into the index when it is next loaded
+    stats = TMCache.stats()
+    assert stats["hits"] == 50
+    assert stats["misses"] == 50
+
+
+def test_get_or_fetch_single_flight_threads(fresh_cache):
+    _check_single_flight_threads(fresh_cache, "directory")
+
+
+def test_get_or_fetch_single_flight_processes(fresh_cache):
+    _check_single_flight_processes(fresh_cache, "directory")
+
+
+def test_locks_leave_no_files(fresh_cache):
+    cache_home = fresh_cache()
+    for i in range(20):
+        _put(f"S{i}_a.json")
+        TMCache(filename=f"S{i}_b.json", cache_type="json").get_or_fetch(lambda: {"v": i})
+    with TMCache(filename="S1_a.json", cache_type="json").lock():
+        #re-entrant within a thread
+        with TMCache(filename="S1_a.json", cache_type="json").lock():
+            assert len(os.listdir(os.path.join(cache_home, ".locks"))) == 1
+
+    assert os.listdir(os.path.join(cache_home, ".locks")) == []
+
+
+def test_sqlite_eviction_and_pinning(fresh_cache):
+    _check_lru(fresh_cache, "sqlite")
+    _check_lfu(fresh_cache, "sqlite")
+    _check_pinning(fresh_cache, "sqlite")
+    _check_stats(fresh_cache, "sqlite")
+
+
+def test_sqlite_single_flight(fresh_cache):
+    _check_single_flight_threads(fresh_cache, "sqlite")
+    _check_single_flight_processes(fresh_cache, "sqlite")
+    assert not os.path.exists(os.path.join(os.environ["HOME"], ".tmcache", ".locks"))
+
+
+def _round_trip(fresh_cache, store: str) -> dict:
+    fresh_cache(store)
+    skymap = np.random.default_rng(0).random(12 * 16**2)
+    payloads = {
+        "S1_a.json": ("json", {"a": [1, 2, 3], "b": None}),
+        "S1_b.npy": ("npy", skymap),
+        "S1_c.npz": ("npz", {"x": np.arange(5), "y": np.eye(3)}),
+        "S1_d.fits": ("fits", skymap)
+    }
+    read = {}
+    for filename, (cache_type, payload) in payloads.items():
+        entry = TMCache(filename=filename, cache_type=cache_type, graceid="S1")
+        entry.put(payload=payload)
+        entry.put_meta({"etag": filename})
+        read[filename] = (entry.get(), entry.get_meta())
+    return read
+
+
+def test_sqlite_matches_directory(fresh_cache):
+    directory, sqlite = _round_trip(fresh_cache, "directory"), _round_trip(fresh_cache, "sqlite")
+    assert directory.keys() == sqlite.keys()
+    for filename in directory:
+        (a, a_meta), (b, b_meta) = directory[filename], sqlite[filename]
+        assert a_meta == b_meta == {"etag": filename}
+        if isinstance(a, dict) and filename.endswith(".npz"):
+            assert a.keys() == b.keys() and all(np.array_equal(a[x], b[x]) for x in a)
+        elif isinstance(a, dict):
+            assert a == b
+        else:
+            assert np.array_equal(a, b)
+
+    assert [x["filename"] for x in TMCache.entries(kind="npy")] == ["S1_b.npy"]
+    assert len(TMCache.entries(graceid="S1")) == 4
+
+
+def test_sqlite_keeps_large_arrays_as_files(fresh_cache, monkeypatch):
+    cache_home = fresh_cache("sqlite")
+    monkeypatch.setattr(tmcache, "SQLITE_INLINE_MAX_BYTES", 10000)
+    files = os.path.join(cache_home, "tmcache.sqlite.files")
+    skymap = np.random.default_rng(0).random(12 * 64**2)
+
+    TMCache(filename="S1_large.npy", cache_type="npy").put(payload=skymap)
+    TMCache(filename="S1_small.npy", cache_type="npy").put(payload=skymap[:100])
+    written = sorted(os.listdir(files))
+    assert len(written) == 2 and written[0].endswith("_S1_large.npy") and written[1] == f"{written[0]}.json"
+    large = TMCache(filename="S1_large.npy", cache_type="npy").get()
+    assert isinstance(large, np.memmap) and np.array_equal(large, skymap)
+    assert TMCache.stats()["bytes"] > skymap.nbytes
+
+    #a rewrite goes to a new file and removes the one it replaced
+    TMCache(filename="S1_large.npy", cache_type="npy").put(payload=skymap * 2, overwrite=True)
+    rewritten = sorted(os.listdir(files))
+    assert len(rewritten) == 2 and rewritten[0] != written[0]
+    assert np.array_equal(TMCache(filename="S1_large.npy", cache_type="npy").get(), skymap * 2)
+
+    #the file of a row that is still referenced is never removed
+    tmcache._get_store()._remove_files([rewritten[0]])
+    assert sorted(os.listdir(files)) == rewritten
+
+    TMCache.prune(max_bytes=0)
+    assert os.listdir(files) == []
+
+
+def test_sqlite_eviction_keeps_files_rewritten_since(fresh_cache, monkeypatch):
+    #S1 is evicted by a write of S2, and rewritten by another writer before that write removes its file
+    fresh_cache("sqlite", max_bytes=150000)
+    monkeypatch.setattr(tmcache, "SQLITE_INLINE_MAX_BYTES", 10000)
+    store = tmcache._get_store()
+    skymap = np.random.default_rng(0).random(12 * 32**2)
+    TMCache(filename="S1_large.npy", cache_type="npy").put(payload=skymap)
+
+    remove_files = store._remove_files
+
+    def rewrite_then_remove(files):
+        if len(files):
+            monkeypatch.setattr(store, "_remove_files", remove_files)
+            TMCache(filename="S1_large.npy", cache_type="npy").put(payload=skymap * 3, overwrite=True)
+        remove_files(files)
+
+    monkeypatch.setattr(store, "_remove_files", rewrite_then_remove)
+    TMCache(filename="S2_large.npy", cache_type="npy").put(payload=skymap)
+    assert np.array_equal(TMCache(filename="S1_large.npy", cache_type="npy").get(), skymap * 3)
+
+
+def test_configure_only_changes_what_is_given(fresh_cache):
+    fresh_cache("sqlite", policy="lfu", max_bytes=1234)
+    TMCache.configure(memory_max_entries=16)
+    assert TMCache.stats()["store"] == "sqlite"
+    assert TMCache.stats()["max_bytes"] == 1234
+    assert tmcache._config["policy"] == "lfu"
+    assert TMCache.stats()["memory"]["max_entries"] == 16
+
+
+def test_key_locks_are_dropped_once_released(fresh_cache):
+    fresh_cache()
+    with TMCache(filename="S1_a.json", cache_type="json").lock():
+        assert len(tmcache._thread_locks) == 1
+
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(
+            lambda i: TMCache(filename=f"S{i % 5}_a.json", cache_type="json").get_or_fetch(lambda: {"v": i}), range(40)
+        ))
+    assert tmcache._thread_locks == {}
+
+
+def _check_memory_tier(fresh_cache, store: str):
+    fresh_cache(store)
+    TMCache.configure(memory_max_entries=8)
+    entry = TMCache(filename="S1_a.json", cache_type="json")
+    entry.put(payload={"v": 1})
+    #the memory tier's counters are kept for the life of the process
+    start = TMCache.stats()["memory"]
+
+    first = entry.get()
+    assert entry.get() is first
+    assert TMCache.stats()["memory"]["hits"] - start["hits"] == 1
+
+    #rewritten, so the stamp it was kept with no longer matches
+    entry.put(payload={"v": 2}, overwrite=True)
+    assert entry.get() == {"v": 2}
+    assert TMCache.stats()["memory"]["misses"] - start["misses"] == 2
+
+    #evicted from the store, so it is not served from memory either
+    TMCache.prune(max_bytes=0)
+    assert entry.get() is None
+
+
+def test_memory_tier_serves_entries_until_they_change(fresh_cache):
+    _check_memory_tier(fresh_cache, "directory")
+    _check_memory_tier(fresh_cache, "sqlite")
+
+
+def test_memory_tier_is_bounded():
+    memory = tmcache._MemoryTier(max_bytes=100, max_entries=3)
+    for name in ["a", "b", "c"]:
+        memory.put(name, 1, name, 10)
+    memory.get("a", 1)
+
+    #over max_entries, the least recently used goes
+    memory.put("d", 1, "d", 10)
+    assert list(memory.entries) == ["c", "a", "d"]
+
+    #over max_bytes, as many as needed go
+    memory.put("e", 1, "e", 85)
+    assert list(memory.entries) == ["d", "e"]
+    assert memory.nbytes == 95
+
+    #an entry larger than the budget is not kept
+    memory.put("f", 1, "f", 101)
+    assert "f" not in memory.entries
+
+    #a stale stamp is a miss, and drops the entry
+    assert memory.get("e", 2) is None
+    assert list(memory.entries) == ["d"]
+    assert memory.stats()["hits"] == 1 and memory.stats()["misses"] == 1
+
+
+def test_memory_tier_counts_arrays_by_size(fresh_cache):
+    fresh_cache()
+    TMCache.configure(memory_max_bytes=3 * 8000, memory_max_entries=100)
+    for i in range(5):
+        TMCache(filename=f"S{i}_a.npz", cache_type="npz").put(payload={"x": np.arange(1000, dtype=float)})
+        TMCache(filename=f"S{i}_a.npz", cache_type="npz").get()
+
+    memory = TMCache.stats()["memory"]
+    assert memory["entries"] == 3
+    assert memory["bytes"] == 3 * 8000
+    #the payloads are shared, so they are read-only
+    assert not TMCache(filename="S4_a.npz", cache_type="npz").get()["x"].flags.writeable
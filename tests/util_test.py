@@ -0,0 +1,74 @@
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../src'))
+
+import numpy as np
+import healpy as hp
+
+from gwtm_api.core import util
+
+#edges along the equator and two meridians are great circles, so points on them are exactly on an edge
+SQUARE = [(10, 0), (12, 0), (12, 2), (10, 2)]
+
+
+def test_points_in_polygons_matches_healpix():
+    polygons = [
+        [(30, -20), (34, -21), (35, -16), (31, -15)],
+        [(200, 60), (215, 62), (205, 70)],
+        [(359, -1), (1, -1), (1, 1), (359, 1)]
+    ]
+    nside = 256
+    for polygon in polygons:
+        #pixel centers around the polygon, query_polygon returns those whose center is inside it
+        uvecs = util.polygon_to_uvecs(polygon)
+        near = hp.query_disc(nside, uvecs.mean(axis=0) / np.linalg.norm(uvecs.mean(axis=0)), np.deg2rad(12))
+        ra, dec = hp.pix2ang(nside, near, lonlat=True)
+
+        inside = util.points_in_polygons(ra, dec, [polygon])[:, 0]
+        expected = np.isin(near, hp.query_polygon(nside, uvecs))
+        assert inside.any()
+        assert np.array_equal(inside, expected)
+
+
+def test_points_in_polygons_either_winding():
+    rng = np.random.default_rng(0)
+    ra, dec = rng.uniform(9, 13, 500), rng.uniform(-1, 3, 500)
+
+    counter_clockwise = util.points_in_polygons(ra, dec, [SQUARE])
+    clockwise = util.points_in_polygons(ra, dec, [SQUARE[::-1]])
+    closed = util.points_in_polygons(ra, dec, [SQUARE + [SQUARE[0]]])
+
+    assert counter_clockwise.any() and not counter_clockwise.all()
+    assert np.array_equal(counter_clockwise, clockwise)
+    assert np.array_equal(counter_clockwise, closed)
+
+
+def test_points_on_an_edge_are_inside():
+    ra = [11, 12, 10, 12, 11, 11]
+    dec = [0, 1, 0, 2, -1e-6, 1]
+    inside = util.points_in_polygons(ra, dec, [SQUARE, SQUARE[::-1]])
+
+    #on the equator edge, on a meridian edge, on two vertices, just outside, well inside
+    assert inside.shape == (6, 2)
+    assert np.array_equal(inside[:, 0], [True, True, True, True, False, True])
+    assert np.array_equal(inside[:, 0], inside[:, 1])
+
+
+def test_points_in_polygons_shapes():
+    triangle = [(200, 60), (215, 62), (205, 70)]
+    inside = util.points_in_polygons([207, 100, 11], [64, 0, 1], [triangle, SQUARE])
+    assert np.array_equal(inside, [[True, False], [False, False], [False, True]])
+
+    assert util.points_in_polygons([], [], [SQUARE]).shape == (0, 1)
+    assert util.points_in_polygons([11], [1], []).shape == (1, 0)
+
+
+def test_paired_points_in_polygons_matches_points_in_polygons():
+    polygons = [SQUARE, [(200, 60), (215, 62), (205, 70)]]
+    normals = util.polygon_edge_normals(polygons)
+    ra, dec = np.array([11, 207, 100]), np.array([1, 64, 0])
+
+    #every point against both polygons, as pairs
+    paired = util.paired_points_in_polygons(ra, dec, np.broadcast_to(normals, (3,) + normals.shape))
+    assert np.array_equal(paired, util.points_in_polygons(ra, dec, polygons))